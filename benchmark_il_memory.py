@@ -0,0 +1,132 @@
+from configs.default import get_config
+from model.policy import *
+from trainer.il.il_trainer import *
+from gym.spaces.dict import Dict as SpaceDict
+from gym.spaces.box import Box
+from gym.spaces.discrete import Discrete
+import os, argparse, torch, time, numpy as np
+from dataset.habitatdataset import ILDataset, ILCollate
+from torch.utils.data import DataLoader
+project_dir = os.path.dirname(os.path.abspath(__file__))
+
+# Peak GPU memory and throughput of IL training steps, for several truncated BPTT chunk lengths
+# (IL.bptt_chunk_length), with and without activation checkpointing (IL.checkpoint_activations).
+# Every setting trains a fresh policy on the same batches of the validation split.
+parser = argparse.ArgumentParser()
+parser.add_argument("--config", type=str, default="configs/TSGM.yaml")
+parser.add_argument("--prebuild-path", type=str, default="data/graph")
+parser.add_argument("--gpu", type=str, default="0")
+parser.add_argument('--data-dir', default='IL_data', type=str)
+parser.add_argument('--dataset', default='gibson', type=str)
+parser.add_argument('--task', default='imggoalnav', type=str)
+parser.add_argument('--policy', default='TSGMPolicy', type=str)
+parser.add_argument('--num-object', default=10, type=int)
+parser.add_argument('--batch-size', default=4, type=int)
+parser.add_argument('--max-input-length', default=100, type=int)
+parser.add_argument('--chunk-lengths', type=int, nargs='+', default=[0, 50, 25, 10])
+parser.add_argument('--num-iters', default=10, type=int)
+parser.add_argument('--num-warmup', default=2, type=int)
+parser.add_argument('--seed', default=1, type=int)
+args = parser.parse_args()
+args.data_dir = os.path.join(project_dir, args.data_dir)
+args.prebuild_path = os.path.join(project_dir, args.prebuild_path)
+
+
+def make_config(chunk_length, checkpoint_activations):
+    config = get_config(args.config, base_task_config_path="./configs/{}_{}.yaml".format(args.task, args.dataset), arguments=vars(args))
+    config.defrost()
+    config.POLICY = args.policy
+    config.IL.batch_size = args.batch_size
+    config.NUM_PROCESSES = config.IL.batch_size
+    config.TORCH_GPU_ID = args.gpu
+    config.scene_data = args.dataset
+    config.IL.WRAPPER = "ILWrapper"
+    config.features.object_category_num = 80
+    config.memory.num_objects = args.num_object
+    config.ENV_NAME = "ImageGoalEnv"
+    config.TASK_CONFIG.TRAIN_IL = True
+    config.TASK_CONFIG.DATASET.DATASET_NAME = args.dataset
+    config.IMG_SHAPE = (64, 252)
+    config.max_input_length = args.max_input_length
+    config.OBJECTGRAPH.SPARSE = False
+    config.IL.bptt_chunk_length = chunk_length
+    config.IL.checkpoint_activations = checkpoint_activations
+    config.freeze()
+    return config
+
+
+def make_trainer(config):
+    observation_space = SpaceDict({
+        'panoramic_rgb': Box(low=0, high=256, shape=(64, 256, 3), dtype=np.float32),
+        'panoramic_depth': Box(low=0, high=256, shape=(64, 256, 1), dtype=np.float32),
+        'target_goal': Box(low=0, high=256, shape=(64, 256, 3), dtype=np.float32),
+        'step': Box(low=0, high=500, shape=(1,), dtype=np.float32),
+        'prev_act': Box(low=0, high=3, shape=(1,), dtype=np.int32),
+        'gt_action': Box(low=0, high=3, shape=(1,), dtype=np.int32)
+    })
+    policy = eval(config.POLICY)(
+        observation_space=observation_space,
+        action_space=Discrete(4),
+        hidden_size=config.features.hidden_size,
+        rnn_type=config.features.rnn_type,
+        num_recurrent_layers=config.features.num_recurrent_layers,
+        backbone=config.features.backbone,
+        goal_sensor_uuid=config.TASK_CONFIG.TASK.GOAL_SENSOR_UUID,
+        normalize_visual_inputs=True,
+        cfg=config
+    )
+    return eval(config.TASK_CONFIG.IL_TRAINER)(config, policy)
+
+
+def load_batches(config, num_batches):
+    data_list = [os.path.join(args.data_dir, 'val', x) for x in sorted(os.listdir(os.path.join(args.data_dir, 'val')))
+                 if x.endswith('.dat.gz') and os.path.exists(os.path.join(args.prebuild_path, 'val', x))]
+    dataset = ILDataset(config, data_list, graph_dir=os.path.join(args.prebuild_path, 'val'))
+    dataloader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True, collate_fn=ILCollate(config.max_input_length))
+    batches = []
+    for batch in dataloader:
+        batches.append(batch)
+        if len(batches) == num_batches:
+            break
+    return batches
+
+
+def copy_batch(batch):
+    # The trainer moves and replaces the entries of the batch dicts
+    return tuple(dict(x) if isinstance(x, dict) else x for x in batch)
+
+
+def benchmark(config, batches):
+    torch.manual_seed(args.seed)
+    trainer = make_trainer(config)
+    trainer.to(trainer.torch_device)
+    trainer.train()
+    for batch in batches[:args.num_warmup]:
+        trainer(copy_batch(batch))
+    torch.cuda.synchronize()
+    torch.cuda.reset_peak_memory_stats()
+    num_samples = 0
+    losses = []
+    start = time.time()
+    for batch in batches[args.num_warmup:]:
+        _, loss_dict = trainer(copy_batch(batch))
+        num_samples += batch[0]['action'].shape[0]
+        losses.append(loss_dict['act_loss'])
+    torch.cuda.synchronize()
+    elapsed = time.time() - start
+    peak = torch.cuda.max_memory_allocated() / 2 ** 20
+    del trainer
+    torch.cuda.empty_cache()
+    return peak, num_samples / elapsed, np.mean(losses)
+
+
+if __name__ == '__main__':
+    np.random.seed(args.seed)
+    batches = load_batches(make_config(0, False), args.num_warmup + args.num_iters)
+    print('====================================')
+    print('%8s | %10s | %14s | %10s | %8s' % ('chunk', 'checkpoint', 'peak mem(MiB)', 'samples/s', 'act_loss'))
+    for checkpoint_activations in [False, True]:
+        for chunk_length in args.chunk_lengths:
+            peak, throughput, loss = benchmark(make_config(chunk_length, checkpoint_activations), batches)
+            print('%8s | %10s | %14.0f | %10.2f | %8.3f' % (chunk_length if chunk_length > 0 else 'full', checkpoint_activations, peak, throughput, loss))
+    print('====================================')
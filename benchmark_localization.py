@@ -0,0 +1,89 @@
+import argparse, time, numpy as np
+from model.Graph.graph_update import is_close
+from model.Graph.graph_index import FlatIndex, IVFIndex
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--seed", type=int, default=1)
+parser.add_argument("--memory-sizes", type=int, nargs='+', default=[100, 300, 1000, 3000, 10000])
+parser.add_argument("--feature-dim", type=int, default=512)
+parser.add_argument("--num-queries", type=int, default=200)
+parser.add_argument("--topk", type=int, default=5)
+parser.add_argument("--img-node-th", type=float, default=0.75)
+parser.add_argument("--ivf-nlist", type=int, default=64)
+parser.add_argument("--ivf-nprobe", type=int, default=8)
+args = parser.parse_args()
+
+
+def normalize(x):
+    return (x / np.linalg.norm(x, axis=-1, keepdims=True)).astype(np.float32)
+
+
+def make_memory(num_node, num_query, feature_dim):
+    # Clustered embeddings, so that queries have close nodes like in a real trajectory
+    centers = normalize(np.random.randn(max(num_node // 20, 1), feature_dim))
+    memory = normalize(centers[np.random.randint(len(centers), size=num_node)] + 0.05 * np.random.randn(num_node, feature_dim))
+    queries = normalize(memory[np.random.randint(num_node, size=num_query)] + 0.02 * np.random.randn(num_query, feature_dim))
+    return memory, queries
+
+
+def scan_localize(graph_memory, graph_mask, new_embedding, last_localized_node_idx, th):
+    # The former localization loop of update_image_graph
+    check_list = 1 - graph_mask.copy()
+    check_list[last_localized_node_idx] = 1.0
+    found = False
+    found_node = None
+    while not found:
+        not_checked_yet = np.where((1 - check_list))[0]
+        neighbor_embedding = graph_memory[not_checked_yet]
+        if len(not_checked_yet) == 0:
+            break
+        close, prob = is_close(new_embedding[None], neighbor_embedding, return_prob=True, th=th)
+        close = close[0]
+        prob = prob[0]
+        if len(np.where(close)[0]) >= 1:
+            found_node = not_checked_yet[prob.argmax()]
+            found = True
+        check_list[found_node] = 1.0
+    return found_node
+
+
+def build_index(index_cls, memory, **kwargs):
+    index = index_cls(memory.shape[1], len(memory), **kwargs)
+    index.reset()
+    for node_idx in range(len(memory)):
+        index.add(node_idx, memory[node_idx])
+    return index
+
+
+def index_localize(index, new_embedding, last_localized_node_idx, th, k):
+    node_indices, scores = index.search(new_embedding, k, exclude=last_localized_node_idx)
+    node_indices = node_indices[scores > th]
+    return node_indices[0] if len(node_indices) > 0 else None
+
+
+def timeit(fn, queries):
+    results = []
+    start = time.time()
+    for query in queries:
+        results.append(fn(query))
+    return (time.time() - start) / len(queries) * 1000., results
+
+
+if __name__ == '__main__':
+    np.random.seed(args.seed)
+    print('====================================')
+    print('%8s | %10s | %10s | %10s | %10s | %8s' % ('N', 'scan(ms)', 'flat(ms)', 'ivf(ms)', 'ivf build', 'ivf top1'))
+    for num_node in args.memory_sizes:
+        memory, queries = make_memory(num_node, args.num_queries, args.feature_dim)
+        graph_mask = np.ones(num_node)
+        flat = build_index(FlatIndex, memory)
+        start = time.time()
+        ivf = build_index(IVFIndex, memory, nlist=args.ivf_nlist, nprobe=args.ivf_nprobe, min_train=min(num_node, 1024))
+        ivf_build = (time.time() - start) * 1000.
+        scan_t, scan_res = timeit(lambda q: scan_localize(memory, graph_mask, q, 0, args.img_node_th), queries)
+        flat_t, flat_res = timeit(lambda q: index_localize(flat, q, 0, args.img_node_th, args.topk), queries)
+        ivf_t, ivf_res = timeit(lambda q: index_localize(ivf, q, 0, args.img_node_th, args.topk), queries)
+        assert all([a == b for a, b in zip(scan_res, flat_res)]), "Flat index disagrees with the scan"
+        recall = np.mean([a == b for a, b in zip(scan_res, ivf_res)])
+        print('%8d | %10.3f | %10.3f | %10.3f | %10.1f | %8.3f' % (num_node, scan_t, flat_t, ivf_t, ivf_build, recall))
+    print('====================================')
@@ -1,8 +1,10 @@
-import argparse, glob, joblib, torch, os, parmap, numpy as np
+import argparse, glob, hashlib, joblib, torch, os, time, parmap, numpy as np
 from configs.default import get_config
 from torchvision.ops import nms as torch_nms
 import quaternion as q
-from env_utils import *
+from model.Graph.graph_builder import GraphBuilder
+from model.Graph.graph_log import GraphEventLog
+from utils.collect_manifest import CollectManifest, atomic_dump, select_shard
 
 torch.set_num_threads(5)
 torch.backends.cudnn.enabled = True
@@ -28,6 +30,11 @@ parser.add_argument('--mode', default='collect_graph', type=str)
 parser.add_argument('--data-dir', default='IL_data/gibson_fd', type=str)
 parser.add_argument('--record-dir', type=str, default='data')
 parser.add_argument('--num-procs', default=16, type=int)
+parser.add_argument('--encode-batch-size', default=64, type=int, help="frames per image/object encoder call")
+parser.add_argument('--embedding-cache-dir', default='', type=str, help="cache the frame embeddings here, reused across threshold changes")
+parser.add_argument('--num-shards', default=1, type=int, help="split the episodes into this many shards, e.g. one per machine")
+parser.add_argument('--shard-id', default=0, type=int, help="shard collected by this run")
+parser.add_argument('--sweep', default='', type=str, help="threshold pairs 'img_th,obj_th;img_th,obj_th;...' built in one pass, each saved to record_dir/graph_img{img_th}_obj{obj_th}")
 
 args = parser.parse_args()
 args.record = int(args.record)
@@ -41,59 +48,111 @@ if args.gpu != 'cpu':
 device = 'cpu' if args.gpu == '-1' else 'cuda:{}'.format(args.gpu)
 
 
-def collect_graph(data_list):
+def file_hash(file_names):
+    """ sha1 of the content of the files """
+    sha = hashlib.sha1()
+    for file_name in file_names:
+        with open(file_name, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha.update(chunk)
+    return sha.hexdigest()
+
+
+def graph_variants(args):
+    """ (img_node_th, obj_node_th, graph_dir) of every graph set to build, one per --sweep pair """
+    if not args.sweep:
+        return [(args.img_node_th, args.obj_node_th, os.path.join(args.record_dir, 'graph', args.split))]
+    variants = []
+    for pair in args.sweep.split(';'):
+        img_node_th, obj_node_th = [float(th) for th in pair.split(',')]
+        variants.append((img_node_th, obj_node_th, os.path.join(args.record_dir, 'graph_img{}_obj{}'.format(img_node_th, obj_node_th), args.split)))
+    return variants
+
+
+def encode_episode(builder, batch, data_path, cache_key):
+    """
+    Stage 1: image and object embeddings of all the frames of an episode, encoded in batches.
+    With --embedding-cache-dir, they are loaded from / saved to the cache, keyed by the hash of the episode file
+    together with cache_key (encoders and object filtering).
+    """
+    cache_file = None
+    if args.embedding_cache_dir:
+        cache_file = os.path.join(args.embedding_cache_dir, '{}_{}.npz'.format(file_hash([data_path]), cache_key))
+        if os.path.exists(cache_file):
+            cache = np.load(cache_file)
+            return cache['img_embeddings'], cache['obj_embeddings']
+    img_embeddings = builder.embed_obs_batch(batch['panoramic_rgb'], args.encode_batch_size)
+    obj_embeddings = builder.embed_object_batch(batch['panoramic_rgb'], batch['object'], args.encode_batch_size)
+    if cache_file is not None:
+        tmp_file = cache_file[:-len('.npz')] + '.tmp{}.npz'.format(os.getpid())
+        np.savez(tmp_file, img_embeddings=img_embeddings, obj_embeddings=obj_embeddings)
+        os.replace(tmp_file, cache_file)
+    return img_embeddings, obj_embeddings
+
+
+def build_graph_log(builder, batch, img_embeddings, obj_embeddings):
+    """ Stage 2: graphs of all the frames of an episode, built from the precomputed embeddings """
+    graph_log = GraphEventLog()
+    for t in range(batch['panoramic_rgb'].shape[0]):
+        obs_t = {
+            'panoramic_rgb': batch['panoramic_rgb'][t],
+            'panoramic_depth': batch['panoramic_depth'][t],
+            'position': batch['position'][t],
+            'rotation': batch['rotation'][t],
+            'object': batch['object'][t],
+            'object_mask': batch['object_mask'][t],
+            'object_score': batch['object_score'][t],
+            'object_category': batch['object_category'][t],
+            'object_pose': batch['object_pose'][t],
+            'object_depth': np.sqrt(np.sum((batch['object_pose'][t] - batch['position'][t])[:, [0, 2]] ** 2, -1)),
+            'step': t,
+        }
+        builder.update(obs_t, reset=t == 0, embeddings=(img_embeddings[t], obj_embeddings[t]))
+        graph_log.append(builder.get_memory())
+    return graph_log
+
+
+def get_manifest(args):
+    return CollectManifest(os.path.join(args.record_dir, 'manifest', 'collect_graph_{}'.format(args.split)), args.num_shards, args.shard_id)
+
+
+def embedding_cache_key(config):
+    """ Key of the encoders and the object filtering, the object embeddings also depend on the detections kept by pull_image """
+    builder = GraphBuilder(config)
+    return hashlib.sha1('{}_{}_{}'.format(file_hash([builder.encoder_checkpoint('Img_encoder.pth.tar'), builder.encoder_checkpoint('Obj_encoder.pth.tar')]),
+                                          args.obj_score_th, config.memory.num_objects).encode()).hexdigest()[:16]
+
+
+def collect_graph(data_list, cache_key):
+    """ Build the graphs of the episodes of data_list, a chunk of the episodes handled by one process """
     data_list = [data_list] if type(data_list) is not list else data_list
     config = collect_config(args)
-    env = eval(config.ENV_NAME)(config)
-    graph_dir = os.path.join(args.record_dir, 'graph', args.split)
+    manifest = get_manifest(args)
+    # Only the encoders and the graphs, no simulator. The encoders are loaded on the first cache miss.
+    builder = GraphBuilder(config, device if torch.cuda.is_available() else 'cpu')
     with torch.no_grad():
         for data_path in data_list:
             batch = pull_image(data_path, config)
-            record_graphs = []
-            for t in range(batch['panoramic_rgb'].shape[0]):
-                obs_t = {
-                    'panoramic_rgb': batch['panoramic_rgb'][t],
-                    'panoramic_depth': batch['panoramic_depth'][t],
-                    'position': batch['position'][t],
-                    'rotation': batch['rotation'][t],
-                    'object': batch['object'][t],
-                    'object_mask': batch['object_mask'][t],
-                    'object_score': batch['object_score'][t],
-                    'object_category': batch['object_category'][t],
-                    'object_pose': batch['object_pose'][t],
-                    'object_depth': np.sqrt(np.sum((batch['object_pose'][t] - batch['position'][t])[:, [0, 2]] ** 2, -1)),
-                    'step': t,
-                }
-                if t == 0:
-                    env.build_graph(obs_t, reset=True)
-                else:
-                    env.build_graph((obs_t,None,None,None))
-                max_num_img_node = env.imggraph.num_node()
-                max_num_obj_node = env.objgraph.num_node()
-                img_memory_dict = {
-                    'img_memory_feat': env.imggraph.graph_memory[:max_num_img_node].copy(),
-                    'img_memory_pose': np.stack(env.imggraph.node_position_list).copy(),
-                    'img_memory_mask': env.imggraph.graph_mask[:max_num_img_node].copy(),
-                    'img_memory_A': env.imggraph.A[:max_num_img_node, :max_num_img_node].copy(),
-                    'img_memory_idx': env.imggraph.last_localized_node_idx,
-                    'img_memory_time': env.imggraph.graph_time[:max_num_img_node].copy()
-                }
-                obj_memory_dict = {
-                    'obj_memory_feat': env.objgraph.graph_memory[:max_num_obj_node].copy(),
-                    'obj_memory_pose': np.stack(env.objgraph.node_position_list).copy(),
-                    'obj_memory_score': env.objgraph.graph_score[:max_num_obj_node].copy(),
-                    'obj_memory_category': env.objgraph.graph_category[:max_num_obj_node].copy(),
-                    'obj_memory_mask': env.objgraph.graph_mask[:max_num_obj_node].copy(),
-                    'obj_memory_A_OV': env.objgraph.A_OV[:max_num_obj_node, :max_num_img_node].copy(),
-                    'obj_memory_time': env.objgraph.graph_time[:max_num_obj_node].copy()
-                }
-                img_memory_dict.update(obj_memory_dict)
-                record_graphs.append(img_memory_dict)
-            file_name = os.path.join(graph_dir, data_path.split('/')[-1])
-            data = {'graph': record_graphs}
-            joblib.dump(data, file_name)
-            print(f"Processing... {len(glob.glob(os.path.join(graph_dir, '*.dat.gz')))}/{len(glob.glob(os.path.join(args.data_dir, args.split, '*.dat.gz')))}.")
-            del data
+            num_frames = batch['panoramic_rgb'].shape[0]
+            episode_name = data_path.split('/')[-1]
+            manifest.start(episode_name)
+            encode_start = time.time()
+            img_embeddings, obj_embeddings = encode_episode(builder, batch, data_path, cache_key)
+            encode_time = time.time() - encode_start
+            outputs = []
+            for img_node_th, obj_node_th, graph_dir in graph_variants(args):
+                builder.imggraph.node_th = img_node_th
+                builder.objgraph.node_th = obj_node_th
+                graph_start = time.time()
+                graph_log = build_graph_log(builder, batch, img_embeddings, obj_embeddings)
+                graph_time = time.time() - graph_start
+                print(f"{episode_name} ({img_node_th}, {obj_node_th}): encoding {num_frames / encode_time:.1f} frames/s, graph update {num_frames / graph_time:.1f} frames/s")
+                file_name = os.path.join(graph_dir, episode_name)
+                data = {'graph_log': graph_log.state_dict()}
+                atomic_dump(data, file_name)
+                outputs.append(file_name)
+                del data
+            manifest.finish(episode_name, outputs)
 
 
 def pull_image(data_path, config):
@@ -182,22 +241,30 @@ if __name__=='__main__':
     print('====================================')
     print('Dataset Name: ', args.dataset)
     print('Split: ', args.split)
-    print('Image Graph Threshold: ', config.TASK_CONFIG.img_node_th)
-    print('Object Graph Threshold: ', config.TASK_CONFIG.obj_node_th)
+    for img_node_th, obj_node_th, graph_dir in graph_variants(args):
+        print('Image / Object Graph Threshold: {} / {} -> {}'.format(img_node_th, obj_node_th, graph_dir))
     print('====================================')
 
-    os.makedirs(os.path.join(args.record_dir, 'graph'), exist_ok=True)
-    graph_dir = os.path.join(args.record_dir, 'graph', args.split)
-    os.makedirs(graph_dir, exist_ok=True)
-    existing_files = glob.glob(graph_dir + "/*")
-
-    data_list = [os.path.join(args.data_dir, args.split, x) for x in sorted(os.listdir(os.path.join(args.data_dir, args.split))) if "dat.gz" in x]
-    existing_files = [os.path.join(args.data_dir, args.split, data_path.split('/')[-1]) for data_path in existing_files]
-    if len(existing_files) > 0:
-        for ef in existing_files:
-            if ef in data_list:
-                data_list.remove(ef)
-    num_data = len(data_list)
-    data_list = np.stack(sorted(data_list))
-    # collect_graph(data_list)
-    parmap.map(collect_graph, data_list, pm_processes = args.num_procs)
\ No newline at end of file
+    data_list = [os.path.join(args.data_dir, args.split, x) for x in sorted(os.listdir(os.path.join(args.data_dir, args.split))) if x.endswith('.dat.gz')]
+    data_list = select_shard(data_list, args.num_shards, args.shard_id)
+    for _, _, graph_dir in graph_variants(args):
+        os.makedirs(graph_dir, exist_ok=True)
+    if args.embedding_cache_dir:
+        os.makedirs(args.embedding_cache_dir, exist_ok=True)
+    # Resume from the manifest: skip the episodes whose graphs were built for every threshold pair
+    manifest = get_manifest(args)
+    # Episodes whose graphs were built before the manifest was used
+    for data_path in data_list:
+        name = data_path.split('/')[-1]
+        manifest.adopt(name, [os.path.join(graph_dir, name) for _, _, graph_dir in graph_variants(args)])
+    manifest.plan([data_path.split('/')[-1] for data_path in data_list])
+    data_list = [data_path for data_path in data_list
+                 if not manifest.is_done(data_path.split('/')[-1], [os.path.join(graph_dir, data_path.split('/')[-1]) for _, _, graph_dir in graph_variants(args)])]
+    print('Shard {}/{}: {} episodes to process'.format(args.shard_id, args.num_shards, len(data_list)))
+    if len(data_list) == 0:
+        exit()
+    cache_key = embedding_cache_key(config)
+    # One chunk of episodes per process, which builds its config, manifest and encoders once
+    chunks = [chunk.tolist() for chunk in np.array_split(np.stack(sorted(data_list)), min(args.num_procs, len(data_list)))]
+    # collect_graph(chunks[0], cache_key)
+    parmap.map(collect_graph, chunks, cache_key, pm_processes = args.num_procs)
\ No newline at end of file
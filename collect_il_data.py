@@ -14,6 +14,7 @@ from tqdm import tqdm
 from habitat import make_dataset
 from env_utils.make_env_utils import add_panoramic_camera
 from utils.statics import GIBSON_TINY_TRAIN_SCENE, GIBSON_TINY_TEST_SCENE
+from utils.collect_manifest import CollectManifest, atomic_dump, select_shard
 
 
 os.environ['GLOG_minloglevel'] = "2"
@@ -33,8 +34,8 @@ parser.add_argument("--version", type=str, default="collect", help="name to save
 parser.add_argument('--task', default='imggoalnav', type=str)
 parser.add_argument('--use-detector', action='store_true', default=False)
 parser.add_argument('--fd', action='store_true', default=False)
-parser.add_argument('--num-splits', type=int, default=1, help='number of processes to run simultaneously')
-parser.add_argument('--split-idx', default=0, type=int)
+parser.add_argument('--num-shards', '--num-splits', dest='num_shards', type=int, default=1, help='split the scenes into this many shards, e.g. one per machine')
+parser.add_argument('--shard-id', '--split-idx', dest='shard_id', default=0, type=int, help='shard collected by this run')
 parser.add_argument('--project-dir', default='.', type=str)
 parser.add_argument('--mode', default='collect', type=str)
 args = parser.parse_args()
@@ -49,7 +50,7 @@ def make_env_fn(config_env, rank):
     return env
 
 
-def data_collect(config, DATA_DIR, space_id, tot_space_num, start_idx, num_episodes):
+def data_collect(config, DATA_DIR, space_id, tot_space_num, start_idx, num_episodes, manifest):
     num_of_envs = args.num_procs
     configs = []
     gpu_ids = np.zeros(num_of_envs)
@@ -87,6 +88,9 @@ def data_collect(config, DATA_DIR, space_id, tot_space_num, start_idx, num_episo
         while True:
             observations = envs.reset()
             episodes = envs.current_episodes()
+            # The successful envs of this round collect the next episode indices, in order
+            for episode_name in episode_names[episode:min(episode + num_of_envs, num_episodes)]:
+                manifest.start(episode_name)
 
             datas = [{'rgb': [], 'depth': [], 'position': [], 'rotation': [], 'action': [],
                       'target_idx': [], 'target_img': None, 'target_pose': None,  'distance': [],
@@ -157,7 +161,9 @@ def data_collect(config, DATA_DIR, space_id, tot_space_num, start_idx, num_episo
             for i in range(num_of_envs):
                 success = successes[i]
                 if success:
-                    joblib.dump(datas[i], os.path.join(DATA_DIR, episode_names[episode] + '.dat.gz'))
+                    file_name = os.path.join(DATA_DIR, episode_names[episode] + '.dat.gz')
+                    atomic_dump(datas[i], file_name)
+                    manifest.finish(episode_names[episode], [file_name])
 
                     episode += 1
                     pbar.update(1)
@@ -249,30 +255,23 @@ def main():
     # else:
     for scene in scenes:
         ep_per_env[scene] = args.ep_per_env
-    collected_scenes = list(np.unique([pp.split("_")[0] for pp in os.listdir(DATA_DIR)]))
-    collected_scenes_orig = collected_scenes.copy()
-    scene_dict = {}
-    for cs in collected_scenes_orig:
-        list_collected = sorted(glob.glob(os.path.join(DATA_DIR, cs) + '*'))
-        print("collected", cs, len(list_collected))
-        if len(list_collected) < ep_per_env[cs]:
-            collected_scenes.remove(cs)
-            scene_dict[cs] = len(list_collected)
-            # for lc in list_collected:
-            #     os.remove(lc)
-    print("collected:", collected_scenes)
     scenes = np.sort(scenes)
-    if args.split_idx == 0:
+    if args.shard_id == 0:
         with open(os.path.join(args.project_dir, args.data_dir, f'{args.split}_config.json'), 'w') as f:
             json.dump(config, f)
-    scenes = np.array_split(scenes, args.num_splits)[args.split_idx]
-    scenes = list(scenes)
-    scenes = np.array(scenes)
+    # Consecutive blocks of scenes, as --num-splits/--split-idx always did
+    scenes = select_shard(list(scenes), args.num_shards, args.shard_id, contiguous=True)
     print(scenes)
+    # Resume from the manifest: the episodes of a scene are collected in order, start from the first one not done
+    manifest = CollectManifest(os.path.join(args.project_dir, args.data_dir, 'manifest', f'collect_il_data_{split}'), args.num_shards, args.shard_id)
     scene_dict = {}
     for cc in scenes:
-        list_collected = sorted(glob.glob(os.path.join(DATA_DIR, cc) + '*'))
-        scene_dict[cc] = len(list_collected)
+        episode_names = ['%s_%03d' % (cc, idx) for idx in range(ep_per_env[cc])]
+        # Episodes collected before the manifest was used
+        for episode_name in episode_names:
+            manifest.adopt(episode_name, [os.path.join(DATA_DIR, episode_name + '.dat.gz')])
+        manifest.plan(episode_names)
+        scene_dict[cc] = next((idx for idx, episode_name in enumerate(episode_names) if not manifest.is_done(episode_name)), ep_per_env[cc])
     print(scene_dict)
     for space_id, (space, start_idx) in enumerate(scene_dict.items()):
         if start_idx < ep_per_env[space]:
@@ -281,7 +280,7 @@ def main():
             config.defrost()
             config.TASK_CONFIG.DATASET.CONTENT_SCENES = [space]
             config.freeze()
-            data_collect(config, DATA_DIR, space_id, len(scenes), start_idx, ep_per_env[space])
+            data_collect(config, DATA_DIR, space_id, len(scenes), start_idx, ep_per_env[space], manifest)
 
 
 if __name__ == "__main__":
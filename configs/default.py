@@ -62,6 +62,7 @@ _C.scene_data = 'gibson'
 _C.OBS_TO_SAVE = ['panoramic_rgb', 'panoramic_depth', 'target_goal']
 _C.noisy_actuation = True
 _C.USE_AUXILIARY_INFO = True
+_C.INFERENCE_AMP = False  # run the policy of the runners under autocast: float16 on GPU, bfloat16 on CPU
 
 #----------------------------------------------------------------------------
 # Base architecture config
@@ -94,9 +95,31 @@ _C.memory = CN()
 _C.memory.num_objects = 10
 # _C.memory.num_target_objects = 10
 _C.memory.img_embedding_dim = 512 #512
-_C.memory.memory_size = 100
+_C.memory.memory_size = 100  # image graph budget
+_C.memory.initial_memory_size = 0  # start with this many image nodes and double up to memory_size. 0: allocate memory_size at once
+_C.memory.initial_obj_memory_size = 0  # same for the object graph, whose budget is MAX_EPISODE_STEPS * num_objects // 2
+_C.memory.eviction = 'lru'  # once the budget is hit, 'lru': evict the least recently visited node, 'visit': the least visited one
 _C.memory.pose_dim = 5
 _C.memory.need_local_memory = False
+_C.memory.merge_interval = 0  # merge near-duplicate image nodes every merge_interval steps. 0: never
+_C.memory.merge_th = 0.95  # embedding similarity above which two image nodes can be merged
+_C.memory.merge_neighbor_th = 0.5  # and the minimum jaccard similarity of their (closed) neighbourhoods
+_C.memory.merge_embedding = 'fresh'  # 'fresh': keep the most recent embedding, 'mean': visit-weighted mean
+_C.memory.embedding_dtype = 'float16'  # storage dtypes of the graph memory, kept in the observations and the rollouts
+_C.memory.adjacency_dtype = 'bool'  # adjacency matrices and node masks
+_C.memory.time_dtype = 'int32'  # node times
+_C.memory.score_dtype = 'float32'  # object scores and categories
+_C.memory.delta_transport = False  # env workers send only the changed memory rows, mirrored by EnvWrapper
+_C.memory.obj_position_radius = 0.0  # only match a detection with memory objects within this distance (m). 0: no position test
+_C.memory.obj_position_cell_size = 1.0  # cell size (m) of the spatial hash over the object positions
+_C.memory.scene_memory = False  # start episodes from the graph of the last episode in the same scene
+_C.memory.scene_memory_dir = ''  # if set, the scene graphs are also saved here and loaded across runs
+_C.memory.scene_memory_max_scenes = 10  # scene graphs kept in memory per env
+_C.memory.localization_index = 'flat'  # 'flat' or 'ivf'
+_C.memory.localization_topk = 5
+_C.memory.ivf_nlist = 16
+_C.memory.ivf_nprobe = 4
+_C.memory.ivf_min_train = 1024
 
 _C.saving = CN()
 _C.saving.name = 'test'
@@ -144,6 +167,7 @@ _C.RL.PPO.reset_critic=False
 _C.RL.PPO.backbone='resnet18'
 _C.RL.PPO.rnn_type='LSTM'
 _C.RL.PPO.num_recurrent_layers=2
+_C.RL.PPO.amp=False  # float16 autocast of the rollouts and updates, with loss scaling (GPU only)
 
 _C.IL = CN()
 _C.IL.lr = 0.0001
@@ -158,6 +182,21 @@ _C.IL.batch_size = 4
 _C.IL.max_epoch = 100
 _C.IL.lr_decay = 0.5
 _C.IL.num_workers = 4
+# Batches of windows of similar length (LengthBucketBatchSampler), trimmed to their longest window
+_C.IL.bucket_by_length = False
+_C.IL.bucket_pool_size = 50  # batches sorted by length together
+# Data loading, the DataLoaders (and their workers) live for the whole training
+_C.IL.persistent_workers = True
+_C.IL.prefetch_factor = 2  # batches loaded in advance by every worker
+_C.IL.pin_memory = True
+_C.IL.episode_cache_size = 0  # decoded episodes kept in the shared LRU cache (SharedEpisodeCache), 0: no cache
+_C.IL.episode_cache_dir = '/dev/shm/tsgm_il_cache'
+_C.IL.background_validation = False  # validate a snapshot of the model in a separate process, without pausing training
+_C.IL.num_val_batches = 100
+# Memory of the training on long sequences
+_C.IL.bptt_chunk_length = 0  # truncated BPTT: backward every bptt_chunk_length steps, the hidden state detached in between. 0: whole sequence
+_C.IL.amp = False  # float16 autocast of the policy, with loss scaling (GPU only)
+_C.IL.checkpoint_activations = False  # recompute the ResNet encoders, CrossGCN and the Perception decoders in backward instead of keeping their activations
 
 
 def get_config(
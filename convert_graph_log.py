@@ -0,0 +1,27 @@
+import argparse, glob, joblib, os, parmap
+from model.Graph.graph_log import GraphEventLog
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--src-dir", type=str, default="data/graph", help="graphs saved as per-timestep snapshots by collect_graph.py")
+parser.add_argument("--dst-dir", type=str, default="data/graph_log")
+parser.add_argument("--split", choices=['val', 'train', 'min_val'], default='train')
+parser.add_argument('--num-procs', default=16, type=int)
+args = parser.parse_args()
+
+
+def convert(file_list):
+    file_list = [file_list] if type(file_list) is not list else file_list
+    for file_name in file_list:
+        data = joblib.load(file_name)
+        if 'graph_log' not in data:
+            data = {'graph_log': GraphEventLog.from_snapshots(data['graph']).state_dict()}
+        joblib.dump(data, os.path.join(args.dst_dir, args.split, file_name.split('/')[-1]))
+
+
+if __name__ == '__main__':
+    os.makedirs(os.path.join(args.dst_dir, args.split), exist_ok=True)
+    file_list = sorted(glob.glob(os.path.join(args.src_dir, args.split, '*.dat.gz')))
+    file_list = [f for f in file_list if not os.path.exists(os.path.join(args.dst_dir, args.split, f.split('/')[-1]))]
+    print(f"Converting {len(file_list)} graph files in {os.path.join(args.src_dir, args.split)}")
+    if len(file_list) > 0:
+        parmap.map(convert, file_list, pm_processes=args.num_procs)
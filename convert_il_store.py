@@ -0,0 +1,46 @@
+import argparse, glob, joblib, os
+from dataset.il_store import ILStoreWriter, ILEpisodeStore
+from dataset.il_labels import validate_labels
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--src-dir", type=str, default="IL_data/gibson", help="episodes saved by collect_il_data.py")
+parser.add_argument("--dst-dir", type=str, default="IL_data/gibson_store")
+parser.add_argument("--split", choices=['val', 'train', 'min_val'], default='train')
+parser.add_argument("--dataset", choices=['gibson', 'mp3d'], default='gibson', help="mp3d objects are sorted by size")
+parser.add_argument("--labels", action='store_true', default=False, help="also store the labels computed by ILDataset (objects after NMS, progress, is_goal)")
+parser.add_argument("--max-num-object", type=int, default=10, help="objects stored per step with --labels, at least --num-object of train_il.py")
+parser.add_argument("--validate", action='store_true', default=False, help="check the labels of an existing store against the ones computed on the fly")
+args = parser.parse_args()
+
+
+def validate(file_list, store):
+    labels_config = store.labels_config
+    if labels_config is None:
+        raise ValueError("{} has no labels".format(store.root))
+    num_failed = 0
+    for file_name in file_list:
+        name = file_name.split('/')[-1]
+        if name not in store:
+            print(f"{name}: missing")
+            num_failed += 1
+            continue
+        mismatches = validate_labels(joblib.load(file_name), store.labels(name), **labels_config)
+        if len(mismatches) > 0:
+            print(f"{name}: {', '.join(mismatches)} differ")
+            num_failed += 1
+    print(f"{len(file_list) - num_failed}/{len(file_list)} episodes match")
+
+
+if __name__ == '__main__':
+    file_list = sorted(glob.glob(os.path.join(args.src_dir, args.split, '*.dat.gz')))
+    if args.validate:
+        validate(file_list, ILEpisodeStore(os.path.join(args.dst_dir, args.split)))
+    else:
+        print(f"Converting {len(file_list)} episodes in {os.path.join(args.src_dir, args.split)}")
+        labels = {'max_num_object': args.max_num_object, 'sort_by_size': args.dataset == 'mp3d'} if args.labels else None
+        writer = ILStoreWriter(os.path.join(args.dst_dir, args.split), labels=labels)
+        for i, file_name in enumerate(file_list):
+            writer.add(file_name.split('/')[-1], joblib.load(file_name))
+            if (i + 1) % 100 == 0:
+                print(f"{i + 1}/{len(file_list)}")
+        writer.close()
@@ -1,12 +1,13 @@
 import torch.utils.data as data
 import numpy as np
 import joblib
+import json
+import os
 import torch
 import quaternion as q
-import torchvision.transforms as transforms
-from PIL import Image
-from torchvision.ops import nms as torch_nms
+from dataset.il_labels import STEP_LABELS, GOAL_LABELS, object_labels, goal_object_labels, progress_labels
 from utils.debug_utils import log_time
+from model.Graph.graph_log import load_graph_record
 from os import path as osp
 
 
@@ -16,21 +17,91 @@ from habitat_sim.sensors.noise_models.redwood_depth_noise_model import (
 )
 TIME_DEBUG = False
 
+
+def sample_start_idx(episode_length):
+    """ First step of the window of an episode sampled by ILDataset """
+    return np.random.randint(episode_length - 10) if episode_length > 10 else 0
+
+
+def window_length(episode_length, start_idx, max_input_length):
+    """ Number of steps of the window starting at start_idx (the last step of an episode is never used) """
+    return min(start_idx + max_input_length, episode_length - 1) - start_idx
+
+
+def is_graph_key(key):
+    return key.startswith('img_memory_') or key.startswith('obj_memory_')
+
+
+def pad_graphs(graphs, num_steps=None):
+    """
+    Stack the arrays of graphs (memory dicts) along a new first axis, zero-padded to their largest node counts.
+    num_steps: the graphs are step sequences (ILDataset.pull_graph), padded to num_steps steps by repeating their
+    last step, so that every row keeps a valid graph
+    """
+    out = {}
+    for key, val in graphs[0].items():
+        val = np.asarray(val)
+        shape = np.max([np.asarray(graph[key]).shape for graph in graphs], 0) if val.ndim > 0 else ()
+        if num_steps is not None:
+            shape = (num_steps, *shape[1:])
+        out[key] = np.zeros([len(graphs), *shape], dtype=val.dtype)
+        for i, graph in enumerate(graphs):
+            graph_val = np.asarray(graph[key])
+            if num_steps is None:
+                out[key][(i,) + tuple(slice(0, n) for n in graph_val.shape)] = graph_val
+                continue
+            graph_val = graph_val[:num_steps]
+            node_slices = tuple(slice(0, n) for n in graph_val.shape[1:])
+            out[key][(i, slice(0, len(graph_val))) + node_slices] = graph_val
+            out[key][(i, slice(len(graph_val), None)) + node_slices] = graph_val[-1]
+    return out
+
+
+class ILCollate(object):
+    """
+    Collate of ILDataset samples:
+    the step dimension of the batch is trimmed to its longest sequence T, so that no encoder or recurrent step is
+    spent on padding only, and the graph memory of the real steps (img_memory_*, obj_memory_*, see
+    ILDataset.pull_graph) is padded to T steps and to the largest graph of the batch, as (B, T, M, ...) tensors.
+    """
+    # Not per-step: the goal images and the start position
+    NON_STEP_KEYS = ['target_goal_rgb', 'target_goal_depth', 'start_position']
+
+    def __init__(self, max_input_length):
+        self.max_input_length = max_input_length
+
+    def __call__(self, samples):
+        graph_keys = [key for key in samples[0][0] if is_graph_key(key)]
+        graphs = [{key: sample[0].pop(key) for key in graph_keys} for sample in samples]
+        train_info, aux_info, vis_info = data.dataloader.default_collate(samples)
+        T = max(int((train_info['action'] > -10).sum(1).max()), 1)
+        for info in [train_info, aux_info, vis_info]:
+            for key, value in info.items():
+                if key not in self.NON_STEP_KEYS and torch.is_tensor(value) and value.dim() > 1 and value.shape[1] == self.max_input_length:
+                    info[key] = value[:, :T].contiguous()
+        if len(graph_keys) > 0:
+            train_info.update({key: torch.from_numpy(val) for key, val in pad_graphs(graphs, num_steps=T).items()})
+        return [train_info, aux_info, vis_info]
+
+
 class ILDataset(data.Dataset):
-    def __init__(self, cfg, data_list, transform):
+    def __init__(self, cfg, data_list, store=None, graph_dir=None, episode_cache=None):
+        """
+        store: ILEpisodeStore (see il_store.py) to read the episodes from, instead of their .dat.gz files
+        graph_dir: directory of the graphs built by collect_graph.py. The graph memory of every step of the window is
+        then loaded here, in the DataLoader workers, and collated by ILCollate.
+        episode_cache: SharedEpisodeCache (see il_store.py) of the decoded .dat.gz episodes, shared by the workers
+        The frames are returned as uint8. Their augmentation and normalization run on the whole batch, on the training
+        device (see ImgGoalTrainer and utils/tensor_augmentations.py).
+        """
         self.data_list = data_list
+        self.store = store
+        self.graph_dir = graph_dir
+        self.episode_cache = episode_cache
         self.img_size = cfg.IMG_SHAPE
         self.action_dim = 4
         self.max_input_length = cfg.max_input_length
         self.config = cfg
-        normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406],
-                                         std=[0.229, 0.224, 0.225])
-        eval_augmentation = [
-            transforms.ToTensor(),
-            normalize
-            ]
-        self.transform_eval = transforms.Compose(eval_augmentation)
-        self.transform = transform
         self.redwood_depth_noise = RedwoodNoiseModelCPUImpl(
             np.load(
                 osp.join(
@@ -44,20 +115,79 @@ class ILDataset(data.Dataset):
 
     def __getitem__(self, index):
         if TIME_DEBUG: s = log_time()
-        res = self.pull_image(index)
+        # (index, start_idx) from LengthBucketBatchSampler, which draws the window itself
+        start_idx = None
+        if isinstance(index, (tuple, list)):
+            index, start_idx = index
+        res = self.pull_image(index, start_idx)
         if TIME_DEBUG : s, get_step_t = log_time(s, 'get data', return_time=True)
         return res
 
     def __len__(self):
         return len(self.data_list)
 
+    def load_labels(self, episode_name, max_num_object, sort_by_size):
+        """ The labels of the episode precomputed in the store, if they fit max_num_object and sort_by_size """
+        if self.store is None or episode_name not in self.store:
+            return None
+        labels_config = self.store.labels_config
+        if labels_config is None or labels_config['max_num_object'] < max_num_object or labels_config['sort_by_size'] != sort_by_size:
+            return None
+        return self.store.labels(episode_name)
+
+    def episode_lengths(self):
+        """
+        Number of steps of every episode, for LengthBucketBatchSampler. Read from the store index, or loaded once and
+        cached in episode_lengths.json next to the episodes. The cache entries are keyed on the file name, size and
+        mtime, so that a re-collected episode is loaded again.
+        """
+        names = [data_path.split('/')[-1] for data_path in self.data_list]
+        if self.store is not None and all(name in self.store for name in names):
+            return [self.store.episode_length(name) for name in names]
+        cache_file = osp.join(osp.dirname(self.data_list[0]), 'episode_lengths.json') if len(self.data_list) > 0 else None
+        cached = {}
+        if cache_file is not None and osp.exists(cache_file):
+            with open(cache_file) as f:
+                cached = json.load(f)
+        keys = []
+        for name, data_path in zip(names, self.data_list):
+            stat = os.stat(data_path)
+            keys.append('{}:{}:{}'.format(name, stat.st_size, stat.st_mtime_ns))
+        missing = [(key, data_path) for key, data_path in zip(keys, self.data_list) if key not in cached]
+        if len(missing) > 0:
+            for key, data_path in missing:
+                cached[key] = len(joblib.load(data_path)['position'])
+            tmp_file = '{}.tmp{}'.format(cache_file, os.getpid())
+            with open(tmp_file, 'w') as f:
+                json.dump(cached, f)
+            os.replace(tmp_file, cache_file)
+        return [cached[key] for key in keys]
+
+    def pull_graph(self, episode_name, start_idx, input_length):
+        """
+        Graph memory of the steps start_idx:start_idx + input_length of an episode, as (input_length, M, ...)
+        arrays padded to its largest graph, and step, the episode step of every window step.
+        The padding steps are added by ILCollate, up to the longest window of the batch.
+        """
+        graph = load_graph_record(osp.join(self.graph_dir, episode_name))
+        graph_steps = [graph[min(start_idx + t, len(graph) - 1)] for t in range(max(input_length, 1))]
+        graph_info = pad_graphs(graph_steps)
+        graph_info['step'] = np.arange(start_idx, start_idx + self.max_input_length, dtype=np.float32)
+        return graph_info
+
     def get_dist(self, input_position):
         return np.linalg.norm(input_position[-1] - input_position[0], ord=2)
 
-    def pull_image(self, index):
+    def pull_image(self, index, start_idx=None):
         if TIME_DEBUG: s = log_time()
         try:
-            input_data = joblib.load(self.data_list[index])
+            episode_name = self.data_list[index].split('/')[-1]
+            if self.store is not None and episode_name in self.store:
+                input_data = self.store.episode(episode_name)
+            elif self.episode_cache is not None:
+                input_data = self.episode_cache.get(episode_name, lambda: joblib.load(self.data_list[index]))
+            else:
+                input_data = joblib.load(self.data_list[index])
         except:
             print(self.data_list[index])
             print("Data loading error")
@@ -67,30 +197,16 @@ class ILDataset(data.Dataset):
         aux_info = {'is_goal': None, 'distance': None, 'progress': None}
 
         orig_data_len = len(input_data['position'])
-        start_idx = np.random.randint(orig_data_len - 10) if orig_data_len > 10 else 0
-        end_idx = - 1
+        if start_idx is None:
+            start_idx = sample_start_idx(orig_data_len)
+        # Only the frames that fit in max_input_length (the last frame is never used)
+        end_idx = min(start_idx + self.max_input_length, orig_data_len - 1)
 
-        input_rgb = np.array(input_data['rgb'][start_idx:end_idx], dtype=np.float32)
+        input_rgb = np.uint8(input_data['rgb'][start_idx:end_idx])
         input_length = np.minimum(len(input_rgb), self.max_input_length)
-        input_rgb_out = np.zeros([self.max_input_length, *input_rgb.shape[1:]])
+        input_rgb_out = np.zeros([self.max_input_length, *input_rgb.shape[1:]], dtype=np.uint8)
         input_rgb_out[:input_length] = input_rgb[:input_length]
 
-        input_rgb_transformed = []
-        for i in range(len(input_rgb)):
-            im = Image.fromarray(np.uint8(input_rgb[i]))
-            input_rgb_transformed.append(self.transform(im))
-        input_rgb_transformed = torch.stack([input_rgb_transformed[i] for i in range(len(input_rgb))], 0)
-        input_rgb_transformed_out = np.zeros([self.max_input_length, *input_rgb_transformed.shape[1:]])
-        input_rgb_transformed_out[:input_length] = input_rgb_transformed[:input_length]
-
-        input_rgb_eval_transformed = []
-        for i in range(len(input_rgb)):
-            im = Image.fromarray(np.uint8(input_rgb[i]))
-            input_rgb_eval_transformed.append(self.transform_eval(im))
-        input_rgb_eval_transformed = torch.stack([input_rgb_eval_transformed[i] for i in range(len(input_rgb))], 0)
-        input_rgb_eval_transformed_out = np.zeros([self.max_input_length, *input_rgb_eval_transformed.shape[1:]])
-        input_rgb_eval_transformed_out[:input_length] = input_rgb_eval_transformed[:input_length]
-
         input_dep = np.array(input_data['depth'][start_idx:end_idx], dtype=np.float32)
         input_dep_out = np.zeros([self.max_input_length, *input_dep.shape[1:]])
         input_dep_out[:input_length] = input_dep[:input_length]
@@ -100,177 +216,53 @@ class ILDataset(data.Dataset):
         input_act_out[:input_length] = input_act -1 if self.action_dim == 3 else input_act
 
         max_num_object = self.config.memory.num_objects
-        input_object = input_data['object'][start_idx:start_idx + input_length]
-        if 'object_id' in input_data:
-            input_object_id = input_data['object_id'][start_idx:start_idx + input_length]
-        input_object_category = input_data['object_category'][start_idx:start_idx + input_length]
-        if 'object_pose' in input_data:
-            input_object_pose = input_data['object_pose'][start_idx:start_idx + input_length]
-        if 'object_score' in input_data:
-            input_object_score = input_data['object_score'][start_idx:start_idx + input_length]
-        else:
-            input_object_score = np.ones([len(input_object_pose), 300])
-
-        input_object_out = np.zeros((self.max_input_length, max_num_object, 5))
-        input_object_score_out = np.zeros((self.max_input_length, max_num_object))
-        input_object_category_out = np.ones((self.max_input_length, max_num_object)) * (-1)
-        input_object_mask_out = np.zeros((self.max_input_length, max_num_object))
-        input_object_pose_out = -100. * np.ones((self.max_input_length, max_num_object, 3))
-        input_object_id_out = np.ones((self.max_input_length, max_num_object)) * (-1)
-        input_object_relpose_out = -100. * np.ones((self.max_input_length, max_num_object, 2))
-        for i in range(len(input_object)):
-            if len(input_object[i]) > 0:
-                input_object_t = np.array(input_object[i]).reshape(-1, 4)
-                input_object_score_t = np.array(input_object_score[i]).reshape(-1)
-                input_object_score_t = input_object_score_t[:len(input_object_t)]
-                keep = torch_nms(torch.from_numpy(input_object_t).float(), torch.from_numpy(input_object_score_t).float(), 0.5)
-                input_object_t = np.array(input_object_t[keep]).reshape(-1, 4)
-                input_object_score_t = np.array(input_object_score_t[keep]).reshape(-1)
-                input_object_category_t = np.array(input_object_category[i]).reshape(-1)[keep].reshape(-1)
-                if 'object_id' in input_data:
-                    input_object_id_t = np.array(input_object_id[i]).reshape(-1)[keep].reshape(-1)
-                if 'object_pose' in input_data:
-                    input_object_pose_t = np.array(input_object_pose[i]).reshape(-1, 3)
-                    input_object_pose_t = np.array(input_object_pose_t[keep]).reshape(-1, 3)
-                num_object_t = len(input_object_t)
-
-                if self.config.scene_data == "mp3d":
-                    size = (input_object_t[:, 2]-input_object_t[:, 0])*(input_object_t[:, 3]-input_object_t[:, 1])
-                    idx = np.argsort(-size)
-                    input_object_out[i, :min(max_num_object, num_object_t), 1:] = input_object_t[idx][:min(max_num_object, num_object_t), :4]
-                    input_object_score_out[i, :min(max_num_object, num_object_t)] = input_object_score_t[idx][:min(max_num_object, num_object_t)]
-                    input_object_category_out[i, :min(max_num_object, num_object_t)] = input_object_category_t[idx][:min(max_num_object, num_object_t)]
-
-                    if 'object_id' in input_data:
-                        input_object_id_out[i, :min(max_num_object, num_object_t)] = input_object_id_t[:min(max_num_object, num_object_t)]
-                    if 'object_pose' in input_data:
-                        input_object_pose_out[i, :min(max_num_object, num_object_t)] = input_object_pose_t[idx][:min(max_num_object, num_object_t)]
-                    input_object_mask_out[i, :min(max_num_object, num_object_t)] = 1
-                else:
-                    input_object_out[i, :min(max_num_object, num_object_t), 1:] = input_object_t[:min(max_num_object, num_object_t), :4]
-                    input_object_score_out[i, :min(max_num_object, num_object_t)] = input_object_score_t[:min(max_num_object, num_object_t)]
-                    input_object_category_out[i, :min(max_num_object, num_object_t)] = input_object_category_t[:min(max_num_object, num_object_t)]
-                    if 'object_id' in input_data:
-                        input_object_id_out[i, :min(max_num_object, num_object_t)] = input_object_id_t[:min(max_num_object, num_object_t)]
-                    if 'object_pose' in input_data:
-                        input_object_pose_out[i, :min(max_num_object, num_object_t)] = input_object_pose_t[:min(max_num_object, num_object_t)]
-                    input_object_mask_out[i, :min(max_num_object, num_object_t)] = 1
-
-        targets = np.zeros([self.max_input_length])
-        targets[:input_length] = target_indices[start_idx:start_idx+input_length]
+        sort_by_size = self.config.scene_data == "mp3d"
         target_img = np.stack(input_data['target_img'])[:,:,:,:4]
         B, H, W, C = target_img.shape
+        labels = self.load_labels(episode_name, max_num_object, sort_by_size)
+        if labels is not None:
+            # Precomputed by convert_il_store.py --labels, only sliced
+            step_labels = {k: np.array(labels[k][start_idx:start_idx + input_length]) for k in STEP_LABELS}
+            goal_labels = {k: np.asarray(labels[k]) for k in GOAL_LABELS if k in labels}
+        else:
+            step_labels = object_labels(input_data, start_idx, start_idx + input_length, max_num_object, sort_by_size)
+            step_labels.update({k: v[start_idx:start_idx + input_length] for k, v in progress_labels(input_data).items()})
+            step_labels['target_idx'] = target_indices[start_idx:start_idx + input_length]
+            goal_labels = goal_object_labels(input_data, 'target_object', (H, W), max_num_object, sort_by_size)
+            goal_labels.update(goal_object_labels(input_data, 'target_loc_object', (H, W), max_num_object, sort_by_size))
+
+        def pad_steps(value, fill=0.):
+            out = np.full([self.max_input_length, *value.shape[1:]], fill, dtype=np.float64)
+            out[:input_length] = value
+            return out
+        input_object_out = pad_steps(step_labels['object'][:, :max_num_object])
+        input_object_score_out = pad_steps(step_labels['object_score'][:, :max_num_object])
+        input_object_category_out = pad_steps(step_labels['object_category'][:, :max_num_object], -1)
+        input_object_mask_out = pad_steps(step_labels['object_mask'][:, :max_num_object])
+        input_object_pose_out = pad_steps(step_labels['object_pose'][:, :max_num_object], -100.)
+        input_object_id_out = pad_steps(step_labels['object_id'][:, :max_num_object], -1)
+        input_object_relpose_out = -100. * np.ones((self.max_input_length, max_num_object, 2))
+
+        target_indices = step_labels['target_idx']
+        targets = pad_steps(target_indices)
 
-        target_img_orig_out = np.zeros([5, *target_img[0].shape[:2], 3])
-        target_img_orig_out[:len(target_img)] = np.stack(target_img,0)[...,:3] * 255.
+        target_img_orig_out = np.zeros([5, *target_img[0].shape[:2], 3], dtype=np.uint8)
+        target_img_orig_out[:len(target_img)] = np.uint8(target_img[...,:3] * 255.)
+        target_depth_out = np.zeros([5, *target_img[0].shape[:2]], dtype=np.float32)
+        target_depth_out[:len(target_img)] = target_img[..., 3]
 
         target_pose = np.stack(input_data['target_pose']) #targets[:, t].long()
-        target_pose = target_pose[target_indices[start_idx:start_idx+input_length].astype(np.int32)]
+        target_pose = target_pose[target_indices.astype(np.int32)]
         target_pose_out = np.zeros([self.max_input_length, 3])
         target_pose_out[:input_length] = target_pose
 
         relpose = np.zeros([self.max_input_length,3])
-        target_img_out = np.zeros([5, *target_img[0].shape])
-        target_img_out[:len(target_img)] = target_img
-
-        target_img_transformed = []
-        for i in range(len(target_img)):
-            im = Image.fromarray(np.uint8(target_img[i][:,:,:3]* 255.))
-            target_img_transformed.append(torch.cat([self.transform(im), torch.from_numpy(target_img[i][:,:,-1][None])], 0))
-        target_img_transformed = torch.stack(target_img_transformed, 0)
-        target_img_transformed_out = np.zeros([5, *target_img_transformed[0].shape])
-        target_img_transformed_out[:len(target_img_transformed)] = target_img_transformed
-
-        target_loc_object_out = np.zeros((5, max_num_object, 5))
-        target_loc_object_category_out = np.zeros((5, max_num_object))
-        target_loc_object_mask_out = np.zeros((5, max_num_object))
-        target_loc_object_pose_out = np.zeros((5, max_num_object, 3))
-        target_loc_object_id_out = np.zeros((5, max_num_object))
-        target_loc_object_score_out = np.zeros((5, max_num_object))
-
-        if 'target_loc_object' in input_data:
-            target_loc_object = input_data['target_loc_object']
-            target_loc_object_score = input_data['target_loc_object_score']
-            target_loc_object_category = input_data['target_loc_object_category']
-            if 'target_loc_object_id' in input_data:
-                target_loc_object_id = input_data['target_loc_object_id']
-            if 'target_loc_object_pose' in input_data:
-                target_loc_object_pose = input_data['target_loc_object_pose']
-            for i in range(len(target_loc_object)):
-                if len(target_loc_object[i]) > 0:
-                    target_loc_object_t = np.array(target_loc_object[i]).reshape(-1, 4)
-                    target_loc_object_t[:, 0] = np.maximum(0, target_loc_object_t[:, 0]-5)
-                    target_loc_object_t[:, 1] = np.maximum(0, target_loc_object_t[:, 1]-5)
-                    target_loc_object_t[:, 2] = np.minimum(W, target_loc_object_t[:, 2]+5)
-                    target_loc_object_t[:, 3] = np.minimum(H, target_loc_object_t[:, 3]+5)
-                    target_loc_object_category_t = np.array(target_loc_object_category[i]).reshape(-1)
-                    target_loc_object_score_t = np.array(target_loc_object_score[i]).reshape(-1)
-                    if 'target_loc_object_id' in input_data:
-                        target_loc_object_id_t = np.array(target_loc_object_id[i]).reshape(-1)
-                    if 'target_loc_object_pose' in input_data:
-                        target_loc_object_pose_t = np.array(target_loc_object_pose[i]).reshape(-1, 3)
-                    num_object_t = len(target_loc_object_t)
-                    if self.config.scene_data == "mp3d":
-                        size = (target_loc_object_t[:, 2]-target_loc_object_t[:, 0])*(target_loc_object_t[:, 3]-target_loc_object_t[:, 1])
-                        idx = np.argsort(-size)
-                        target_loc_object_out[i, :min(max_num_object, num_object_t), 1:] = target_loc_object_t[idx][:min(max_num_object, num_object_t), :4]
-                        target_loc_object_score_out[i, :min(max_num_object, num_object_t), 1:] = target_loc_object_score_t[idx][:min(max_num_object, num_object_t), :4]
-                        target_loc_object_category_out[i, :min(max_num_object, num_object_t)] = target_loc_object_category_t[idx][:min(max_num_object, num_object_t)]
-                        target_loc_object_mask_out[i, :min(max_num_object, num_object_t)] = 1
-                        if 'target_loc_object_pose' in input_data:
-                            target_loc_object_pose_out[i, :min(max_num_object, num_object_t)] = target_loc_object_pose_t[:min(max_num_object, num_object_t)]
-                    else:
-                        target_loc_object_out[i, :min(max_num_object, num_object_t), 1:] = target_loc_object_t[:min(max_num_object, num_object_t), :4]
-                        target_loc_object_score_out[i, :min(max_num_object, num_object_t), 1:] = target_loc_object_score_t[idx][:min(max_num_object, num_object_t), :4]
-                        target_loc_object_category_out[i, :min(max_num_object, num_object_t)] = target_loc_object_category_t[:min(max_num_object, num_object_t)]
-                        target_loc_object_mask_out[i, :min(max_num_object, num_object_t)] = 1
-                        if 'target_loc_object_id' in input_data:
-                            target_loc_object_id_out[i, :min(max_num_object, num_object_t)] = target_loc_object_id_t[:min(max_num_object, num_object_t)]
-                        if 'target_loc_object_pose' in input_data:
-                            target_loc_object_pose_out[i, :min(max_num_object, num_object_t)] = target_loc_object_pose_t[:min(max_num_object, num_object_t)]
-
-        target_object_out = np.zeros((5, max_num_object, 5))
-        target_object_category_out = np.zeros((5, max_num_object))
-        target_object_mask_out = np.zeros((5, max_num_object))
-        target_object_pose_out = np.zeros((5, max_num_object, 3))
-        target_object_id_out = np.zeros((5, max_num_object))
-
-        if 'target_object' in input_data:
-            target_object = input_data['target_object']
-            target_object_category = input_data['target_object_category']
-            if 'target_object_id' in input_data:
-                target_object_id = input_data['target_object_id']
-            if 'target_object_pose' in input_data:
-                target_object_pose = input_data['target_object_pose']
-            for i in range(len(target_object)):
-                if len(target_object[i]) > 0:
-                    target_object_t = np.array(target_object[i]).reshape(-1, 4)
-                    target_object_t[:, 0] = np.maximum(0, target_object_t[:, 0]-5)
-                    target_object_t[:, 1] = np.maximum(0, target_object_t[:, 1]-5)
-                    target_object_t[:, 2] = np.minimum(W, target_object_t[:, 2]+5)
-                    target_object_t[:, 3] = np.minimum(H, target_object_t[:, 3]+5)
-                    target_object_category_t = np.array(target_object_category[i]).reshape(-1)
-                    if 'target_object_id' in input_data:
-                        target_object_id_t = np.array(target_object_id[i]).reshape(-1)
-                    if 'target_object_pose' in input_data:
-                        target_object_pose_t = np.array(target_object_pose[i]).reshape(-1, 3)
-                    num_object_t = len(target_object_t)
-                    if self.config.scene_data == "mp3d":
-                        size = (target_object_t[:, 2]-target_object_t[:, 0])*(target_object_t[:, 3]-target_object_t[:, 1])
-                        idx = np.argsort(-size)
-                        target_object_out[i, :min(max_num_object, num_object_t), 1:] = target_object_t[idx][:min(max_num_object, num_object_t), :4]
-                        target_object_category_out[i, :min(max_num_object, num_object_t)] = target_object_category_t[idx][:min(max_num_object, num_object_t)]
-                        target_object_mask_out[i, :min(max_num_object, num_object_t)] = 1
-                        if 'target_object_pose' in input_data:
-                            target_object_pose_out[i, :min(max_num_object, num_object_t)] = target_object_pose_t[:min(max_num_object, num_object_t)]
-                    else:
-                        target_object_out[i, :min(max_num_object, num_object_t), 1:] = target_object_t[:min(max_num_object, num_object_t), :4]
-                        target_object_category_out[i, :min(max_num_object, num_object_t)] = target_object_category_t[:min(max_num_object, num_object_t)]
-                        target_object_mask_out[i, :min(max_num_object, num_object_t)] = 1
-                        if 'target_object_id' in input_data:
-                            target_object_id_out[i, :min(max_num_object, num_object_t)] = target_object_id_t[:min(max_num_object, num_object_t)]
-                        if 'target_object_pose' in input_data:
-                            target_object_pose_out[i, :min(max_num_object, num_object_t)] = target_object_pose_t[:min(max_num_object, num_object_t)]
+
+        target_object_out, target_object_category_out, target_object_mask_out, target_object_pose_out, target_object_id_out, \
+            target_loc_object_out, target_loc_object_category_out, target_loc_object_mask_out, target_loc_object_pose_out, target_loc_object_id_out = \
+            [goal_labels[k][:, :max_num_object] for k in GOAL_LABELS if k != 'target_loc_object_score']
+        target_loc_object_score_out = goal_labels['target_loc_object_score'][:, :max_num_object] \
+            if 'target_loc_object_score' in goal_labels else np.zeros((5, max_num_object))
 
         positions = np.zeros([self.max_input_length,3])
         positions[:input_length] = input_data['position'][start_idx:start_idx+input_length]
@@ -285,21 +277,11 @@ class ILDataset(data.Dataset):
         aux_info['distance'] = np.zeros([self.max_input_length])
         distances = np.stack(input_data['distance'][start_idx:start_idx+input_length])
         aux_info['distance'][:input_length] = torch.from_numpy(distances).float()
-        episode_length = np.stack([input_data['distance'][0]] + [np.stack(input_data['distance'])[i+1] for i in np.where(np.stack(input_data['action'])==0)[0][:-1]])
-        episode_idx = np.stack([i+1 for i in np.where(np.stack(input_data['action'])==0)[0]])[:-1]
-        max_length = []
-        epi_idx = 0
-        for i in range(len(input_data['distance'])):
-            if i in episode_idx:
-                epi_idx += 1
-            max_length.append(episode_length[epi_idx])
-        progress = np.clip(1 - np.array(np.stack(input_data['distance'])/np.stack(max_length))[start_idx:start_idx+input_length],0,1)
-        is_goal = np.stack(input_data['distance'])[start_idx:start_idx+input_length] < 1
+        progress = step_labels['progress']
+        is_goal = step_labels['is_goal']
 
         train_info = {}
-        train_info["panoramic_rgb"] = torch.from_numpy(input_rgb_out).float()
-        train_info["panoramic_rgb_trans"] = torch.from_numpy(input_rgb_transformed_out).float()
-        train_info["panoramic_rgb_eval"] = torch.from_numpy(input_rgb_eval_transformed_out).float()
+        train_info["panoramic_rgb"] = torch.from_numpy(input_rgb_out)
         train_info["panoramic_depth"] = torch.from_numpy(input_dep_out).float()
         train_info["relpose"] = torch.from_numpy(relpose).float()
         train_info["action"] = torch.from_numpy(input_act_out).float()
@@ -313,9 +295,9 @@ class ILDataset(data.Dataset):
         train_info["position"] = torch.from_numpy(positions).float()
         train_info["rotation"] = torch.from_numpy(rotations).float()
         train_info["target"] = targets
-        # train_info["target_goal_orig"] = torch.from_numpy(target_img_orig_out[targets.astype(np.int32)]).float()
-        train_info["target_goal"] = torch.from_numpy(target_img_out[targets.astype(np.long)]).float()
-        train_info["target_goal_trans"] = torch.from_numpy(target_img_transformed_out[targets.astype(np.int32)]).float()
+        # The five goal images, target_goal of every step is gathered from them on the device
+        train_info["target_goal_rgb"] = torch.from_numpy(target_img_orig_out)
+        train_info["target_goal_depth"] = torch.from_numpy(target_depth_out)
 
         train_info["target_object"] = torch.from_numpy(target_object_out[targets.astype(np.int32)]).float()
         train_info["target_object_category"] = torch.from_numpy(target_object_category_out[targets.astype(np.int32)]).float()
@@ -355,4 +337,8 @@ class ILDataset(data.Dataset):
         vis_info["object"] = torch.from_numpy(input_object_out).float()
         if TIME_DEBUG : s, get_step_t = log_time(s, 'process data', return_time=True)
         train_info['data_path'] = self.data_list[index]
+        if self.graph_dir is not None:
+            graph_info = self.pull_graph(episode_name, start_idx, input_length)
+            train_info['step'] = torch.from_numpy(graph_info.pop('step'))
+            train_info.update(graph_info)
         return [train_info, aux_info, vis_info]
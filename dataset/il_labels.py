@@ -0,0 +1,154 @@
+import numpy as np
+import torch
+from torchvision.ops import nms as torch_nms
+
+# Labels of an episode computed by ILDataset, per step (STEP_LABELS) or per goal image (GOAL_LABELS)
+STEP_LABELS = ['object', 'object_score', 'object_category', 'object_mask', 'object_pose', 'object_id', 'object_count',
+               'progress', 'is_goal', 'target_idx']
+GOAL_LABELS = ['target_object', 'target_object_category', 'target_object_mask', 'target_object_pose', 'target_object_id',
+               'target_loc_object', 'target_loc_object_category', 'target_loc_object_score', 'target_loc_object_mask',
+               'target_loc_object_pose', 'target_loc_object_id']
+NUM_GOALS = 5
+
+
+def object_labels(input_data, start_idx, end_idx, max_num_object, sort_by_size=False):
+    """
+    NMS-filtered detections of the steps start_idx:end_idx, padded to max_num_object per step.
+    With sort_by_size (mp3d), the largest boxes are kept first.
+    Returns (end_idx - start_idx, max_num_object, ...) float32 arrays, and object_count, the number of kept detections.
+    """
+    input_object = input_data['object'][start_idx:end_idx]
+    num_steps = len(input_object)
+    input_object_category = input_data['object_category'][start_idx:end_idx]
+    if 'object_id' in input_data:
+        input_object_id = input_data['object_id'][start_idx:end_idx]
+    if 'object_pose' in input_data:
+        input_object_pose = input_data['object_pose'][start_idx:end_idx]
+    if 'object_score' in input_data:
+        input_object_score = input_data['object_score'][start_idx:end_idx]
+    else:
+        input_object_score = np.ones([num_steps, 300])
+
+    out = {
+        'object': np.zeros((num_steps, max_num_object, 5), dtype=np.float32),
+        'object_score': np.zeros((num_steps, max_num_object), dtype=np.float32),
+        'object_category': np.ones((num_steps, max_num_object), dtype=np.float32) * (-1),
+        'object_mask': np.zeros((num_steps, max_num_object), dtype=np.float32),
+        'object_pose': -100. * np.ones((num_steps, max_num_object, 3), dtype=np.float32),
+        'object_id': np.ones((num_steps, max_num_object), dtype=np.float32) * (-1),
+        'object_count': np.zeros(num_steps, dtype=np.int64),
+    }
+    for i in range(num_steps):
+        if len(input_object[i]) == 0:
+            continue
+        input_object_t = np.array(input_object[i]).reshape(-1, 4)
+        input_object_score_t = np.array(input_object_score[i]).reshape(-1)[:len(input_object_t)]
+        keep = torch_nms(torch.from_numpy(input_object_t).float(), torch.from_numpy(input_object_score_t).float(), 0.5).numpy()
+        input_object_t = input_object_t[keep].reshape(-1, 4)
+        input_object_score_t = input_object_score_t[keep].reshape(-1)
+        input_object_category_t = np.array(input_object_category[i]).reshape(-1)[keep].reshape(-1)
+        num_object_t = min(max_num_object, len(input_object_t))
+        idx = np.argsort(-(input_object_t[:, 2] - input_object_t[:, 0]) * (input_object_t[:, 3] - input_object_t[:, 1])) \
+            if sort_by_size else np.arange(len(input_object_t))
+        out['object'][i, :num_object_t, 1:] = input_object_t[idx][:num_object_t, :4]
+        out['object_score'][i, :num_object_t] = input_object_score_t[idx][:num_object_t]
+        out['object_category'][i, :num_object_t] = input_object_category_t[idx][:num_object_t]
+        if 'object_id' in input_data:
+            # The ids are not reordered by size
+            out['object_id'][i, :num_object_t] = np.array(input_object_id[i]).reshape(-1)[keep].reshape(-1)[:num_object_t]
+        if 'object_pose' in input_data:
+            input_object_pose_t = np.array(input_object_pose[i]).reshape(-1, 3)[keep].reshape(-1, 3)
+            out['object_pose'][i, :num_object_t] = input_object_pose_t[idx][:num_object_t]
+        out['object_mask'][i, :num_object_t] = 1
+        out['object_count'][i] = num_object_t
+    return out
+
+
+def goal_object_labels(input_data, prefix, img_size, max_num_object, sort_by_size=False):
+    """
+    Detections of the goal images (input_data[prefix], prefix is target_object or target_loc_object), with the boxes
+    enlarged by 5 pixels, padded to (NUM_GOALS, max_num_object, ...) float32 arrays.
+    """
+    H, W = img_size
+    out = {
+        prefix: np.zeros((NUM_GOALS, max_num_object, 5), dtype=np.float32),
+        prefix + '_category': np.zeros((NUM_GOALS, max_num_object), dtype=np.float32),
+        prefix + '_mask': np.zeros((NUM_GOALS, max_num_object), dtype=np.float32),
+        prefix + '_pose': np.zeros((NUM_GOALS, max_num_object, 3), dtype=np.float32),
+        prefix + '_id': np.zeros((NUM_GOALS, max_num_object), dtype=np.float32),
+    }
+    has_score = prefix + '_score' in input_data
+    if has_score:
+        out[prefix + '_score'] = np.zeros((NUM_GOALS, max_num_object), dtype=np.float32)
+    if prefix not in input_data:
+        return out
+    goal_object = input_data[prefix]
+    for i in range(len(goal_object)):
+        if len(goal_object[i]) == 0:
+            continue
+        goal_object_t = np.array(goal_object[i]).reshape(-1, 4)
+        goal_object_t[:, 0] = np.maximum(0, goal_object_t[:, 0] - 5)
+        goal_object_t[:, 1] = np.maximum(0, goal_object_t[:, 1] - 5)
+        goal_object_t[:, 2] = np.minimum(W, goal_object_t[:, 2] + 5)
+        goal_object_t[:, 3] = np.minimum(H, goal_object_t[:, 3] + 5)
+        num_object_t = min(max_num_object, len(goal_object_t))
+        idx = np.argsort(-(goal_object_t[:, 2] - goal_object_t[:, 0]) * (goal_object_t[:, 3] - goal_object_t[:, 1])) \
+            if sort_by_size else np.arange(len(goal_object_t))
+        out[prefix][i, :num_object_t, 1:] = goal_object_t[idx][:num_object_t, :4]
+        out[prefix + '_category'][i, :num_object_t] = np.array(input_data[prefix + '_category'][i]).reshape(-1)[idx][:num_object_t]
+        out[prefix + '_mask'][i, :num_object_t] = 1
+        if has_score:
+            out[prefix + '_score'][i, :num_object_t] = np.array(input_data[prefix + '_score'][i]).reshape(-1)[idx][:num_object_t]
+        # The ids are only kept without sort_by_size, the poses are not reordered by size
+        if prefix + '_id' in input_data and not sort_by_size:
+            out[prefix + '_id'][i, :num_object_t] = np.array(input_data[prefix + '_id'][i]).reshape(-1)[:num_object_t]
+        if prefix + '_pose' in input_data:
+            out[prefix + '_pose'][i, :num_object_t] = np.array(input_data[prefix + '_pose'][i]).reshape(-1, 3)[:num_object_t]
+    return out
+
+
+def progress_labels(input_data):
+    """
+    progress (1 - distance / distance at the start of the current sub-episode, clipped to [0, 1]) and is_goal
+    (distance < 1) of every step. A sub-episode ends at every stop action.
+    """
+    distance = np.asarray(input_data['distance'], dtype=np.float64).reshape(-1)
+    stops = np.where(np.asarray(input_data['action']).reshape(-1) == 0)[0]
+    episode_length = np.concatenate([distance[:1], distance[stops[:-1] + 1]])
+    episode_idx = (stops + 1)[:-1]
+    max_length = episode_length[np.searchsorted(episode_idx, np.arange(len(distance)), side='right')]
+    progress = np.clip(1 - distance / max_length, 0, 1).astype(np.float32)
+    is_goal = (distance < 1).astype(np.float32)
+    return {'progress': progress, 'is_goal': is_goal}
+
+
+def episode_labels(input_data, max_num_object, sort_by_size=False):
+    """ All the labels of an episode, as stored by convert_il_store.py --labels """
+    H, W = np.asarray(input_data['target_img'][0]).shape[:2]
+    labels = object_labels(input_data, 0, len(input_data['object']), max_num_object, sort_by_size)
+    labels.update(progress_labels(input_data))
+    labels['target_idx'] = np.asarray(input_data['target_idx'], dtype=np.int64).reshape(-1)
+    labels.update(goal_object_labels(input_data, 'target_object', (H, W), max_num_object, sort_by_size))
+    labels.update(goal_object_labels(input_data, 'target_loc_object', (H, W), max_num_object, sort_by_size))
+    return labels
+
+
+def validate_labels(input_data, labels, max_num_object, sort_by_size=False, num_windows=3, rng=np.random):
+    """
+    Compare precomputed labels with the ones computed on the fly, on the whole episode and on random windows.
+    Returns the names of the labels that differ.
+    """
+    mismatches = set()
+    expected = episode_labels(input_data, max_num_object, sort_by_size)
+    for key, value in expected.items():
+        if key not in labels or not np.array_equal(np.asarray(labels[key][:len(value)]), value):
+            mismatches.add(key)
+    num_steps = len(input_data['object'])
+    for _ in range(num_windows if num_steps > 1 else 0):
+        start_idx = rng.randint(num_steps - 1)
+        end_idx = rng.randint(start_idx + 1, num_steps + 1)
+        window = object_labels(input_data, start_idx, end_idx, max_num_object, sort_by_size)
+        for key, value in window.items():
+            if key not in labels or not np.array_equal(np.asarray(labels[key][start_idx:end_idx]), value):
+                mismatches.add(key)
+    return sorted(mismatches)
@@ -0,0 +1,229 @@
+import json
+import os
+import shutil
+from collections import OrderedDict
+import numpy as np
+from dataset.il_labels import episode_labels
+
+# Per-step (and per-goal, target_img) arrays, one row per step
+DENSE_KEYS = ['rgb', 'depth', 'action', 'position', 'rotation', 'distance', 'target_idx', 'target_img']
+# Per-step lists of detections, flattened with the row offsets of every step
+RAGGED_KEYS = {'object': (4,), 'object_score': (), 'object_category': (), 'object_pose': (3,), 'object_id': ()}
+COLUMN_DTYPES = {'rgb': np.uint8}
+# Columns of the precomputed labels (see il_labels.py)
+LABEL_PREFIX = 'label_'
+
+
+class RaggedColumn(object):
+    """ List-like view of the per-step detections of an episode: column[t] is a (num_detections_t, ...) memmap slice """
+    def __init__(self, rows, step_offsets):
+        self.rows = rows
+        self.step_offsets = step_offsets
+
+    def __len__(self):
+        return len(self.step_offsets) - 1
+
+    def __getitem__(self, t):
+        if isinstance(t, slice):
+            return [self[i] for i in range(*t.indices(len(self)))]
+        if t < 0:
+            t += len(self)
+        return self.rows[self.step_offsets[t]:self.step_offsets[t + 1]]
+
+
+class ILStoreWriter(object):
+    """
+    Writes IL episodes (the dicts saved by collect_il_data.py) as a columnar store: one flat binary file per modality,
+    plus index.json with the dtype, row shape and episode offsets of every column. The other per-episode entries
+    (target poses and objects) are kept in episodes.json.
+    labels: {'max_num_object': , 'sort_by_size': } to also store the labels of every episode computed by ILDataset
+    (NMS-filtered and padded objects, progress, is_goal), so that it only has to slice them.
+    See convert_il_store.py.
+    """
+    def __init__(self, root, labels=None):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.files = {}
+        self.index = {'episodes': [], 'columns': {}, 'labels': labels}
+        self.metadata = []
+
+    def _write(self, key, array, row_shape=None):
+        column = self.index['columns'].get(key)
+        if column is None:
+            array = array.astype(COLUMN_DTYPES.get(key, array.dtype))
+            column = {'dtype': array.dtype.str, 'row_shape': list(array.shape[1:] if row_shape is None else row_shape),
+                      'counts': [0] * len(self.index['episodes']), 'present': [False] * len(self.index['episodes'])}
+            self.index['columns'][key] = column
+            self.files[key] = open(os.path.join(self.root, key + '.bin'), 'wb')
+        array = np.ascontiguousarray(array, dtype=np.dtype(column['dtype'])).reshape([-1] + column['row_shape'])
+        self.files[key].write(array.tobytes())
+        return len(array)
+
+    def add(self, name, input_data):
+        num_rows = {}
+        for key in DENSE_KEYS:
+            if key in input_data and input_data[key] is not None and len(input_data[key]) > 0:
+                num_rows[key] = self._write(key, np.stack([np.asarray(x) for x in input_data[key]]))
+        for key, row_shape in RAGGED_KEYS.items():
+            if key in input_data:
+                steps = [np.asarray(x, dtype=np.float64 if key != 'object_id' else np.int64).reshape((-1,) + row_shape) for x in input_data[key]]
+                counts = np.array([len(x) for x in steps], dtype=np.int64)
+                rows = np.concatenate(steps) if len(steps) > 0 else np.zeros((0,) + row_shape)
+                num_rows[key] = self._write(key, rows.astype(np.float32) if key != 'object_id' else rows, row_shape)
+                num_rows[key + '_steps'] = self._write(key + '_steps', counts, ())
+        if self.index['labels'] is not None:
+            for key, value in episode_labels(input_data, **self.index['labels']).items():
+                num_rows[LABEL_PREFIX + key] = self._write(LABEL_PREFIX + key, value)
+        for key, column in self.index['columns'].items():
+            column['present'].append(key in num_rows)
+            column['counts'].append(num_rows.get(key, 0))
+        self.index['episodes'].append(name)
+        self.metadata.append({k: v for k, v in input_data.items() if k not in DENSE_KEYS and k not in RAGGED_KEYS})
+
+    def close(self):
+        for f in self.files.values():
+            f.close()
+        for column in self.index['columns'].values():
+            column['offsets'] = [0] + np.cumsum(column.pop('counts')).tolist()
+        with open(os.path.join(self.root, 'index.json'), 'w') as f:
+            json.dump(self.index, f)
+        with open(os.path.join(self.root, 'episodes.json'), 'w') as f:
+            json.dump(self.metadata, f, default=lambda x: np.asarray(x).tolist())
+
+
+class ILEpisodeStore(object):
+    """
+    Reader of the store written by ILStoreWriter.
+    episode(name) returns a dict like the joblib-loaded episode, whose arrays are zero-copy memory-mapped views:
+    slicing a time window only reads that window from disk.
+    The files are opened lazily, in every DataLoader worker.
+    """
+    def __init__(self, root):
+        self.root = root
+        with open(os.path.join(root, 'index.json')) as f:
+            self.index = json.load(f)
+        with open(os.path.join(root, 'episodes.json')) as f:
+            self.metadata = json.load(f)
+        self.names = self.index['episodes']
+        self.episode_idx = {name: i for i, name in enumerate(self.names)}
+        self.arrays = None
+
+    def __len__(self):
+        return len(self.names)
+
+    def __contains__(self, name):
+        return name in self.episode_idx
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['arrays'] = None
+        return state
+
+    def _array(self, key):
+        if self.arrays is None:
+            self.arrays = {}
+        if key not in self.arrays:
+            column = self.index['columns'][key]
+            num_rows = column['offsets'][-1]
+            file_name = os.path.join(self.root, key + '.bin')
+            if num_rows == 0:
+                self.arrays[key] = np.zeros([0] + column['row_shape'], dtype=np.dtype(column['dtype']))
+            else:
+                self.arrays[key] = np.memmap(file_name, dtype=np.dtype(column['dtype']), mode='r', shape=tuple([num_rows] + column['row_shape']))
+        return self.arrays[key]
+
+    def _rows(self, key, i):
+        offsets = self.index['columns'][key]['offsets']
+        return self._array(key)[offsets[i]:offsets[i + 1]]
+
+    @property
+    def labels_config(self):
+        """ The max_num_object and sort_by_size of the stored labels, None without labels """
+        return self.index.get('labels')
+
+    def labels(self, name):
+        """ The precomputed labels of an episode, as memory-mapped views """
+        i = self.episode_idx[name]
+        return {key[len(LABEL_PREFIX):]: self._rows(key, i) for key, column in self.index['columns'].items()
+                if key.startswith(LABEL_PREFIX) and column['present'][i]}
+
+    def episode_length(self, name):
+        offsets = self.index['columns']['position']['offsets']
+        i = self.episode_idx[name]
+        return offsets[i + 1] - offsets[i]
+
+    def episode(self, name):
+        i = self.episode_idx[name]
+        input_data = dict(self.metadata[i])
+        for key in DENSE_KEYS:
+            if key in self.index['columns'] and self.index['columns'][key]['present'][i]:
+                input_data[key] = self._rows(key, i)
+        for key in RAGGED_KEYS:
+            if key in self.index['columns'] and self.index['columns'][key]['present'][i]:
+                step_offsets = np.concatenate([[0], np.cumsum(self._rows(key + '_steps', i))])
+                input_data[key] = RaggedColumn(self._rows(key, i), step_offsets)
+        return input_data
+
+
+class SharedEpisodeCache(object):
+    """
+    LRU cache of decoded episodes shared by all the DataLoader workers (and runs) of a machine.
+    Every cached episode is a one-episode store (ILStoreWriter) in root, by default on /dev/shm, so the workers
+    memory-map the same pages instead of each decompressing and holding its own copy.
+    An entry is written to a temporary directory renamed into place, so readers never see a partial one.
+    Reading an entry refreshes its time, the least recently used entries are removed past max_episodes.
+    """
+    def __init__(self, root, max_episodes):
+        self.root = root
+        self.max_episodes = max_episodes
+        self.stores = OrderedDict()  # stores opened by this process
+        os.makedirs(root, exist_ok=True)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['stores'] = OrderedDict()
+        return state
+
+    def _open(self, name):
+        store = self.stores.pop(name, None)
+        if store is None:
+            store = ILEpisodeStore(os.path.join(self.root, name))
+        self.stores[name] = store
+        while len(self.stores) > self.max_episodes:
+            self.stores.popitem(last=False)
+        return store
+
+    def get(self, name, load_fn):
+        """ The episode name, decoded with load_fn() and cached on a miss """
+        path = os.path.join(self.root, name)
+        if name in self.stores or os.path.exists(os.path.join(path, 'index.json')):
+            try:
+                os.utime(path)
+                return self._open(name).episode(name)
+            except (FileNotFoundError, ValueError):
+                # Evicted by another worker meanwhile
+                self.stores.pop(name, None)
+        input_data = load_fn()
+        tmp_path = os.path.join(self.root, '.tmp_{}_{}'.format(name, os.getpid()))
+        writer = ILStoreWriter(tmp_path)
+        writer.add(name, input_data)
+        writer.close()
+        try:
+            os.rename(tmp_path, path)
+        except OSError:
+            # Cached by another worker meanwhile
+            shutil.rmtree(tmp_path, ignore_errors=True)
+        self.evict()
+        return input_data
+
+    def evict(self):
+        entries = []
+        for name in os.listdir(self.root):
+            if name.startswith('.tmp_'):
+                continue
+            try:
+                entries.append((os.path.getmtime(os.path.join(self.root, name)), name))
+            except FileNotFoundError:
+                pass
+        for _, name in sorted(entries)[:max(0, len(entries) - self.max_episodes)]:
+            shutil.rmtree(os.path.join(self.root, name), ignore_errors=True)
@@ -0,0 +1,43 @@
+import numpy as np
+from torch.utils.data import Sampler
+from dataset.habitatdataset import sample_start_idx, window_length
+
+
+class LengthBucketBatchSampler(Sampler):
+    """
+    Batch sampler for ILDataset grouping windows of similar length, so that a batch trimmed by ILCollate keeps little
+    padding.
+    Every epoch, it draws the window of every episode like ILDataset does, shuffles them, sorts them by length within
+    pools of bucket_pool_size batches, and shuffles the batches. Yields lists of (episode index, window start).
+    """
+    def __init__(self, episode_lengths, batch_size, max_input_length, bucket_pool_size=50, drop_last=False):
+        self.episode_lengths = episode_lengths
+        self.batch_size = batch_size
+        self.max_input_length = max_input_length
+        self.bucket_pool_size = bucket_pool_size
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        start_indices = [sample_start_idx(length) for length in self.episode_lengths]
+        lengths = np.array([window_length(length, start_idx, self.max_input_length)
+                            for length, start_idx in zip(self.episode_lengths, start_indices)])
+        order = np.random.permutation(len(self.episode_lengths))
+        pool_size = self.batch_size * self.bucket_pool_size
+        batches = []
+        for i in range(0, len(order), pool_size):
+            pool = order[i:i + pool_size]
+            pool = pool[np.argsort(-lengths[pool], kind='stable')]
+            for j in range(0, len(pool), self.batch_size):
+                batch = pool[j:j + self.batch_size]
+                if len(batch) < self.batch_size and self.drop_last:
+                    continue
+                batches.append([(int(index), int(start_indices[index])) for index in batch])
+        for batch_idx in np.random.permutation(len(batches)):
+            yield batches[batch_idx]
+
+    def __len__(self):
+        if self.drop_last:
+            num_pools, rest = divmod(len(self.episode_lengths), self.batch_size * self.bucket_pool_size)
+            return num_pools * self.bucket_pool_size + rest // self.batch_size
+        return sum(int(np.ceil(min(self.batch_size * self.bucket_pool_size, len(self.episode_lengths) - i) / self.batch_size))
+                   for i in range(0, len(self.episode_lengths), self.batch_size * self.bucket_pool_size))
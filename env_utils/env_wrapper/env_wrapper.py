@@ -8,6 +8,7 @@ from utils.debug_utils import log_time
 
 TIME_DEBUG = False
 from utils.habitat_utils import batch_obs
+from env_utils.graph_delta import GraphMemoryMirror
 
 # this wrapper comes after vectorenv
 from habitat.core.vector_env import VectorEnv
@@ -31,6 +32,31 @@ class EnvWrapper(Wrapper):
         self.B = self.num_envs
         self.torch = exp_config.TASK_CONFIG.SIMULATOR.HABITAT_SIM_V0.GPU_GPU
         self.torch_device = 'cuda:' + str(exp_config.TORCH_GPU_ID) if torch.cuda.device_count() > 0 else 'cpu'
+        self.delta_transport = exp_config.memory.delta_transport
+        if self.delta_transport:
+            self.graph_mirror = GraphMemoryMirror(self.B, self.torch_device)
+
+    def apply_graph_deltas(self, obs_list, obs_batch):
+        """
+        Apply the graph deltas of the workers to the mirrored memory and put the memory in the batch.
+        A worker whose delta does not follow the mirrored version is asked for a full snapshot.
+        """
+        for b, obs in enumerate(obs_list):
+            delta = obs['graph_delta']
+            if not self.graph_mirror.can_apply(b, delta):
+                if self.is_vector_env:
+                    delta = self.envs.call_at(b, 'get_graph_snapshot')
+                else:
+                    delta = self.envs.get_graph_snapshot()
+            self.graph_mirror.apply(b, delta)
+        obs_batch.update(self.graph_mirror.get_memory())
+        return obs_batch
+
+    def _batch_obs(self, obs_list):
+        if not self.delta_transport:
+            return batch_obs(obs_list, device=self.torch_device)
+        obs_batch = batch_obs([{k: v for k, v in obs.items() if k != 'graph_delta'} for obs in obs_list], device=self.torch_device)
+        return self.apply_graph_deltas(obs_list, obs_batch)
 
     def step(self, actions):
         if TIME_DEBUG: s = log_time()
@@ -40,7 +66,7 @@ class EnvWrapper(Wrapper):
         else:
             outputs = [self.envs.step(actions)]
         obs_list, reward_list, done_list, info_list = [list(x) for x in zip(*outputs)]
-        obs_batch = batch_obs(obs_list, device=self.torch_device)
+        obs_batch = self._batch_obs(obs_list)
 
         if self.is_vector_env:
             return obs_batch, reward_list, done_list, info_list
@@ -50,7 +76,7 @@ class EnvWrapper(Wrapper):
     def reset(self):
         obs_list = self.envs.reset()
         if not self.is_vector_env: obs_list = [obs_list]
-        obs_batch = batch_obs(obs_list, device=self.torch_device)
+        obs_batch = self._batch_obs(obs_list)
         return obs_batch
 
     def call(self, aa, bb):
@@ -1,4 +1,5 @@
 import numpy as np
+from model.Graph.graph import HOP_INF
 
 class ImgGraph(object):
     def __init__(self, cfg):
@@ -20,6 +21,7 @@ class ImgGraph(object):
         self.A = np.zeros([self.M, self.M], dtype=np.bool)
         self.distance_mat = np.full([self.M, self.M], fill_value=float('inf'), dtype=np.float32)
         self.connectivity_mat = np.full([self.M, self.M], fill_value=0, dtype=np.float32)
+        self.hop_dist = np.full([self.M, self.M], fill_value=HOP_INF, dtype=np.int32)
         self.graph_mask = np.zeros(self.M)
         self.graph_time = np.zeros(self.M)
         self.pre_last_localized_node_idx = np.zeros([1], dtype=np.int32)
@@ -37,6 +39,7 @@ class ImgGraph(object):
         self.graph_memory[node_idx] = embedding
         self.graph_mask[node_idx] = 1.0
         self.graph_time[node_idx] = time_step
+        self.hop_dist[node_idx, node_idx] = 0
         if dists is not None:
             self.distance_mat[node_idx, :node_idx] = dists
             self.distance_mat[:node_idx, node_idx] = dists
@@ -52,11 +55,25 @@ class ImgGraph(object):
     def add_edge(self, node_idx_a, node_idx_b):
         self.A[node_idx_a, node_idx_b] = True
         self.A[node_idx_b, node_idx_a] = True
+        self.relax_hop_dist(int(node_idx_a), int(node_idx_b))
 
     def add_edges(self, node_idx_as, node_idx_b):
         for node_idx_a in node_idx_as:
-            self.A[node_idx_a, node_idx_b] = True
-            self.A[node_idx_b, node_idx_a] = True
+            self.add_edge(node_idx_a, node_idx_b)
+
+    def relax_hop_dist(self, node_idx_a, node_idx_b):
+        """ Update the all-pairs hop distances for a new edge (a, b), as model/Graph/graph.py ImgGraph.relax_hop_dist """
+        if node_idx_a == node_idx_b:
+            return
+        n = self.num_node()
+        D = self.hop_dist
+        for src, dst in [(node_idx_a, node_idx_b), (node_idx_b, node_idx_a)]:
+            rows = np.where(D[:n, src] + 1 < D[:n, dst])[0]
+            if len(rows) == 0:
+                continue
+            relaxed = np.minimum(D[rows, :n], D[rows, src][:, None] + 1 + D[dst, :n][None])
+            D[rows, :n] = relaxed
+            D[:n, rows] = relaxed.T
 
     def update_node(self, node_idx, time_info, embedding=None):
         if embedding is not None:
@@ -81,7 +98,9 @@ class ImgGraph(object):
             return np.where(self.A[node_idx])[0]
 
     def calculate_multihop(self, hop):
-        return np.matrix_power(self.A[:, :self.num_node(), :self.num_node()].float(), hop)
+        """ (num_node, num_node) adjacency of the nodes that are at most `hop` hops apart, as ImgGraph in model/Graph/graph.py """
+        n = self.num_node()
+        return (self.hop_dist[:n, :n] <= hop).astype(np.float32)
 
 
 class ObjGraph(object):
@@ -0,0 +1,89 @@
+import numpy as np
+import torch
+
+# memory key -> per-node array of ImgGraph/ObjGraph
+IMG_NODE_ARRAYS = {'img_memory_feat': 'graph_memory', 'img_memory_mask': 'graph_mask', 'img_memory_time': 'graph_time'}
+OBJ_NODE_ARRAYS = {'obj_memory_feat': 'graph_memory', 'obj_memory_score': 'graph_score', 'obj_memory_category': 'graph_category',
+                   'obj_memory_mask': 'graph_mask', 'obj_memory_time': 'graph_time'}
+
+
+class GraphDeltaEncoder(object):
+    """
+    Worker side of the graph memory transport.
+    Instead of the full memory arrays, every step emits the nodes and edges that the graphs recorded as changed
+    since the previous step (ImgGraph/ObjGraph dirty_nodes and dirty_edges) together with a version number.
+    The cost of a step depends on the number of changes, not on the memory size.
+    A full snapshot is emitted after a reset, or when the trainer asks for one.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.version = 0
+
+    def snapshot(self, memory_dict, imggraph, objgraph):
+        self.version += 1
+        imggraph.reset_dirty()
+        objgraph.reset_dirty()
+        return {'version': self.version, 'base_version': -1, 'full': memory_dict}
+
+    def encode(self, imggraph, objgraph):
+        rows, edges = {}, {}
+        node_indices = np.array(sorted(imggraph.dirty_nodes), dtype=np.int64)
+        if len(node_indices) > 0:
+            for key, name in IMG_NODE_ARRAYS.items():
+                rows[key] = (node_indices, getattr(imggraph, name)[node_indices])
+        if len(imggraph.dirty_edges) > 0:
+            node_idx_a, node_idx_b = np.array(sorted(imggraph.dirty_edges), dtype=np.int64).T
+            edges['img_memory_A'] = (node_idx_a, node_idx_b, imggraph.A[node_idx_a, node_idx_b])
+        node_indices = np.array(sorted(objgraph.dirty_nodes), dtype=np.int64)
+        if len(node_indices) > 0:
+            for key, name in OBJ_NODE_ARRAYS.items():
+                rows[key] = (node_indices, getattr(objgraph, name)[node_indices])
+            rows['obj_memory_A_OV'] = (node_indices, objgraph.A_OV[node_indices])
+        imggraph.reset_dirty()
+        objgraph.reset_dirty()
+        self.version += 1
+        return {'version': self.version, 'base_version': self.version - 1, 'rows': rows, 'edges': edges}
+
+
+class GraphMemoryMirror(object):
+    """
+    Trainer side of the graph memory transport: the batched [B, ...] memory tensors, kept on device
+    and updated in place with the deltas of every env.
+    """
+    def __init__(self, B, device='cpu'):
+        self.B = B
+        self.torch_device = device
+        self.memory = {}
+        self.version = [-1] * B
+
+    def can_apply(self, b, delta):
+        return 'full' in delta or (self.version[b] >= 0 and self.version[b] == delta['base_version'])
+
+    def to_device(self, x, k):
+        return torch.from_numpy(np.asarray(x)).to(device=self.torch_device, dtype=self.memory[k].dtype)
+
+    def apply(self, b, delta):
+        if 'full' in delta:
+            for k, v in delta['full'].items():
+                v = torch.from_numpy(np.asarray(v))
+                if k not in self.memory:
+                    # Same dtypes as batch_obs
+                    dtype = torch.float32 if v.dtype == torch.float64 else v.dtype
+                    self.memory[k] = torch.zeros((self.B,) + tuple(v.shape), dtype=dtype, device=self.torch_device)
+                self.memory[k][b] = v.to(device=self.torch_device, dtype=self.memory[k].dtype)
+        else:
+            for k, (idx, v) in delta['rows'].items():
+                self.memory[k][b, torch.from_numpy(idx).to(self.torch_device)] = self.to_device(v, k)
+            for k, (idx_a, idx_b, v) in delta['edges'].items():
+                idx_a = torch.from_numpy(idx_a).to(self.torch_device)
+                idx_b = torch.from_numpy(idx_b).to(self.torch_device)
+                v = self.to_device(v, k)
+                self.memory[k][b, idx_a, idx_b] = v
+                self.memory[k][b, idx_b, idx_a] = v
+        self.version[b] = delta['version']
+
+    def get_memory(self):
+        # The mirror buffers themselves: they are updated in place by the next apply, copy them to keep a step
+        return dict(self.memory)
@@ -1,18 +1,15 @@
 import os
 import numpy as np
-from PIL import Image
 from typing import Optional
 from habitat import Config, Dataset
 from gym.spaces.box import Box
 import torch
 import torch.nn as nn
-import torchvision.transforms as transforms
 from env_utils.imagegoal_env import ImageGoalEnv
-# from model.Graph.resnet_img import resnet18 as resnet18_img
-from torchvision.models import resnet18 as resnet18_img
-from model.Graph.resnet_obj import resnet18 as resnet18_obj
-from model.Graph.graph import ImgGraph, ObjGraph
-from model.Graph.graph_update import update_image_graph, update_object_graph
+from model.Graph.graph import pad_to_budget
+from model.Graph.graph_builder import GraphBuilder
+from model.Graph.scene_memory import SceneMemory
+from env_utils.graph_delta import GraphDeltaEncoder
 project_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 
 
@@ -27,15 +24,16 @@ class ImageGoalGraphEnv(ImageGoalEnv):
         self.num_objects = config.memory.num_objects
         self.feature_dim = config.memory.img_embedding_dim
         self.torch_device = 'cuda:' + str(config.TORCH_GPU_ID) if torch.cuda.device_count() > 0 else 'cpu'
-        self.transform_eval = transforms.Compose([transforms.ToTensor(), transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])])
 
         self.img_node_th = config.TASK_CONFIG.img_node_th
         self.obj_node_th = config.TASK_CONFIG.obj_node_th
-        self.imggraph = ImgGraph(config)
-        self.objgraph = ObjGraph(config)
-
-        self.img_encoder = self.load_img_encoder(config.memory.img_embedding_dim)
-        self.obj_encoder = self.load_obj_encoder(config.features.object_feature_dim)
+        self.graph_builder = GraphBuilder(config, self.torch_device)
+        self.delta_transport = config.memory.delta_transport
+        self.graph_delta = GraphDeltaEncoder()
+        self.scene_memory = None
+        if config.memory.scene_memory:
+            self.scene_memory = SceneMemory(config.memory.scene_memory_max_scenes, config.memory.scene_memory_dir)
+        self.scene_key = None
 
         self.reset_all_memory()
         
@@ -54,57 +52,36 @@ class ImageGoalGraphEnv(ImageGoalEnv):
             return
 
         self.dn = config.TASK_CONFIG.DATASET.DATASET_NAME.split("_")[0]
+        dtypes = self.imggraph.dtypes
+        max_time = np.iinfo(dtypes['time']).max if np.issubdtype(dtypes['time'], np.integer) else np.Inf
         self.observation_space.spaces.update({
-            'img_memory_feat': Box(low=-np.Inf, high=np.Inf, shape=(self.imggraph.M, self.feature_dim), dtype=np.float32),
+            'img_memory_feat': Box(low=-np.Inf, high=np.Inf, shape=(self.imggraph.M, self.feature_dim), dtype=dtypes['embedding']),
             'img_memory_pose': Box(low=-np.Inf, high=np.Inf, shape=(self.imggraph.M, 3), dtype=np.float32),
-            'img_memory_mask': Box(low=0, high=1, shape=(self.imggraph.M,), dtype=np.bool),
-            'img_memory_A': Box(low=0, high=1, shape=(self.imggraph.M, self.imggraph.M), dtype=np.bool),
-            'img_memory_idx': Box(low=-np.Inf, high=np.Inf, shape=(), dtype=np.float32),
-            'img_memory_time': Box(low=-np.Inf, high=np.Inf, shape=(self.imggraph.M,), dtype=np.float32)
+            'img_memory_mask': Box(low=0, high=1, shape=(self.imggraph.M,), dtype=dtypes['adjacency']),
+            'img_memory_A': Box(low=0, high=1, shape=(self.imggraph.M, self.imggraph.M), dtype=dtypes['adjacency']),
+            'img_memory_idx': Box(low=0, high=self.imggraph.M, shape=(), dtype=np.int32),
+            'img_memory_time': Box(low=0, high=max_time, shape=(self.imggraph.M,), dtype=dtypes['time'])
         })
         self.observation_space.spaces.update({
-            'obj_memory_feat': Box(low=-np.Inf, high=np.Inf, shape=(self.objgraph.M, self.object_feature_dim), dtype=np.float32),
-            'obj_memory_score': Box(low=-np.Inf, high=np.Inf, shape=(self.objgraph.M,), dtype=np.float32),
+            'obj_memory_feat': Box(low=-np.Inf, high=np.Inf, shape=(self.objgraph.M, self.object_feature_dim), dtype=dtypes['embedding']),
+            'obj_memory_score': Box(low=-np.Inf, high=np.Inf, shape=(self.objgraph.M,), dtype=dtypes['score']),
             'obj_memory_pose': Box(low=-np.Inf, high=np.Inf, shape=(self.objgraph.M, 3), dtype=np.float32),
-            'obj_memory_category': Box(low=-np.Inf, high=np.Inf, shape=(self.objgraph.M,), dtype=np.float32),
-            'obj_memory_mask': Box(low=0, high=1, shape=(self.objgraph.M,), dtype=np.bool),
-            'obj_memory_A_OV': Box(low=0, high=1, shape=(self.objgraph.M, self.objgraph.MV), dtype=np.bool),
-            'obj_memory_time': Box(low=-np.Inf, high=np.Inf, shape=(self.objgraph.M,), dtype=np.float32)
+            'obj_memory_category': Box(low=-np.Inf, high=np.Inf, shape=(self.objgraph.M,), dtype=dtypes['score']),
+            'obj_memory_mask': Box(low=0, high=1, shape=(self.objgraph.M,), dtype=dtypes['adjacency']),
+            'obj_memory_A_OV': Box(low=0, high=1, shape=(self.objgraph.M, self.objgraph.MV), dtype=dtypes['adjacency']),
+            'obj_memory_time': Box(low=0, high=max_time, shape=(self.objgraph.M,), dtype=dtypes['time'])
         })
 
-    def load_img_encoder(self, feature_dim):
-        img_encoder = resnet18_img(num_classes=feature_dim)
-        dim_mlp = img_encoder.fc.weight.shape[1]
-        img_encoder.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), img_encoder.fc)
-        ckpt_pth = os.path.join(project_dir, 'data/graph', self.dn, 'Img_encoder.pth.tar')
-        ckpt = torch.load(ckpt_pth, map_location='cpu')
-        state_dict = {k[len('module.encoder_q.'):]: v for k, v in ckpt['state_dict'].items() if 'module.encoder_q.' in k}
-        img_encoder.load_state_dict(state_dict)
-        img_encoder.eval().to(self.torch_device)
-
-        # img_encoder = resnet18_img(num_classes=feature_dim)
-        # dim_mlp = img_encoder.fc.weight.shape[1]
-        # img_encoder.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), img_encoder.fc)
-        # ckpt_pth = os.path.join(project_dir, 'data/graph', self.dn, 'Img_encoder.pth.tar')
-        # ckpt = torch.load(ckpt_pth, map_location='cpu')
-        # img_encoder.load_state_dict(ckpt)
-        # img_encoder.eval().to(self.torch_device)
-        return img_encoder
+    @property
+    def imggraph(self):
+        return self.graph_builder.imggraph
 
-    def load_obj_encoder(self, feature_dim):
-        obj_encoder = resnet18_obj(num_classes=feature_dim)
-        dim_mlp = obj_encoder.fc.weight.shape[1]
-        obj_encoder.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), obj_encoder.fc)
-        ckpt_pth = os.path.join(project_dir, 'data/graph', self.dn, f'Obj_encoder.pth.tar')
-        ckpt = torch.load(ckpt_pth, map_location='cpu')
-        state_dict = {k[len('module.encoder_q.'):]: v for k, v in ckpt['state_dict'].items() if 'module.encoder_q.' in k}
-        obj_encoder.load_state_dict(state_dict)
-        obj_encoder.eval().to(self.torch_device)
-        return obj_encoder
+    @property
+    def objgraph(self):
+        return self.graph_builder.objgraph
 
     def reset_all_memory(self):
-        self.imggraph.reset()
-        self.objgraph.reset()
+        self.graph_builder.reset()
 
     def is_close(self, embed_a, embed_b, return_prob=False, th=0.75):
         logits = np.matmul(embed_a, embed_b.transpose(1, 0))
@@ -246,44 +223,19 @@ class ImageGoalGraphEnv(ImageGoalEnv):
     #         self.imggraph.record_localized_state(new_node_idx, new_embedding)
     #     self.last_localized_node_idx = self.imggraph.last_localized_node_idx
 
-    def embed_obs(self, obs):
-        with torch.no_grad():
-            img_tensor = (torch.tensor(obs['panoramic_rgb'][None]).to(self.torch_device).float() / 255).permute(0, 3, 1, 2)
-            img_embedding = nn.functional.normalize(self.img_encoder(img_tensor).view(-1, self.feature_dim), dim=1)
-        return img_embedding[0].cpu().detach().numpy()
-
-    def embed_target(self, obs):
-        with torch.no_grad():
-            img_tensor = obs['target_goal'][...,:3].permute(0, 3, 1, 2)
-            img_embedding = nn.functional.normalize(self.img_encoder(img_tensor).view(-1, self.feature_dim), dim=1)
-        return img_embedding[0].cpu().detach().numpy()
-
-    def embed_object(self, obs):
-        with torch.no_grad():
-            im = Image.fromarray(np.uint8(obs['panoramic_rgb']))
-            img_tensor = self.transform_eval(im)[None].to(self.torch_device)
-            feat = self.obj_encoder(img_tensor, torch.tensor(obs['object']).to(self.torch_device).float()[None])
-            obj_embedding = nn.functional.normalize(feat, dim=-1)
-        return obj_embedding[0].cpu().detach().numpy()
-
-    def build_graph(self, obs, reset=False):
+    def build_graph(self, obs, reset=False, embeddings=None):
+        """
+        Update the graphs with the observation and add them to it.
+        embeddings: (image embedding, object embeddings) of the observation if already computed, see GraphBuilder.embed_obs_batch
+        With memory.scene_memory, a new episode starts from the graphs saved for its scene, see model/Graph/scene_memory.py.
+        """
         if not reset:
             obs, reward, done, info = obs
-        curr_img_embeddings = self.embed_obs(obs)
-        curr_object_embedding = self.embed_object(obs)
-        if reset:
-            self.imggraph.reset()
-            self.imggraph.initialize_graph(curr_img_embeddings, obs['position'], obs['rotation'])
-        else:
-            self.imggraph = update_image_graph(self.imggraph, self.objgraph, curr_img_embeddings, curr_object_embedding, obs, done=False)
-        img_memory_dict = self.get_img_memory()
-        if reset:
-            self.objgraph.reset()
-            self.objgraph.initialize_graph(curr_object_embedding, obs['object_score'], obs['object_category'], obs['object_mask'], obs['object_pose'])
-        else:
-            self.objgraph = update_object_graph(self.imggraph, self.objgraph, curr_object_embedding, obs, done=False)
-        obj_memory_dict = self.get_obj_memory()
-        obs = self.add_memory_in_obs(obs, img_memory_dict, obj_memory_dict)
+        state = None
+        if reset and self.scene_memory is not None and self.scene_key is not None:
+            state = self.scene_memory.load(self.scene_key)
+        self.graph_builder.update(obs, reset=reset, embeddings=embeddings, state=state)
+        obs = self.add_memory_in_obs(obs, reset=reset)
         if self.args.render:
             # self.draw_graphs()
             self.render('human')
@@ -297,7 +249,11 @@ class ImageGoalGraphEnv(ImageGoalEnv):
             self.record_objects = []
             self.record_imgs = []
             self.record_iter += 1
+        if self.scene_memory is not None and self.scene_key is not None:
+            self.scene_memory.save(self.scene_key, self.imggraph, self.objgraph)
         obs_list = super().reset()
+        if self.scene_memory is not None:
+            self.scene_key = self.current_episode.scene_id.split("/")[-2]
         obs = self.build_graph(obs_list, reset=True)
         return obs
 
@@ -314,12 +270,17 @@ class ImageGoalGraphEnv(ImageGoalEnv):
                       'curr_info': {'curr_node': self.imggraph.last_localized_node_idx}}
         self.draw_image_graph_on_map(**input_args)
 
-    def add_memory_in_obs(self, obs, memory_dict, obj_memory_dict):
+    def add_memory_in_obs(self, obs, reset=False):
         """
-        Add memory in observation
+        Add memory in observation.
+        With memory.delta_transport, the memory arrays are replaced by obs['graph_delta'], see env_utils/graph_delta.py
         """
-        obs.update(memory_dict)
-        obs.update(obj_memory_dict)
+        if self.delta_transport:
+            obs.update({'img_memory_idx': self.get_img_memory_idx()})
+            obs['graph_delta'] = self.get_graph_snapshot() if reset else self.graph_delta.encode(self.imggraph, self.objgraph)
+        else:
+            obs.update(self.get_img_memory())
+            obs.update(self.get_obj_memory())
         obs.update({'object_localized_idx': self.objgraph.last_localized_node_idx})
         obs.update({'localized_idx': self.imggraph.last_localized_node_idx})
         if 'distance' in obs.keys():
@@ -335,23 +296,32 @@ class ImageGoalGraphEnv(ImageGoalEnv):
             self.render('human')
         return obs, reward, done, info
 
+    def get_graph_snapshot(self):
+        """ Full memory snapshot for the trainer, called when its mirror is out of sync """
+        memory_dict = dict(self.get_img_memory(), **self.get_obj_memory())
+        memory_dict.pop('img_memory_idx')
+        return self.graph_delta.snapshot(memory_dict, self.imggraph, self.objgraph)
+
+    def get_img_memory_idx(self):
+        return np.int32(np.asarray(self.imggraph.last_localized_node_idx).reshape(-1)[0])
+
     def get_img_memory(self):
         img_memory_dict = {
-            'img_memory_feat': self.imggraph.graph_memory,
-            'img_memory_mask': self.imggraph.graph_mask,
-            'img_memory_A': self.imggraph.A,
-            'img_memory_idx': self.imggraph.last_localized_node_idx,
-            'img_memory_time': self.imggraph.graph_time
+            'img_memory_feat': pad_to_budget(self.imggraph.graph_memory, self.imggraph.M),
+            'img_memory_mask': pad_to_budget(self.imggraph.graph_mask, self.imggraph.M),
+            'img_memory_A': pad_to_budget(self.imggraph.A, self.imggraph.M, 2),
+            'img_memory_idx': self.get_img_memory_idx(),
+            'img_memory_time': pad_to_budget(self.imggraph.graph_time, self.imggraph.M)
         }
         return img_memory_dict
 
     def get_obj_memory(self):
         obj_memory_dict = {
-            'obj_memory_feat': self.objgraph.graph_memory,
-            'obj_memory_score': self.objgraph.graph_score,
-            'obj_memory_category': self.objgraph.graph_category,
-            'obj_memory_mask': self.objgraph.graph_mask,
+            'obj_memory_feat': pad_to_budget(self.objgraph.graph_memory, self.objgraph.M),
+            'obj_memory_score': pad_to_budget(self.objgraph.graph_score, self.objgraph.M),
+            'obj_memory_category': pad_to_budget(self.objgraph.graph_category, self.objgraph.M),
+            'obj_memory_mask': pad_to_budget(self.objgraph.graph_mask, self.objgraph.M),
             'obj_memory_A_OV': self.objgraph.A_OV,
-            'obj_memory_time': self.objgraph.graph_time
+            'obj_memory_time': pad_to_budget(self.objgraph.graph_time, self.objgraph.M)
         }
         return obj_memory_dict
\ No newline at end of file
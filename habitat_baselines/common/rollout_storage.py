@@ -32,10 +32,14 @@ class RolloutStorage:
         self.MEMORY_LIST = MEMORY_LIST
         for sensor in observation_space.spaces:
             if sensor in OBS_LIST:
+                # The graph memory is stored in the compact dtype of its observation space
+                dtype = torch.from_numpy(np.zeros(0, dtype=observation_space.spaces[sensor].dtype)).dtype \
+                    if sensor in MEMORY_LIST else torch.float
                 self.observations[sensor] = torch.zeros(
                     num_steps + 1,
                     num_envs,
-                    *observation_space.spaces[sensor].shape
+                    *observation_space.spaces[sensor].shape,
+                    dtype=dtype
                 )
         self.recurrent_hidden_states = torch.zeros(
             num_steps + 1,
@@ -1,4 +1,46 @@
+import itertools
 import numpy as np
+from model.Graph.graph_index import build_localization_index
+
+
+EVICTION_POLICIES = ['lru', 'visit']
+HOP_INF = np.iinfo(np.int32).max // 2  # hop distance between disconnected nodes
+
+
+def get_memory_dtypes(cfg):
+    """ Storage dtypes of the graph memory arrays """
+    return {'embedding': np.dtype(cfg.memory.embedding_dtype), 'adjacency': np.dtype(cfg.memory.adjacency_dtype),
+            'time': np.dtype(cfg.memory.time_dtype), 'score': np.dtype(cfg.memory.score_dtype)}
+
+
+def resize_array(x, capacity, num_axes=1, fill_value=0):
+    """ Copy x into a new array whose first num_axes dims have the given size """
+    out = np.full((capacity,) * num_axes + x.shape[num_axes:], fill_value=fill_value, dtype=x.dtype)
+    old = tuple(slice(0, min(capacity, d)) for d in x.shape[:num_axes])
+    out[old] = x[old]
+    return out
+
+
+def pad_to_budget(x, budget, num_axes=1):
+    """ Zero-pad the first num_axes dims of a graph array to the memory budget, e.g. for the observation space """
+    if all([d == budget for d in x.shape[:num_axes]]):
+        return x
+    return resize_array(x, budget, num_axes)
+
+
+def select_eviction_victims(policy, graph_mask, graph_time, graph_visit, num, protect=()):
+    """
+    Pick num nodes to evict among the nodes in use, except the protected ones.
+    'lru': the nodes that were visited the longest time ago. 'visit': the least visited nodes, then the oldest.
+    """
+    candidates = np.setdiff1d(np.where(graph_mask == 1)[0], np.asarray(protect, dtype=np.int64))
+    if len(candidates) < num:
+        candidates = np.where(graph_mask == 1)[0]
+    if policy == 'lru':
+        order = np.argsort(graph_time[candidates], kind='stable')
+    else:
+        order = np.lexsort((graph_time[candidates], graph_visit[candidates]))
+    return candidates[order[:num]]
 
 
 class ImgGraph(object):
@@ -10,7 +52,21 @@ class ImgGraph(object):
         self.input_shape = cfg.IMG_SHAPE
         self.feature_dim = cfg.memory.img_embedding_dim
         self.M = cfg.memory.memory_size
+        self.dtypes = get_memory_dtypes(cfg)
+        self.initial_capacity = min(cfg.memory.initial_memory_size or self.M, self.M)
+        self.eviction = cfg.memory.eviction
+        if self.eviction not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy {}. Choose from {}".format(self.eviction, EVICTION_POLICIES))
+        self.merge_interval = cfg.memory.merge_interval
+        self.merge_th = cfg.memory.merge_th
+        self.merge_neighbor_th = cfg.memory.merge_neighbor_th
+        self.merge_embedding = cfg.memory.merge_embedding
+        if self.merge_embedding not in ['fresh', 'mean']:
+            raise ValueError("Unknown merge_embedding {}. Choose from ['fresh', 'mean']".format(self.merge_embedding))
         self.node_th = cfg.TASK_CONFIG.img_node_th
+        self.topk = cfg.memory.localization_topk
+        self.index = build_localization_index(cfg.memory.localization_index, self.feature_dim, self.initial_capacity,
+                                              nlist=cfg.memory.ivf_nlist, nprobe=cfg.memory.ivf_nprobe, min_train=cfg.memory.ivf_min_train)
 
     def num_node(self):
         return len(self.node_position_list)
@@ -18,28 +74,228 @@ class ImgGraph(object):
     def reset(self):
         self.node_position_list = []  # This position list is only for visualizations
         self.node_rotation_list = []  # This position list is only for visualizations
-        self.graph_memory = np.zeros([self.M, self.feature_dim])
-        self.A = np.zeros([self.M, self.M], dtype=np.bool)
-        self.distance_mat = np.full([self.M, self.M], fill_value=float('inf'), dtype=np.float32)
-        self.connectivity_mat = np.full([self.M, self.M], fill_value=0, dtype=np.float32)
-        self.graph_mask = np.zeros(self.M)
-        self.graph_time = np.zeros(self.M)
+        self.capacity = self.initial_capacity
+        self.index.reset(self.capacity)
+        self.graph_memory = np.zeros([self.capacity, self.feature_dim], dtype=self.dtypes['embedding'])
+        self.A = np.zeros([self.capacity, self.capacity], dtype=self.dtypes['adjacency'])
+        self.distance_mat = np.full([self.capacity, self.capacity], fill_value=float('inf'), dtype=np.float32)
+        self.connectivity_mat = np.full([self.capacity, self.capacity], fill_value=0, dtype=np.float32)
+        self.hop_dist = np.full([self.capacity, self.capacity], fill_value=HOP_INF, dtype=np.int32)
+        self.hop_dirty = False  # set when edges are removed, the hop distances are then rebuilt on the next query
+        self.graph_mask = np.zeros(self.capacity, dtype=self.dtypes['adjacency'])
+        self.graph_time = np.zeros(self.capacity, dtype=self.dtypes['time'])
+        self.graph_visit = np.zeros(self.capacity, dtype=np.int32)
+        self.free_slots = set()  # indices of the evicted nodes, reused before growing
+        self.node_remap = {}  # old node index -> node it was merged into, by the last compact()
+        self.num_grown = 0
+        self.num_evicted = 0
+        self.num_merged = 0
+        self.reset_dirty()
         self.pre_last_localized_node_idx = np.zeros([1], dtype=np.int32)
         self.last_localized_node_idx = np.zeros([1], dtype=np.int32)
         self.last_local_node_num = np.zeros([1])
         self.last_localized_node_embedding = np.zeros([self.feature_dim], dtype=np.float32)
         self.found = True
 
+    def reserve(self, num):
+        """ Grow the arrays by doubling until they can hold num nodes """
+        if num <= self.capacity:
+            return
+        if num > self.M:
+            raise ValueError("Image graph node {} exceeds the memory budget {}".format(num - 1, self.M))
+        capacity = self.capacity
+        while capacity < num:
+            capacity = min(2 * capacity, self.M)
+        self.graph_memory = resize_array(self.graph_memory, capacity)
+        self.A = resize_array(self.A, capacity, 2)
+        self.distance_mat = resize_array(self.distance_mat, capacity, 2, fill_value=float('inf'))
+        self.connectivity_mat = resize_array(self.connectivity_mat, capacity, 2)
+        self.hop_dist = resize_array(self.hop_dist, capacity, 2, fill_value=HOP_INF)
+        self.graph_mask = resize_array(self.graph_mask, capacity)
+        self.graph_time = resize_array(self.graph_time, capacity)
+        self.graph_visit = resize_array(self.graph_visit, capacity)
+        self.index.resize(capacity)
+        self.capacity = capacity
+        self.num_grown += 1
+
+    def reset_dirty(self):
+        """ Start a new delta: forget the changed nodes and edges, see env_utils/graph_delta.py """
+        self.dirty_nodes = set()  # nodes whose graph_memory/graph_mask/graph_time changed
+        self.dirty_edges = set()  # (a, b) pairs with a < b whose entry of A changed
+
+    def mark_edges_dirty(self, node_idx):
+        for node_idx_b in np.where(self.A[node_idx, :self.num_node()])[0]:
+            self.dirty_edges.add((min(int(node_idx), int(node_idx_b)), max(int(node_idx), int(node_idx_b))))
+
+    def allocate_node(self, protect=()):
+        """
+        Index for a new node: a free slot, else the next index while under the budget,
+        else the slot of a node evicted with the eviction policy (never one of the protected nodes).
+        Returns the index and the evicted node (None if nothing was evicted).
+        Objects attached to the evicted node are not removed here, see ObjGraph.remove_vis_node.
+        """
+        if len(self.free_slots) > 0:
+            node_idx = min(self.free_slots)
+            self.free_slots.remove(node_idx)
+            return node_idx, None
+        if self.num_node() < self.M:
+            return self.num_node(), None
+        node_idx = int(select_eviction_victims(self.eviction, self.graph_mask, self.graph_time, self.graph_visit, 1, protect)[0])
+        self.remove_node(node_idx)
+        self.free_slots.remove(node_idx)
+        return node_idx, node_idx
+
+    def remove_node(self, node_idx, evicted=True):
+        self.mark_edges_dirty(node_idx)
+        self.dirty_nodes.add(int(node_idx))
+        self.A[node_idx, :] = False
+        self.A[:, node_idx] = False
+        self.distance_mat[node_idx, :] = float('inf')
+        self.distance_mat[:, node_idx] = float('inf')
+        self.connectivity_mat[node_idx, :] = 0
+        self.connectivity_mat[:, node_idx] = 0
+        self.graph_memory[node_idx] = 0
+        self.graph_mask[node_idx] = 0
+        self.graph_time[node_idx] = 0
+        self.graph_visit[node_idx] = 0
+        self.index.remove(node_idx)
+        self.hop_dist[node_idx, :] = HOP_INF
+        self.hop_dist[:, node_idx] = HOP_INF
+        self.hop_dirty = True
+        self.free_slots.add(int(node_idx))
+        self.num_evicted += int(evicted)
+
+    def merge_candidates(self):
+        """
+        Pairs of nodes (i, j) whose embeddings are closer than merge_th and whose closed neighbourhoods
+        have a jaccard similarity of at least merge_neighbor_th, most similar first.
+        """
+        live = np.where(self.graph_mask == 1)[0]
+        if len(live) < 2:
+            return []
+        sim = np.matmul(self.graph_memory[live], self.graph_memory[live].T)
+        ii, jj = np.where(np.triu(sim > self.merge_th, 1))
+        if len(ii) == 0:
+            return []
+        neighbors = self.A[live][:, live] | np.eye(len(live), dtype=bool)
+        inter = (neighbors[ii] & neighbors[jj]).sum(1)
+        union = (neighbors[ii] | neighbors[jj]).sum(1)
+        keep = inter >= self.merge_neighbor_th * union
+        ii, jj = ii[keep], jj[keep]
+        order = np.argsort(-sim[ii, jj], kind='stable')
+        return [(int(live[ii[k]]), int(live[jj[k]])) for k in order]
+
+    def merge_nodes(self, keep_idx, drop_idx):
+        """ Merge the node drop_idx into keep_idx. The edges are united and drop_idx is freed """
+        self.mark_edges_dirty(keep_idx)
+        self.mark_edges_dirty(drop_idx)
+        self.A[keep_idx] |= self.A[drop_idx]
+        self.A[:, keep_idx] |= self.A[:, drop_idx]
+        self.A[keep_idx, keep_idx] = False
+        self.A[keep_idx, drop_idx] = self.A[drop_idx, keep_idx] = False
+        self.mark_edges_dirty(keep_idx)
+        self.dirty_nodes.add(int(keep_idx))
+        self.distance_mat[keep_idx] = np.minimum(self.distance_mat[keep_idx], self.distance_mat[drop_idx])
+        self.distance_mat[:, keep_idx] = self.distance_mat[keep_idx]
+        self.connectivity_mat[keep_idx] = np.maximum(self.connectivity_mat[keep_idx], self.connectivity_mat[drop_idx])
+        self.connectivity_mat[:, keep_idx] = self.connectivity_mat[keep_idx]
+        if self.merge_embedding == 'mean':
+            embedding = self.graph_visit[keep_idx] * self.graph_memory[keep_idx] + self.graph_visit[drop_idx] * self.graph_memory[drop_idx]
+            embedding = embedding / (np.linalg.norm(embedding) + 1e-8)
+        elif self.graph_time[drop_idx] > self.graph_time[keep_idx]:
+            embedding = self.graph_memory[drop_idx]
+        else:
+            embedding = self.graph_memory[keep_idx]
+        self.graph_memory[keep_idx] = embedding
+        self.index.update(keep_idx, self.graph_memory[keep_idx])
+        self.graph_time[keep_idx] = max(self.graph_time[keep_idx], self.graph_time[drop_idx])
+        self.graph_visit[keep_idx] += self.graph_visit[drop_idx]
+        if self.last_localized_node_idx == drop_idx:
+            self.last_localized_node_idx = keep_idx
+            self.last_localized_node_embedding = self.graph_memory[keep_idx]
+        if self.pre_last_localized_node_idx == drop_idx:
+            self.pre_last_localized_node_idx = keep_idx
+        self.remove_node(drop_idx, evicted=False)
+        self.num_merged += 1
+
+    def compact(self):
+        """
+        Merge near-duplicate nodes (see merge_candidates). Every node takes part in at most one merge per pass,
+        the most visited node of a pair is kept. Returns node_remap, the old -> new index table of this pass,
+        which stays valid until the freed indices are reused by the next add_node.
+        """
+        self.node_remap = {}
+        for node_idx_a, node_idx_b in self.merge_candidates():
+            if node_idx_a in self.node_remap or node_idx_b in self.node_remap:
+                continue
+            if self.graph_visit[node_idx_b] > self.graph_visit[node_idx_a]:
+                node_idx_a, node_idx_b = node_idx_b, node_idx_a
+            self.merge_nodes(node_idx_a, node_idx_b)
+            self.node_remap[node_idx_b] = node_idx_a
+            self.node_remap[node_idx_a] = node_idx_a
+        self.node_remap = {old: new for old, new in self.node_remap.items() if old != new}
+        return self.node_remap
+
+    def translate(self, node_indices):
+        """ Translate node indices held from before the last compact() """
+        if np.ndim(node_indices) == 0:
+            return self.node_remap.get(int(node_indices), node_indices)
+        return np.array([self.node_remap.get(int(n), n) for n in node_indices], dtype=np.int64)
+
+    STATE_ARRAYS = ['graph_memory', 'graph_mask', 'graph_time', 'graph_visit']
+    STATE_MATRICES = ['A', 'distance_mat', 'connectivity_mat', 'hop_dist']
+
+    def state_dict(self):
+        """ Copy of the graph, trimmed to the used nodes (see scene_memory.py) """
+        n = self.num_node()
+        state = {key: getattr(self, key)[:n].copy() for key in self.STATE_ARRAYS}
+        state.update({key: getattr(self, key)[:n, :n].copy() for key in self.STATE_MATRICES})
+        state.update({'node_position_list': list(self.node_position_list), 'node_rotation_list': list(self.node_rotation_list),
+                      'free_slots': sorted(self.free_slots), 'hop_dirty': self.hop_dirty})
+        return state
+
+    def load_state_dict(self, state):
+        self.reset()
+        n = len(state['node_position_list'])
+        self.reserve(n)
+        for key in self.STATE_ARRAYS:
+            getattr(self, key)[:n] = state[key]
+        for key in self.STATE_MATRICES:
+            getattr(self, key)[:n, :n] = state[key]
+        self.node_position_list = list(state['node_position_list'])
+        self.node_rotation_list = list(state['node_rotation_list'])
+        self.free_slots = set(state['free_slots'])
+        self.hop_dirty = state['hop_dirty']
+        for node_idx in np.where(self.graph_mask[:n] == 1)[0]:
+            self.index.add(node_idx, self.graph_memory[node_idx].astype(np.float32))
+
+    def stats(self):
+        num_nodes = int(self.graph_mask.sum())
+        return {'num_nodes': num_nodes, 'num_slots': self.num_node(), 'capacity': self.capacity, 'budget': self.M,
+                'occupancy': num_nodes / self.M, 'num_edges': int(self.A.sum()) // 2,
+                'num_grown': self.num_grown, 'num_evicted': self.num_evicted, 'num_merged': self.num_merged}
+
     def initialize_graph(self, new_embeddings, positions, rotations):
         self.add_node(node_idx=0, embedding=new_embeddings, time_step=0, position=positions, rotation=rotations)
         self.record_localized_state(node_idx=0, embedding=new_embeddings)
 
     def add_node(self, node_idx, embedding, time_step, position, rotation, dists=None, connectivity=None):
-        self.node_position_list.append(position)
-        self.node_rotation_list.append(rotation)
+        self.reserve(node_idx + 1)
+        if node_idx < self.num_node():
+            self.node_position_list[node_idx] = position
+            self.node_rotation_list[node_idx] = rotation
+        else:
+            self.node_position_list.append(position)
+            self.node_rotation_list.append(rotation)
         self.graph_memory[node_idx] = embedding
         self.graph_mask[node_idx] = 1.0
         self.graph_time[node_idx] = time_step
+        self.graph_visit[node_idx] = 1
+        self.dirty_nodes.add(int(node_idx))
+        self.index.add(node_idx, embedding)
+        self.hop_dist[node_idx, :] = HOP_INF
+        self.hop_dist[:, node_idx] = HOP_INF
+        self.hop_dist[node_idx, node_idx] = 0
         if dists is not None:
             self.distance_mat[node_idx, :node_idx] = dists
             self.distance_mat[:node_idx, node_idx] = dists
@@ -55,11 +311,203 @@ class ImgGraph(object):
     def add_edge(self, node_idx_a, node_idx_b):
         self.A[node_idx_a, node_idx_b] = True
         self.A[node_idx_b, node_idx_a] = True
+        self.dirty_edges.add((min(int(node_idx_a), int(node_idx_b)), max(int(node_idx_a), int(node_idx_b))))
+        if not self.hop_dirty:
+            self.relax_hop_dist(int(node_idx_a), int(node_idx_b))
 
     def update_node(self, node_idx, time_info, embedding=None):
         if embedding is not None:
             self.graph_memory[node_idx] = embedding
+            self.index.update(node_idx, embedding)
         self.graph_time[node_idx] = time_info
+        self.graph_visit[node_idx] += 1
+        self.dirty_nodes.add(int(node_idx))
+
+    def relax_hop_dist(self, node_idx_a, node_idx_b):
+        """
+        Update the all-pairs hop distances for a new edge (a, b). A path u..v can only get shorter through a..b
+        if u is closer to a than to b, so only those rows (and symmetrically those columns) are relaxed.
+        """
+        if node_idx_a == node_idx_b:
+            return
+        n = self.num_node()
+        D = self.hop_dist
+        for src, dst in [(node_idx_a, node_idx_b), (node_idx_b, node_idx_a)]:
+            rows = np.where(D[:n, src] + 1 < D[:n, dst])[0]
+            if len(rows) == 0:
+                continue
+            relaxed = np.minimum(D[rows, :n], D[rows, src][:, None] + 1 + D[dst, :n][None])
+            D[rows, :n] = relaxed
+            D[:n, rows] = relaxed.T
+
+    def rebuild_hop_dist(self):
+        """ All-pairs hop distances from scratch with a BFS from every node, after edges were removed """
+        n = self.num_node()
+        A = self.A[:n, :n].astype(bool)
+        D = np.full([n, n], fill_value=HOP_INF, dtype=np.int32)
+        live = self.graph_mask[:n] == 1
+        frontier = np.diag(live)
+        visited = frontier.copy()
+        hop = 0
+        while frontier.any():
+            D[frontier] = hop
+            frontier = (np.matmul(frontier.astype(np.float32), A.astype(np.float32)) > 0) & ~visited
+            visited |= frontier
+            hop += 1
+        self.hop_dist[:] = HOP_INF
+        self.hop_dist[:n, :n] = D
+        self.hop_dirty = False
+
+    def get_hop_dist(self):
+        """ (num_node, num_node) hop distances, HOP_INF between disconnected nodes """
+        if self.hop_dirty:
+            self.rebuild_hop_dist()
+        n = self.num_node()
+        return self.hop_dist[:n, :n]
+
+    def khop_mask(self, node_indices, k):
+        """ Mask of the nodes that are at most k hops away from any of the given nodes """
+        return (self.get_hop_dist()[np.atleast_1d(node_indices)] <= k).any(0)
+
+    def calculate_multihop(self, hop):
+        """ (num_node, num_node) adjacency of the nodes that are at most `hop` hops apart """
+        return (self.get_hop_dist() <= hop).astype(np.float32)
+
+    def shortest_path(self, node_idx_a, node_idx_b):
+        """ Node indices of a shortest hop path from a to b (both included), None if they are not connected """
+        D = self.get_hop_dist()
+        if D[node_idx_a, node_idx_b] >= HOP_INF:
+            return None
+        path = [int(node_idx_a)]
+        while path[-1] != node_idx_b:
+            neighbors = np.where(self.A[path[-1], :len(D)])[0]
+            path.append(int(neighbors[np.argmin(D[neighbors, node_idx_b])]))
+        return path
+
+    def localize(self, embedding, k=None, exclude=None):
+        """
+        Rank the memory nodes by cosine similarity to the embedding.
+        Only the nodes that are closer than node_th are returned, best first.
+        """
+        node_indices, scores = self.index.search(embedding, self.topk if k is None else k, exclude=exclude)
+        close = scores > self.node_th
+        return node_indices[close], scores[close]
+
+
+class SparseAdjacency(object):
+    """
+    Boolean (num_rows, num_cols) adjacency stored as adjacency sets in both directions.
+    Adding or removing an edge is O(1). The dense matrix is only built when todense() is called,
+    and later calls only rewrite the rows that changed since the previous one.
+    """
+    def __init__(self, num_rows, num_cols, dtype=bool):
+        self.shape = (num_rows, num_cols)
+        self.dtype = dtype
+        self.reset()
+
+    def reset(self):
+        self.row_to_cols = {}
+        self.col_to_rows = {}
+        self.num_edges = 0
+        self._dense = None
+        self._dirty_rows = set()
+
+    def add_edge(self, row, col):
+        row, col = int(row), int(col)
+        cols = self.row_to_cols.setdefault(row, set())
+        if col not in cols:
+            cols.add(col)
+            self.col_to_rows.setdefault(col, set()).add(row)
+            self.num_edges += 1
+            self._dirty_rows.add(row)
+
+    def clear_row(self, row):
+        row = int(row)
+        for col in self.row_to_cols.pop(row, ()):
+            self.col_to_rows[col].discard(row)
+            self.num_edges -= 1
+        self._dirty_rows.add(row)
+
+    def rows_of(self, cols):
+        """ Sorted indices of the rows connected to any of the given columns """
+        rows = set()
+        for col in np.atleast_1d(cols):
+            rows.update(self.col_to_rows.get(int(col), ()))
+        return np.array(sorted(rows), dtype=np.int64)
+
+    def cols_of(self, row):
+        return np.array(sorted(self.row_to_cols.get(int(row), ())), dtype=np.int64)
+
+    def edges(self):
+        """ Edge list as (rows, cols) arrays """
+        edges = [(row, col) for row, cols in self.row_to_cols.items() for col in cols]
+        if len(edges) == 0:
+            return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.int64)
+        rows, cols = np.array(edges, dtype=np.int64).T
+        return rows, cols
+
+    def todense(self):
+        if self._dense is None:
+            self._dense = np.zeros(self.shape, dtype=self.dtype)
+        for row in self._dirty_rows:
+            self._dense[row] = 0
+            self._dense[row, list(self.row_to_cols.get(row, ()))] = 1
+        self._dirty_rows = set()
+        return self._dense
+
+
+class SpatialHash(object):
+    """
+    Uniform grid over world positions, keyed by the quantized xyz.
+    A radius query only visits the cells overlapping the query ball, so its cost depends on the local density
+    of the points and not on their total number.
+    """
+    def __init__(self, cell_size=1.0):
+        self.cell_size = cell_size
+        self.reset()
+
+    def reset(self):
+        self.cells = {}  # cell -> indices of the points in it
+        self.positions = {}  # index -> position
+
+    def __len__(self):
+        return len(self.positions)
+
+    def cell_of(self, position):
+        return tuple(np.floor(np.asarray(position, dtype=np.float64) / self.cell_size).astype(np.int64).tolist())
+
+    def insert(self, idx, position):
+        idx = int(idx)
+        self.remove(idx)
+        position = np.asarray(position, dtype=np.float64).reshape(-1)
+        self.positions[idx] = position
+        self.cells.setdefault(self.cell_of(position), set()).add(idx)
+
+    def remove(self, idx):
+        idx = int(idx)
+        if idx in self.positions:
+            cell = self.cell_of(self.positions.pop(idx))
+            self.cells[cell].discard(idx)
+            if len(self.cells[cell]) == 0:
+                del self.cells[cell]
+
+    def query(self, position, radius):
+        """ Sorted indices of the points within radius of position """
+        position = np.asarray(position, dtype=np.float64).reshape(-1)
+        lo = np.floor((position - radius) / self.cell_size).astype(np.int64)
+        hi = np.floor((position + radius) / self.cell_size).astype(np.int64)
+        found = []
+        for cell in itertools.product(*[range(l, h + 1) for l, h in zip(lo, hi)]):
+            for idx in self.cells.get(cell, ()):
+                if np.sum((self.positions[idx] - position) ** 2) <= radius ** 2:
+                    found.append(idx)
+        return np.array(sorted(found), dtype=np.int64)
+
+    def within(self, indices, positions, radius):
+        """ (len(indices), len(positions)) mask of the stored points within radius of each position """
+        stored = np.array([self.positions[int(idx)] for idx in indices]).reshape(len(indices), -1)
+        positions = np.asarray(positions, dtype=np.float64).reshape(len(positions), -1)
+        return np.sum((stored[:, None] - positions[None]) ** 2, -1) <= radius ** 2
 
 
 class ObjGraph(object):
@@ -71,54 +519,218 @@ class ObjGraph(object):
         self.feature_dim = cfg.features.object_feature_dim
         self.M = (cfg.TASK_CONFIG.ENVIRONMENT.MAX_EPISODE_STEPS * cfg.memory.num_objects) // 2
         self.MV = cfg.memory.memory_size
+        self.dtypes = get_memory_dtypes(cfg)
+        self.initial_capacity = min(cfg.memory.initial_obj_memory_size or self.M, self.M)
+        self.eviction = cfg.memory.eviction
+        if self.eviction not in EVICTION_POLICIES:
+            raise ValueError("Unknown eviction policy {}. Choose from {}".format(self.eviction, EVICTION_POLICIES))
         self.num_obj = cfg.memory.num_objects
         self.sparse = cfg.OBJECTGRAPH.SPARSE
         self.node_th = cfg.TASK_CONFIG.obj_node_th
+        self.position_radius = cfg.memory.obj_position_radius
+        self.position_cell_size = cfg.memory.obj_position_cell_size
 
     def num_node(self):
         return len(self.node_position_list)
 
     def reset(self):
         self.node_position_list = []  # This position list is only for visualizations
-        self.graph_memory = np.zeros([self.M, self.feature_dim])
-        self.graph_category = np.zeros([self.M])
-        self.graph_score = np.zeros([self.M])
-        self.A_OV = np.zeros([self.M, self.MV], dtype=np.bool)
-        self.graph_mask = np.zeros(self.M)
-        self.graph_time = np.zeros([self.M], dtype=np.int32)
+        self.capacity = self.initial_capacity
+        self.graph_memory = np.zeros([self.capacity, self.feature_dim], dtype=self.dtypes['embedding'])
+        self.graph_category = np.zeros([self.capacity], dtype=self.dtypes['score'])
+        self.graph_score = np.zeros([self.capacity], dtype=self.dtypes['score'])
+        self.A_OV_sparse = SparseAdjacency(self.M, self.MV, dtype=self.dtypes['adjacency'])
+        self.category_index = {}  # category -> indices of the objects of that category
+        self.position_index = SpatialHash(self.position_cell_size)  # world positions of the objects
+        self.graph_mask = np.zeros(self.capacity, dtype=self.dtypes['adjacency'])
+        self.graph_time = np.zeros([self.capacity], dtype=self.dtypes['time'])
+        self.graph_visit = np.zeros([self.capacity], dtype=np.int32)
+        self.free_slots = set()  # indices of the evicted objects, reused before growing
+        self.num_grown = 0
+        self.num_evicted = 0
+        self.reset_dirty()
         self.last_localized_node_idx = 0
 
+    def reset_dirty(self):
+        """ Start a new delta: forget the changed objects, see env_utils/graph_delta.py """
+        self.dirty_nodes = set()  # objects whose arrays or row of A_OV changed
+
+    @property
+    def A_OV(self):
+        """ Dense (M, MV) object-visual adjacency, densified lazily from A_OV_sparse """
+        return self.A_OV_sparse.todense()
+
+    def objects_of(self, vis_node_indices):
+        """ Sorted indices of the objects attached to any of the given image nodes """
+        return self.A_OV_sparse.rows_of(vis_node_indices)
+
+    def objects_near(self, positions, radius=None):
+        """ Sorted indices of the objects within radius (memory.obj_position_radius by default) of any of the positions """
+        radius = self.position_radius if radius is None else radius
+        node_indices = [self.position_index.query(position, radius) for position in positions]
+        if len(node_indices) == 0:
+            return np.zeros([0], dtype=np.int64)
+        return np.unique(np.concatenate(node_indices))
+
+    def reserve(self, num):
+        """ Grow the arrays by doubling until they can hold num objects """
+        if num <= self.capacity:
+            return
+        if num > self.M:
+            raise ValueError("Object graph node {} exceeds the memory budget {}".format(num - 1, self.M))
+        capacity = self.capacity
+        while capacity < num:
+            capacity = min(2 * capacity, self.M)
+        self.graph_memory = resize_array(self.graph_memory, capacity)
+        self.graph_category = resize_array(self.graph_category, capacity)
+        self.graph_score = resize_array(self.graph_score, capacity)
+        self.graph_mask = resize_array(self.graph_mask, capacity)
+        self.graph_time = resize_array(self.graph_time, capacity)
+        self.graph_visit = resize_array(self.graph_visit, capacity)
+        self.capacity = capacity
+        self.num_grown += 1
+
+    def allocate_nodes(self, num, protect=()):
+        """
+        Indices for num new objects: free slots first, then the next indices while under the budget,
+        then the slots of objects evicted with the eviction policy (never one of the protected objects).
+        """
+        node_indices = sorted(self.free_slots)[:num]
+        self.free_slots.difference_update(node_indices)
+        num_new = min(num - len(node_indices), self.M - self.num_node())
+        node_indices.extend(range(self.num_node(), self.num_node() + num_new))
+        num_evict = num - len(node_indices)
+        if num_evict > 0:
+            victims = select_eviction_victims(self.eviction, self.graph_mask, self.graph_time, self.graph_visit, num_evict, protect)
+            self.remove_nodes(victims)
+            self.free_slots.difference_update(victims.tolist())
+            node_indices.extend(victims.tolist())
+        return np.array(node_indices, dtype=np.int64)
+
+    def remove_nodes(self, node_indices):
+        node_indices = np.asarray(node_indices, dtype=np.int64)
+        for node_idx, category in zip(node_indices, self.graph_category[node_indices]):
+            self.category_index[float(category)].discard(int(node_idx))
+            self.position_index.remove(node_idx)
+            self.A_OV_sparse.clear_row(node_idx)
+        self.graph_memory[node_indices] = 0
+        self.graph_category[node_indices] = 0
+        self.graph_score[node_indices] = 0
+        self.graph_mask[node_indices] = 0
+        self.graph_time[node_indices] = 0
+        self.graph_visit[node_indices] = 0
+        self.dirty_nodes.update(node_indices.tolist())
+        self.free_slots.update(node_indices.tolist())
+        self.num_evicted += len(node_indices)
+
+    def remove_vis_node(self, vis_node_idx):
+        """ Remove the objects attached to an image node that was evicted from the image graph """
+        self.remove_nodes(self.objects_of(vis_node_idx))
+
+    def remap_vis_nodes(self, node_remap):
+        """ Re-attach the objects of merged image nodes to the nodes they were merged into (see ImgGraph.compact) """
+        for old_vis_node_idx, new_vis_node_idx in node_remap.items():
+            for node_idx in self.objects_of(old_vis_node_idx):
+                self.A_OV_sparse.clear_row(node_idx)
+                self.A_OV_sparse.add_edge(node_idx, new_vis_node_idx)
+                self.dirty_nodes.add(int(node_idx))
+
+    STATE_ARRAYS = ['graph_memory', 'graph_category', 'graph_score', 'graph_mask', 'graph_time', 'graph_visit']
+
+    def state_dict(self):
+        """ Copy of the graph, trimmed to the used nodes (see scene_memory.py) """
+        n = self.num_node()
+        state = {key: getattr(self, key)[:n].copy() for key in self.STATE_ARRAYS}
+        state['A_OV_edges'] = self.A_OV_sparse.edges()
+        state.update({'node_position_list': list(self.node_position_list), 'free_slots': sorted(self.free_slots)})
+        return state
+
+    def load_state_dict(self, state):
+        self.reset()
+        n = len(state['node_position_list'])
+        self.reserve(n)
+        for key in self.STATE_ARRAYS:
+            getattr(self, key)[:n] = state[key]
+        self.node_position_list = list(state['node_position_list'])
+        self.free_slots = set(state['free_slots'])
+        for node_idx, vis_node_idx in zip(*state['A_OV_edges']):
+            self.A_OV_sparse.add_edge(node_idx, vis_node_idx)
+        for node_idx in np.where(self.graph_mask[:n] == 1)[0]:
+            self.category_index.setdefault(float(self.graph_category[node_idx]), set()).add(int(node_idx))
+            self.position_index.insert(node_idx, self.node_position_list[node_idx])
+
+    def stats(self):
+        num_nodes = int(self.graph_mask.sum())
+        return {'num_nodes': num_nodes, 'num_slots': self.num_node(), 'capacity': self.capacity, 'budget': self.M,
+                'occupancy': num_nodes / self.M, 'num_edges': self.A_OV_sparse.num_edges,
+                'num_grown': self.num_grown, 'num_evicted': self.num_evicted}
+
     def initialize_graph(self, new_embeddings, object_scores, object_categories, masks, positions):
         if sum(masks == 1) == 0:
             masks[0] = 1
         self.add_node(node_idx=0, embedding=new_embeddings, object_score=object_scores, object_category=object_categories, time_step=0, mask=masks, position=positions, vis_node_idx=0)
 
+    def objects_of_category(self, categories):
+        """ Sorted indices of the objects whose category is one of the given categories """
+        node_indices = set()
+        for category in np.unique(categories):
+            node_indices.update(self.category_index.get(float(category), ()))
+        return np.array(sorted(node_indices), dtype=np.int64)
+
     def add_node(self, node_idx, embedding, object_score, object_category, mask, time_step, position, vis_node_idx):
-        node_idx_ = node_idx
-        i = 0
-        while True:
-            if mask[i] == 1:
-                self.node_position_list.append(position[i])
-                self.graph_memory[node_idx_] = embedding[i]
-                self.graph_score[node_idx_] = object_score[i]
-                self.graph_category[node_idx_] = object_category[i]
-                self.graph_mask[node_idx_] = 1.0
-                self.graph_time[node_idx_] = time_step
-                self.add_vo_edge([node_idx_], vis_node_idx)
-                node_idx_ += 1
-            i += 1
-            if i == len(position):
-                break
+        keep = np.where(np.asarray(mask) == 1)[0]
+        self.add_nodes(np.arange(node_idx, node_idx + len(keep)), embedding[keep], object_score[keep], object_category[keep],
+                       time_step, [position[i] for i in keep], vis_node_idx)
+
+    def add_nodes(self, node_indices, embeddings, object_scores, object_categories, time_step, positions, vis_node_idx):
+        """
+        Add the objects as the nodes node_indices (see allocate_nodes) attached to the image node vis_node_idx
+        """
+        node_indices = np.asarray(node_indices, dtype=np.int64)
+        if len(node_indices) == 0:
+            return
+        self.reserve(int(node_indices.max()) + 1)
+        for node_idx, position in zip(node_indices, positions):
+            if node_idx < self.num_node():
+                self.node_position_list[node_idx] = position
+            else:
+                self.node_position_list.append(position)
+            self.position_index.insert(node_idx, position)
+        self.graph_memory[node_indices] = embeddings
+        self.graph_score[node_indices] = object_scores
+        self.graph_category[node_indices] = object_categories
+        self.graph_mask[node_indices] = 1.0
+        self.graph_time[node_indices] = time_step
+        self.graph_visit[node_indices] = 1
+        self.dirty_nodes.update(node_indices.tolist())
+        for node_idx_i, category in zip(node_indices, self.graph_category[node_indices]):
+            self.category_index.setdefault(float(category), set()).add(int(node_idx_i))
+        self.add_vo_edge(node_indices, vis_node_idx)
 
     def add_vo_edge(self, node_idx_obj, curr_vis_node_idx):
         for node_idx_obj_i in node_idx_obj:
-            self.A_OV[node_idx_obj_i, curr_vis_node_idx] = True
+            self.A_OV_sparse.add_edge(node_idx_obj_i, curr_vis_node_idx)
+            self.dirty_nodes.add(int(node_idx_obj_i))
 
     def update_node(self, node_idx, time_info, node_score, node_category, curr_vis_node_idx, embedding=None):
-        if embedding is not None:
-            self.graph_memory[node_idx] = embedding
-        self.graph_score[node_idx] = node_score
-        self.graph_category[node_idx] = node_category
-        self.graph_time[node_idx] = time_info
-        self.A_OV[node_idx, :] = False
-        self.A_OV[node_idx, curr_vis_node_idx] = True
\ No newline at end of file
+        self.update_nodes([node_idx], time_info, [node_score], [node_category], curr_vis_node_idx, None if embedding is None else embedding[None])
+
+    def update_nodes(self, node_indices, time_info, node_scores, node_categories, curr_vis_node_idx, embeddings=None):
+        """
+        Overwrite the given objects with new detections and re-attach them to the image node curr_vis_node_idx
+        """
+        node_indices = np.asarray(node_indices, dtype=np.int64)
+        if embeddings is not None:
+            self.graph_memory[node_indices] = embeddings
+        for node_idx, old_category, new_category in zip(node_indices, self.graph_category[node_indices], node_categories):
+            if old_category != new_category:
+                self.category_index[float(old_category)].discard(int(node_idx))
+                self.category_index.setdefault(float(new_category), set()).add(int(node_idx))
+        self.graph_score[node_indices] = node_scores
+        self.graph_category[node_indices] = node_categories
+        self.graph_time[node_indices] = time_info
+        self.graph_visit[node_indices] += 1
+        self.dirty_nodes.update(node_indices.tolist())
+        for node_idx in node_indices:
+            self.A_OV_sparse.clear_row(node_idx)
+            self.A_OV_sparse.add_edge(node_idx, curr_vis_node_idx)
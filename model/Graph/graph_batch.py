@@ -0,0 +1,319 @@
+import torch
+
+
+class BatchedImgGraph(object):
+    """
+    Image graphs of B environments stored in preallocated [B, M, ...] tensors.
+    Every method takes a vector of env indices (`envs`) and the per-env arguments stacked along the first dim,
+    so all environments are updated at once. Nodes that do not fit in M are not added.
+    """
+    def __init__(self, cfg, B, device='cpu'):
+        self.B = B
+        self.feature_dim = cfg.memory.img_embedding_dim
+        self.M = cfg.memory.memory_size
+        self.node_th = cfg.TASK_CONFIG.img_node_th
+        self.topk = cfg.memory.localization_topk
+        self.torch_device = device
+
+    def num_node(self, b=None):
+        if b is None:
+            return self.num_nodes
+        return int(self.num_nodes[b])
+
+    def num_node_max(self):
+        return max(int(self.num_nodes.max()), 1)
+
+    def reset(self, B=None):
+        if B: self.B = B
+        self.graph_memory = torch.zeros([self.B, self.M, self.feature_dim], device=self.torch_device)
+        self.graph_pose = torch.zeros([self.B, self.M, 3], device=self.torch_device)
+        self.A = torch.zeros([self.B, self.M, self.M], dtype=torch.bool, device=self.torch_device)
+        self.graph_mask = torch.zeros([self.B, self.M], device=self.torch_device)
+        self.graph_time = torch.zeros([self.B, self.M], device=self.torch_device)
+        self.num_nodes = torch.zeros([self.B], dtype=torch.long, device=self.torch_device)
+        self.pre_last_localized_node_idx = torch.zeros([self.B], dtype=torch.long, device=self.torch_device)
+        self.last_localized_node_idx = torch.zeros([self.B], dtype=torch.long, device=self.torch_device)
+        self.last_localized_node_embedding = torch.zeros([self.B, self.feature_dim], device=self.torch_device)
+        self.found = torch.ones([self.B], dtype=torch.bool, device=self.torch_device)
+
+    def reset_at(self, envs):
+        self.graph_memory[envs] = 0
+        self.graph_pose[envs] = 0
+        self.A[envs] = False
+        self.graph_mask[envs] = 0
+        self.graph_time[envs] = 0
+        self.num_nodes[envs] = 0
+        self.pre_last_localized_node_idx[envs] = 0
+        self.last_localized_node_idx[envs] = 0
+        self.last_localized_node_embedding[envs] = 0
+        self.found[envs] = True
+
+    def initialize_graph(self, envs, new_embeddings, positions):
+        node_idx = self.add_node(envs, new_embeddings, torch.zeros(len(envs), device=self.torch_device), positions)
+        self.record_localized_state(envs, node_idx, new_embeddings)
+
+    def add_node(self, envs, embeddings, time_step, positions):
+        """
+        Append one node to each graph in envs. Returns the index of the new nodes
+        (the last localized node for the graphs that are full).
+        """
+        node_idx = self.num_nodes[envs]
+        keep = node_idx < self.M
+        envs_, node_idx_ = envs[keep], node_idx[keep]
+        self.graph_memory[envs_, node_idx_] = embeddings[keep].to(self.graph_memory.dtype)
+        self.graph_pose[envs_, node_idx_] = positions[keep].to(self.graph_pose.dtype)
+        self.graph_mask[envs_, node_idx_] = 1.0
+        self.graph_time[envs_, node_idx_] = time_step[keep].to(self.graph_time.dtype)
+        self.num_nodes[envs_] += 1
+        return torch.where(keep, node_idx, self.last_localized_node_idx[envs])
+
+    def record_localized_state(self, envs, node_indices, embeddings):
+        self.pre_last_localized_node_idx[envs] = self.last_localized_node_idx[envs]
+        self.last_localized_node_idx[envs] = node_indices
+        self.last_localized_node_embedding[envs] = embeddings.to(self.last_localized_node_embedding.dtype)
+
+    def add_edge(self, envs, node_idx_a, node_idx_b):
+        keep = node_idx_a != node_idx_b
+        envs, node_idx_a, node_idx_b = envs[keep], node_idx_a[keep], node_idx_b[keep]
+        self.A[envs, node_idx_a, node_idx_b] = True
+        self.A[envs, node_idx_b, node_idx_a] = True
+
+    def update_node(self, envs, node_indices, time_info, embeddings=None):
+        if embeddings is not None:
+            self.graph_memory[envs, node_indices] = embeddings.to(self.graph_memory.dtype)
+        self.graph_time[envs, node_indices] = time_info.to(self.graph_time.dtype)
+
+    def localize(self, embeddings, k=None, exclude=None):
+        """
+        Rank the nodes of every graph by cosine similarity to the [B, D] embeddings with one batched matmul.
+        Returns [B, k] node indices, their similarities and whether they are closer than node_th.
+        """
+        N = self.num_node_max()
+        scores = torch.bmm(self.graph_memory[:, :N], embeddings.unsqueeze(-1).to(self.graph_memory.dtype)).squeeze(-1)
+        scores = scores.masked_fill(self.graph_mask[:, :N] == 0, -float('inf'))
+        if exclude is not None:
+            scores = scores.scatter(1, exclude.view(-1, 1), -float('inf'))
+        k = min(self.topk if k is None else k, N)
+        scores, node_indices = scores.topk(k, dim=1)
+        return node_indices, scores, scores > self.node_th
+
+    def get_img_memory(self):
+        img_memory_dict = {
+            'img_memory_feat': self.graph_memory,
+            'img_memory_mask': self.graph_mask,
+            'img_memory_A': self.A,
+            'img_memory_idx': self.last_localized_node_idx,
+            'img_memory_time': self.graph_time
+        }
+        return img_memory_dict
+
+
+class BatchedObjGraph(object):
+    """
+    Object graphs of B environments stored in preallocated [B, M, ...] tensors. See BatchedImgGraph.
+    """
+    def __init__(self, cfg, B, device='cpu'):
+        self.B = B
+        self.feature_dim = cfg.features.object_feature_dim
+        self.M = (cfg.TASK_CONFIG.ENVIRONMENT.MAX_EPISODE_STEPS * cfg.memory.num_objects) // 2
+        self.MV = cfg.memory.memory_size
+        self.num_obj = cfg.memory.num_objects
+        self.sparse = cfg.OBJECTGRAPH.SPARSE
+        self.node_th = cfg.TASK_CONFIG.obj_node_th
+        self.torch_device = device
+
+    def num_node(self, b=None):
+        if b is None:
+            return self.num_nodes
+        return int(self.num_nodes[b])
+
+    def num_node_max(self):
+        return max(int(self.num_nodes.max()), 1)
+
+    def reset(self, B=None):
+        if B: self.B = B
+        self.graph_memory = torch.zeros([self.B, self.M, self.feature_dim], device=self.torch_device)
+        self.graph_pose = torch.zeros([self.B, self.M, 3], device=self.torch_device)
+        self.graph_category = torch.zeros([self.B, self.M], device=self.torch_device)
+        self.graph_score = torch.zeros([self.B, self.M], device=self.torch_device)
+        self.A_OV = torch.zeros([self.B, self.M, self.MV], dtype=torch.bool, device=self.torch_device)
+        self.graph_mask = torch.zeros([self.B, self.M], device=self.torch_device)
+        self.graph_time = torch.zeros([self.B, self.M], dtype=torch.int32, device=self.torch_device)
+        self.num_nodes = torch.zeros([self.B], dtype=torch.long, device=self.torch_device)
+        self.last_localized_node_idx = torch.zeros([self.B], dtype=torch.long, device=self.torch_device)
+
+    def reset_at(self, envs):
+        self.graph_memory[envs] = 0
+        self.graph_pose[envs] = 0
+        self.graph_category[envs] = 0
+        self.graph_score[envs] = 0
+        self.A_OV[envs] = False
+        self.graph_mask[envs] = 0
+        self.graph_time[envs] = 0
+        self.num_nodes[envs] = 0
+        self.last_localized_node_idx[envs] = 0
+
+    def initialize_graph(self, envs, new_embeddings, object_scores, object_categories, masks, positions):
+        masks = masks.clone()
+        masks[masks.sum(1) == 0, 0] = 1
+        self.add_node(envs, new_embeddings, object_scores, object_categories, masks, torch.zeros(len(envs), device=self.torch_device),
+                      positions, torch.zeros(len(envs), dtype=torch.long, device=self.torch_device))
+
+    def add_node(self, envs, embedding, object_score, object_category, mask, time_step, position, vis_node_idx):
+        """
+        Append the detections with mask == 1 to the graphs in envs.
+        embedding: [n, K, D], object_score/object_category/mask: [n, K], position: [n, K, 3], time_step/vis_node_idx: [n]
+        """
+        valid = mask == 1
+        node_idx = self.num_nodes[envs].unsqueeze(1) + valid.long().cumsum(1) - 1
+        valid = valid & (node_idx < self.M)
+        b, c = torch.where(valid)
+        envs_, node_idx_ = envs[b], node_idx[b, c]
+        self.graph_memory[envs_, node_idx_] = embedding[b, c].to(self.graph_memory.dtype)
+        self.graph_pose[envs_, node_idx_] = position[b, c].to(self.graph_pose.dtype)
+        self.graph_score[envs_, node_idx_] = object_score[b, c].to(self.graph_score.dtype)
+        self.graph_category[envs_, node_idx_] = object_category[b, c].to(self.graph_category.dtype)
+        self.graph_mask[envs_, node_idx_] = 1.0
+        self.graph_time[envs_, node_idx_] = time_step[b].to(self.graph_time.dtype)
+        self.A_OV[envs_, node_idx_, vis_node_idx[b]] = True
+        self.num_nodes[envs] += valid.sum(1)
+
+    def update_node(self, envs, node_idx, time_info, node_score, node_category, curr_vis_node_idx, embedding=None):
+        if embedding is not None:
+            self.graph_memory[envs, node_idx] = embedding.to(self.graph_memory.dtype)
+        self.graph_score[envs, node_idx] = node_score.to(self.graph_score.dtype)
+        self.graph_category[envs, node_idx] = node_category.to(self.graph_category.dtype)
+        self.graph_time[envs, node_idx] = time_info.to(self.graph_time.dtype)
+        self.A_OV[envs, node_idx] = False
+        self.A_OV[envs, node_idx, curr_vis_node_idx] = True
+
+    def object_consistency(self, vis_node_indices, curr_obj_embedding, object_score, object_category):
+        """
+        Batched version of graph_update.is_object_consistent for [B, k] image node indices.
+        Returns a [B, k] mask that is False where the objects of the node are not found among the current detections.
+        """
+        N = self.num_node_max()
+        node_obj = torch.gather(self.A_OV[:, :N], 2, vis_node_indices.unsqueeze(1).expand(-1, N, -1)).permute(0, 2, 1)
+        conf_obj = node_obj & (self.graph_score[:, :N] > 0.5).unsqueeze(1)
+        curr_obj_mask = object_score > 0.5
+        sim = torch.bmm(self.graph_memory[:, :N], curr_obj_embedding.transpose(1, 2).to(self.graph_memory.dtype))
+        close = (sim > self.node_th) & (self.graph_category[:, :N].unsqueeze(2) == object_category.unsqueeze(1)) & curr_obj_mask.unsqueeze(1)
+        num_conf = conf_obj.sum(2)
+        num_matched = (conf_obj & close.any(2).unsqueeze(1)).sum(2)
+        check = (curr_obj_mask.float().mean(1) >= 0.5).unsqueeze(1) & (num_conf >= 3)
+        return ~(check & (num_matched.float() < 0.1 * num_conf.float()))
+
+    def get_obj_memory(self):
+        obj_memory_dict = {
+            'obj_memory_feat': self.graph_memory,
+            'obj_memory_score': self.graph_score,
+            'obj_memory_category': self.graph_category,
+            'obj_memory_mask': self.graph_mask,
+            'obj_memory_A_OV': self.A_OV,
+            'obj_memory_time': self.graph_time
+        }
+        return obj_memory_dict
+
+
+def update_image_graph_batch(imggraph, objgraph, new_embedding, curr_obj_embedding, obs, done):
+    """
+    update_image_graph over all environments at once. obs holds the batched tensors produced by batch_obs.
+    """
+    position, time = obs['position'], obs['step'].view(-1)
+    done = done.to(imggraph.torch_device).bool()
+    if done.any():
+        envs = torch.where(done)[0]
+        imggraph.reset_at(envs)
+        imggraph.initialize_graph(envs, new_embedding[envs], position[envs])
+
+    last = imggraph.last_localized_node_idx.clone()
+    obj_close = objgraph.object_consistency(last.unsqueeze(1), curr_obj_embedding, obs['object_score'], obs['object_category'])[:, 0]
+    close = (imggraph.last_localized_node_embedding * new_embedding).sum(-1) > imggraph.node_th
+    found = (done | close) & obj_close
+    imggraph.found = found
+
+    envs = torch.where(found)[0]
+    imggraph.update_node(envs, last[envs], time[envs])
+
+    # Candidates above the threshold, ranked by similarity. Take the first one whose objects agree with the current view.
+    node_indices, _, close = imggraph.localize(new_embedding, exclude=last)
+    consistent = close & objgraph.object_consistency(node_indices, curr_obj_embedding, obs['object_score'], obs['object_category'])
+    found_node = node_indices.gather(1, consistent.float().argmax(1, keepdim=True)).squeeze(1)
+
+    envs = torch.where(~found & consistent.any(1))[0]
+    imggraph.update_node(envs, found_node[envs], time[envs], new_embedding[envs])
+    imggraph.add_edge(envs, found_node[envs], last[envs])
+    imggraph.record_localized_state(envs, found_node[envs], new_embedding[envs])
+
+    envs = torch.where(~found & ~consistent.any(1))[0]
+    new_node_idx = imggraph.add_node(envs, new_embedding[envs], time[envs], position[envs])
+    imggraph.add_edge(envs, new_node_idx, last[envs])
+    imggraph.record_localized_state(envs, new_node_idx, new_embedding[envs])
+    return imggraph
+
+
+def greedy_match_batch(scores, valid):
+    """
+    graph_update.greedy_match for [B, N, K] score matrices, matching all environments at once.
+    Returns the env, row and column indices of the matched pairs.
+    """
+    B, N, K = scores.shape
+    scores = scores.masked_fill(~valid, -float('inf'))
+    envs, rows, cols = [], [], []
+    for _ in range(min(N, K)):
+        best, flat_idx = scores.view(B, -1).max(1)
+        matched = torch.where(torch.isfinite(best))[0]
+        if len(matched) == 0:
+            break
+        row, col = flat_idx[matched] // K, flat_idx[matched] % K
+        envs.append(matched)
+        rows.append(row)
+        cols.append(col)
+        scores[matched, row, :] = -float('inf')
+        scores[matched, :, col] = -float('inf')
+    if len(envs) == 0:
+        empty = torch.zeros([0], dtype=torch.long, device=scores.device)
+        return empty, empty, empty
+    return torch.cat(envs), torch.cat(rows), torch.cat(cols)
+
+
+def update_object_graph_batch(imggraph, objgraph, object_embedding, obs, done):
+    """
+    update_object_graph over all environments at once. Detections are matched one-to-one to close memory objects
+    of the same category and a lower score, most similar pair first.
+    """
+    object_score, object_category, object_position, time = obs['object_score'], obs['object_category'], obs['object_pose'], obs['step'].view(-1)
+    object_mask = obs['object_mask'] == 1
+    done = done.to(objgraph.torch_device).bool()
+    if done.any():
+        envs = torch.where(done)[0]
+        objgraph.reset_at(envs)
+        objgraph.initialize_graph(envs, object_embedding[envs], object_score[envs], object_category[envs], obs['object_mask'][envs], object_position[envs])
+
+    if objgraph.sparse:
+        not_found = ~imggraph.found
+    else:
+        not_found = ~done
+    if not not_found.any():
+        return objgraph
+
+    B = object_embedding.shape[0]
+    N, NV = objgraph.num_node_max(), imggraph.num_node_max()
+    last = imggraph.last_localized_node_idx
+    neighbor_vis_node = imggraph.A[torch.arange(B), last, :NV].clone()
+    neighbor_vis_node[torch.arange(B), last] = True
+    neighbor_obj_node_mask = torch.bmm(objgraph.A_OV[:, :N, :NV].float(), neighbor_vis_node.float().unsqueeze(-1)).squeeze(-1) > 0
+    neighbor_obj_node_mask = neighbor_obj_node_mask & not_found.unsqueeze(1)
+
+    sim = torch.bmm(objgraph.graph_memory[:, :N], object_embedding.transpose(1, 2).to(objgraph.graph_memory.dtype))
+    close = (sim > objgraph.node_th) & neighbor_obj_node_mask.unsqueeze(2) & object_mask.unsqueeze(1)
+    is_same = close & (objgraph.graph_category[:, :N].unsqueeze(2) == object_category.unsqueeze(1)) & (object_category != -1).unsqueeze(1)
+    to_add = object_mask & ~is_same.any(1) & not_found.unsqueeze(1)
+
+    to_update = is_same & (object_score.unsqueeze(1) > objgraph.graph_score[:, :N].unsqueeze(2))
+    envs, node_idx, det_idx = greedy_match_batch(sim, to_update)
+    objgraph.update_node(envs, node_idx, time[envs], object_score[envs, det_idx], object_category[envs, det_idx], last[envs], object_embedding[envs, det_idx])
+
+    envs = torch.where(to_add.any(1))[0]
+    objgraph.add_node(envs, object_embedding[envs], object_score[envs], object_category[envs], to_add[envs].float(), time[envs], object_position[envs], last[envs])
+    return objgraph
@@ -0,0 +1,156 @@
+import os
+import numpy as np
+import torch
+import torch.nn as nn
+# from model.Graph.resnet_img import resnet18 as resnet18_img
+from torchvision.models import resnet18 as resnet18_img
+from model.Graph.resnet_obj import resnet18 as resnet18_obj
+from model.Graph.graph import ImgGraph, ObjGraph
+from model.Graph.graph_update import update_image_graph, update_object_graph, relocalize
+project_dir = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+class GraphBuilder(object):
+    """
+    Image and object graphs of an episode, built from its observations.
+    Holds the image/object encoders and runs update_image_graph/update_object_graph on their embeddings.
+    Only needs torch and numpy, so recorded episodes can be turned into graphs without a simulator (see collect_graph.py).
+    ImageGoalGraphEnv builds its graphs with it as well.
+    """
+    def __init__(self, config, torch_device='cpu'):
+        self.feature_dim = config.memory.img_embedding_dim
+        self.object_feature_dim = config.features.object_feature_dim
+        self.torch_device = torch_device
+        self.dn = config.TASK_CONFIG.DATASET.DATASET_NAME.split("_")[0]
+        self.imggraph = ImgGraph(config)
+        self.objgraph = ObjGraph(config)
+        # Loaded on first use, so that a run whose embeddings are all cached never loads them
+        self._img_encoder = None
+        self._obj_encoder = None
+        self.mean = torch.tensor(IMAGENET_MEAN, device=self.torch_device).view(1, 3, 1, 1)
+        self.std = torch.tensor(IMAGENET_STD, device=self.torch_device).view(1, 3, 1, 1)
+        self.reset()
+
+    def reset(self):
+        self.imggraph.reset()
+        self.objgraph.reset()
+
+    @property
+    def img_encoder(self):
+        if self._img_encoder is None:
+            self._img_encoder = self.load_img_encoder(self.feature_dim)
+        return self._img_encoder
+
+    @property
+    def obj_encoder(self):
+        if self._obj_encoder is None:
+            self._obj_encoder = self.load_obj_encoder(self.object_feature_dim)
+        return self._obj_encoder
+
+    def encoder_checkpoint(self, name):
+        return os.path.join(project_dir, 'data/graph', self.dn, name)
+
+    def load_img_encoder(self, feature_dim):
+        img_encoder = resnet18_img(num_classes=feature_dim)
+        dim_mlp = img_encoder.fc.weight.shape[1]
+        img_encoder.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), img_encoder.fc)
+        ckpt_pth = self.encoder_checkpoint('Img_encoder.pth.tar')
+        ckpt = torch.load(ckpt_pth, map_location='cpu')
+        state_dict = {k[len('module.encoder_q.'):]: v for k, v in ckpt['state_dict'].items() if 'module.encoder_q.' in k}
+        img_encoder.load_state_dict(state_dict)
+        img_encoder.eval().to(self.torch_device)
+        return img_encoder
+
+    def load_obj_encoder(self, feature_dim):
+        obj_encoder = resnet18_obj(num_classes=feature_dim)
+        dim_mlp = obj_encoder.fc.weight.shape[1]
+        obj_encoder.fc = nn.Sequential(nn.Linear(dim_mlp, dim_mlp), nn.ReLU(), obj_encoder.fc)
+        ckpt_pth = self.encoder_checkpoint('Obj_encoder.pth.tar')
+        ckpt = torch.load(ckpt_pth, map_location='cpu')
+        state_dict = {k[len('module.encoder_q.'):]: v for k, v in ckpt['state_dict'].items() if 'module.encoder_q.' in k}
+        obj_encoder.load_state_dict(state_dict)
+        obj_encoder.eval().to(self.torch_device)
+        return obj_encoder
+
+    def embed_obs(self, obs):
+        return self.embed_obs_batch(obs['panoramic_rgb'][None])[0]
+
+    def embed_target(self, obs):
+        with torch.no_grad():
+            img_tensor = obs['target_goal'][...,:3].permute(0, 3, 1, 2)
+            img_embedding = nn.functional.normalize(self.img_encoder(img_tensor).view(-1, self.feature_dim), dim=1)
+        return img_embedding[0].cpu().detach().numpy()
+
+    def embed_object(self, obs):
+        return self.embed_object_batch(obs['panoramic_rgb'][None], obs['object'][None])[0]
+
+    def embed_obs_batch(self, rgb, batch_size=64):
+        """ Image embeddings of the frames rgb (T, H, W, 3), batch_size frames per encoder call """
+        img_embeddings = []
+        with torch.no_grad():
+            for i in range(0, len(rgb), batch_size):
+                img_tensor = (torch.tensor(rgb[i:i + batch_size]).to(self.torch_device).float() / 255).permute(0, 3, 1, 2)
+                img_embedding = nn.functional.normalize(self.img_encoder(img_tensor).view(-1, self.feature_dim), dim=1)
+                img_embeddings.append(img_embedding.cpu().numpy())
+        return np.concatenate(img_embeddings)
+
+    def embed_object_batch(self, rgb, objects, batch_size=64):
+        """ Object embeddings of the frames rgb (T, H, W, 3) and their boxes objects (T, num_objects, 5) """
+        obj_embeddings = []
+        with torch.no_grad():
+            for i in range(0, len(rgb), batch_size):
+                # ToTensor + Normalize of the uint8 frames
+                img_tensor = torch.tensor(np.uint8(rgb[i:i + batch_size])).to(self.torch_device).permute(0, 3, 1, 2).float() / 255
+                img_tensor = (img_tensor - self.mean) / self.std
+                feat = self.obj_encoder(img_tensor, torch.tensor(objects[i:i + batch_size]).to(self.torch_device).float())
+                obj_embeddings.append(nn.functional.normalize(feat, dim=-1).cpu().numpy())
+        return np.concatenate(obj_embeddings)
+
+    def update(self, obs, reset=False, embeddings=None, state=None):
+        """
+        Add an observation to the graphs. With reset, it starts a new episode, from the saved graphs state if given
+        (see scene_memory.py).
+        embeddings: (image embedding, object embeddings) of the observation if already computed, see embed_obs_batch
+        """
+        if embeddings is None:
+            curr_img_embeddings = self.embed_obs(obs)
+            curr_object_embedding = self.embed_object(obs)
+        else:
+            curr_img_embeddings, curr_object_embedding = embeddings
+        if reset and state is not None:
+            self.imggraph.load_state_dict(state['imggraph'])
+            self.objgraph.load_state_dict(state['objgraph'])
+            # Time steps are relative to the episode. The loaded nodes count as seen at its start.
+            self.imggraph.graph_time[:] = 0
+            self.objgraph.graph_time[:] = 0
+            self.imggraph = relocalize(self.imggraph, self.objgraph, curr_img_embeddings, obs)
+            self.objgraph = update_object_graph(self.imggraph, self.objgraph, curr_object_embedding, obs, done=False)
+        elif reset:
+            self.reset()
+            self.imggraph.initialize_graph(curr_img_embeddings, obs['position'], obs['rotation'])
+            self.objgraph.initialize_graph(curr_object_embedding, obs['object_score'], obs['object_category'], obs['object_mask'], obs['object_pose'])
+        else:
+            self.imggraph = update_image_graph(self.imggraph, self.objgraph, curr_img_embeddings, curr_object_embedding, obs, done=False)
+            self.objgraph = update_object_graph(self.imggraph, self.objgraph, curr_object_embedding, obs, done=False)
+
+    def get_memory(self):
+        """ Memory dict of the graphs, trimmed to their nodes, as saved by collect_graph.py """
+        max_num_img_node = self.imggraph.num_node()
+        max_num_obj_node = self.objgraph.num_node()
+        return {
+            'img_memory_feat': self.imggraph.graph_memory[:max_num_img_node].copy(),
+            'img_memory_pose': np.stack(self.imggraph.node_position_list).astype(np.float32),
+            'img_memory_mask': self.imggraph.graph_mask[:max_num_img_node].copy(),
+            'img_memory_A': self.imggraph.A[:max_num_img_node, :max_num_img_node].copy(),
+            'img_memory_idx': self.imggraph.last_localized_node_idx,
+            'img_memory_time': self.imggraph.graph_time[:max_num_img_node].copy(),
+            'obj_memory_feat': self.objgraph.graph_memory[:max_num_obj_node].copy(),
+            'obj_memory_pose': np.stack(self.objgraph.node_position_list).astype(np.float32),
+            'obj_memory_score': self.objgraph.graph_score[:max_num_obj_node].copy(),
+            'obj_memory_category': self.objgraph.graph_category[:max_num_obj_node].copy(),
+            'obj_memory_mask': self.objgraph.graph_mask[:max_num_obj_node].copy(),
+            'obj_memory_A_OV': self.objgraph.A_OV[:max_num_obj_node, :max_num_img_node].copy(),
+            'obj_memory_time': self.objgraph.graph_time[:max_num_obj_node].copy()
+        }
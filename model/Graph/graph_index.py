@@ -0,0 +1,168 @@
+import numpy as np
+
+
+class FlatIndex(object):
+    """
+    Exact cosine-similarity index over the image graph nodes.
+    Embeddings are assumed to be l2-normalized, so one matmul gives the similarity to every node.
+    """
+    def __init__(self, feature_dim, capacity, **kwargs):
+        self.feature_dim = feature_dim
+        self.capacity = capacity
+
+    def __len__(self):
+        return int(self.valid[:self.num].sum())
+
+    def reset(self, capacity=None):
+        if capacity: self.capacity = capacity
+        self.embeddings = np.zeros([self.capacity, self.feature_dim], dtype=np.float32)
+        self.valid = np.zeros([self.capacity], dtype=bool)
+        self.num = 0  # high-water mark of the node indices that have been added
+
+    def add(self, node_idx, embedding):
+        self.embeddings[node_idx] = embedding
+        self.valid[node_idx] = True
+        self.num = max(self.num, int(node_idx) + 1)
+
+    def update(self, node_idx, embedding):
+        self.embeddings[node_idx] = embedding
+
+    def resize(self, capacity):
+        embeddings = np.zeros([capacity, self.feature_dim], dtype=np.float32)
+        embeddings[:self.num] = self.embeddings[:self.num]
+        valid = np.zeros([capacity], dtype=bool)
+        valid[:self.num] = self.valid[:self.num]
+        self.embeddings, self.valid, self.capacity = embeddings, valid, capacity
+
+    def remove(self, node_idx):
+        self.valid[node_idx] = False
+
+    def scores(self, query, candidates=None):
+        if candidates is None:
+            return np.matmul(self.embeddings[:self.num], query)
+        return np.matmul(self.embeddings[candidates], query)
+
+    def search(self, query, k=1, exclude=None):
+        """
+        Return the top-k node indices sorted by descending cosine similarity, and their similarities.
+        """
+        if self.num == 0:
+            return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.float32)
+        scores = self.scores(query)
+        scores[~self.valid[:self.num]] = -np.inf
+        if exclude is not None:
+            scores[exclude] = -np.inf
+        return self._topk(np.arange(self.num), scores, k)
+
+    @staticmethod
+    def _topk(indices, scores, k):
+        k = min(k, len(scores))
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        top = top[np.isfinite(scores[top])]
+        return indices[top], scores[top]
+
+
+class IVFIndex(FlatIndex):
+    """
+    Inverted-file index with a spherical k-means coarse quantizer.
+    Behaves like FlatIndex until `min_train` nodes have been added. After that, only the
+    nodes assigned to the `nprobe` closest centroids are scored. The quantizer is retrained
+    whenever the number of nodes doubles since the last training.
+    """
+    def __init__(self, feature_dim, capacity, nlist=16, nprobe=4, min_train=1024, **kwargs):
+        super().__init__(feature_dim, capacity)
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_train = min_train
+
+    def reset(self, capacity=None):
+        super().reset(capacity)
+        self.centroids = None
+        self.assign = np.full([self.capacity], fill_value=-1, dtype=np.int64)
+        self.lists = [[] for _ in range(self.nlist)]
+        self.trained_num = 0
+
+    def add(self, node_idx, embedding):
+        super().add(node_idx, embedding)
+        if self.centroids is None:
+            if len(self) >= self.min_train:
+                self.train()
+        elif len(self) >= 2 * self.trained_num:
+            self.train()
+        else:
+            self._assign(node_idx)
+
+    def update(self, node_idx, embedding):
+        super().update(node_idx, embedding)
+        if self.centroids is not None:
+            self._unassign(node_idx)
+            self._assign(node_idx)
+
+    def resize(self, capacity):
+        super().resize(capacity)
+        assign = np.full([capacity], fill_value=-1, dtype=np.int64)
+        assign[:self.num] = self.assign[:self.num]
+        self.assign = assign
+
+    def remove(self, node_idx):
+        super().remove(node_idx)
+        if self.centroids is not None:
+            self._unassign(node_idx)
+
+    def _assign(self, node_idx):
+        list_idx = int(np.argmax(np.matmul(self.centroids, self.embeddings[node_idx])))
+        self.assign[node_idx] = list_idx
+        self.lists[list_idx].append(int(node_idx))
+
+    def _unassign(self, node_idx):
+        list_idx = self.assign[node_idx]
+        if list_idx >= 0:
+            self.lists[list_idx].remove(int(node_idx))
+            self.assign[node_idx] = -1
+
+    def train(self, num_iter=10):
+        node_indices = np.where(self.valid[:self.num])[0]
+        data = self.embeddings[node_indices]
+        nlist = min(self.nlist, len(node_indices))
+        init = np.random.choice(len(node_indices), nlist, replace=False)
+        centroids = data[init].copy()
+        for _ in range(num_iter):
+            assign = np.argmax(np.matmul(data, centroids.T), 1)
+            for c in range(nlist):
+                members = data[assign == c]
+                if len(members) > 0:
+                    centroid = members.sum(0)
+                    centroids[c] = centroid / (np.linalg.norm(centroid) + 1e-8)
+        assign = np.argmax(np.matmul(data, centroids.T), 1)
+        self.centroids = centroids
+        self.assign[:] = -1
+        self.assign[node_indices] = assign
+        self.lists = [node_indices[assign == c].tolist() for c in range(nlist)]
+        self.trained_num = len(node_indices)
+
+    def search(self, query, k=1, exclude=None):
+        if self.centroids is None:
+            return super().search(query, k, exclude)
+        probes = np.argsort(-np.matmul(self.centroids, query))[:self.nprobe]
+        candidates = np.concatenate([np.array(self.lists[p], dtype=np.int64) for p in probes])
+        if exclude is not None:
+            candidates = candidates[~np.isin(candidates, exclude)]
+        if len(candidates) == 0:
+            return np.zeros([0], dtype=np.int64), np.zeros([0], dtype=np.float32)
+        return self._topk(candidates, self.scores(query, candidates), k)
+
+
+LOCALIZATION_INDEX = {
+    'flat': FlatIndex,
+    'ivf': IVFIndex,
+}
+
+
+def build_localization_index(index_type, feature_dim, capacity, **kwargs):
+    if index_type not in LOCALIZATION_INDEX:
+        raise ValueError("Unknown localization index {}. Choose from {}".format(index_type, list(LOCALIZATION_INDEX.keys())))
+    return LOCALIZATION_INDEX[index_type](feature_dim, capacity, **kwargs)
@@ -0,0 +1,136 @@
+import joblib
+import numpy as np
+
+
+class GraphEventLog(object):
+    """
+    Append-only record of the graph memory of one episode.
+    append() takes the memory dict of every time step, as collect_graph.py used to save it, and only keeps
+    what changed: the node rows that were inserted or updated, the adjacency cells that were set or cleared,
+    and the per-step scalars. Storage is O(T + M + E) instead of O(T * M^2) for the snapshots.
+    graph_at(t) rebuilds the memory dict of step t. Indexing (log[t], len(log)) behaves like the former list of
+    snapshots, so the IL wrappers can use either.
+    """
+    CELL_KEYS = ['img_memory_A', 'obj_memory_A_OV']
+    SCALAR_KEYS = ['img_memory_idx']
+
+    def __init__(self):
+        self.length = 0
+        self.prev = {}
+        self.sizes = {}  # key -> number of rows (and cols) at every step
+        self.scalars = {}  # key -> value at every step
+        self.events = {}  # key -> (steps, indices, values)
+        self.dtypes = {}
+        self.shapes = {}  # key -> shape of one event value
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, t):
+        if t < 0:
+            t += self.length
+        if t < 0 or t >= self.length:
+            raise IndexError("Step {} is out of the {} recorded steps".format(t, self.length))
+        return self.graph_at(t)
+
+    def append(self, memory_dict):
+        t = self.length
+        for key, val in memory_dict.items():
+            if key in self.SCALAR_KEYS:
+                self.scalars.setdefault(key, []).append(np.asarray(val).reshape(-1)[0])
+                continue
+            val = np.asarray(val)
+            if key not in self.events:
+                self.events[key] = ([], [], [])
+                self.sizes[key] = []
+                self.dtypes[key] = val.dtype
+                self.shapes[key] = () if key in self.CELL_KEYS else val.shape[1:]
+            num_axes = 2 if key in self.CELL_KEYS else 1
+            prev = np.zeros(val.shape, dtype=val.dtype)
+            if key in self.prev:
+                overlap = tuple(slice(0, min(a, b)) for a, b in zip(val.shape[:num_axes], self.prev[key].shape[:num_axes]))
+                prev[overlap] = self.prev[key][overlap]
+            changed = val != prev
+            if num_axes == 2:
+                indices = np.argwhere(changed)
+                values = val[changed]
+            else:
+                indices = np.where(changed.reshape(len(val), -1).any(1))[0]
+                values = val[indices]
+            if len(indices) > 0:
+                steps, index_list, value_list = self.events[key]
+                steps.append(np.full([len(indices)], t, dtype=np.int32))
+                index_list.append(indices.astype(np.int32))
+                value_list.append(values.copy())
+            self.sizes[key].append(val.shape[:num_axes])
+            self.prev[key] = val.copy()
+        self.length += 1
+
+    def _event_arrays(self, key):
+        steps, indices, values = self.events[key]
+        if isinstance(steps, np.ndarray):
+            return steps, indices, values
+        index_shape = (0, 2) if key in self.CELL_KEYS else (0,)
+        steps = np.concatenate(steps) if len(steps) > 0 else np.zeros([0], dtype=np.int32)
+        indices = np.concatenate(indices) if len(indices) > 0 else np.zeros(index_shape, dtype=np.int32)
+        values = np.concatenate(values) if len(values) > 0 else np.zeros((0,) + self.shapes[key], dtype=self.dtypes[key])
+        return steps, indices, values
+
+    def graph_at(self, t):
+        """ Memory dict of step t, with the arrays sized as the graph was at that step """
+        memory_dict = {}
+        for key in self.events:
+            steps, indices, values = self._event_arrays(key)
+            size = tuple(self.sizes[key][t])
+            out = np.zeros(size + self.shapes[key], dtype=self.dtypes[key])
+            end = np.searchsorted(steps, t, side='right')
+            if end > 0:
+                indices_t = indices[:end]
+                if key in self.CELL_KEYS:
+                    indices_t = indices_t[:, 0].astype(np.int64) * (int(indices[:, 1].max()) + 1) + indices_t[:, 1]
+                # The last event of every row/cell up to step t
+                _, last = np.unique(indices_t[::-1], return_index=True)
+                last = end - 1 - last
+                if key in self.CELL_KEYS:
+                    out[indices[last, 0], indices[last, 1]] = values[last]
+                else:
+                    out[indices[last]] = values[last]
+            memory_dict[key] = out
+        for key, val in self.scalars.items():
+            memory_dict[key] = val[t]
+        return memory_dict
+
+    def state_dict(self):
+        state = {'length': self.length, 'dtypes': {k: np.dtype(v).str for k, v in self.dtypes.items()}, 'shapes': self.shapes,
+                 'scalars': {k: np.array(v) for k, v in self.scalars.items()},
+                 'sizes': {k: np.array(v, dtype=np.int32) for k, v in self.sizes.items()}, 'events': {}}
+        for key in self.events:
+            state['events'][key] = self._event_arrays(key)
+        return state
+
+    @classmethod
+    def from_state_dict(cls, state):
+        """ Read-only log: append() is not supported after loading """
+        log = cls()
+        log.length = state['length']
+        log.dtypes = {k: np.dtype(v) for k, v in state['dtypes'].items()}
+        log.shapes = state['shapes']
+        log.scalars = state['scalars']
+        log.sizes = state['sizes']
+        log.events = state['events']
+        return log
+
+    @classmethod
+    def from_snapshots(cls, snapshots):
+        log = cls()
+        for memory_dict in snapshots:
+            log.append(memory_dict)
+        return log
+
+
+def load_graph_record(file_name):
+    """ Graphs of one recorded episode, from an event log file or a former snapshot file """
+    data = joblib.load(file_name)
+    if 'graph_log' in data:
+        return GraphEventLog.from_state_dict(data['graph_log'])
+    return data['graph']
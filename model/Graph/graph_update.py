@@ -10,6 +10,24 @@ def is_close(embed_a, embed_b, return_prob=False, th=0.75):
         return close
 
 
+def greedy_match(scores, valid):
+    """
+    One-to-one matching between the rows and the columns of a score matrix, taking the best valid pair first.
+    Returns the matched row and column indices.
+    """
+    scores = np.where(valid, scores, -np.inf)
+    rows, cols = [], []
+    for _ in range(min(scores.shape)):
+        row, col = np.unravel_index(np.argmax(scores), scores.shape)
+        if not np.isfinite(scores[row, col]):
+            break
+        rows.append(row)
+        cols.append(col)
+        scores[row, :] = -np.inf
+        scores[:, col] = -np.inf
+    return np.array(rows, dtype=np.int64), np.array(cols, dtype=np.int64)
+
+
 def update_object_graph(imggraph, objgraph, object_embedding, obs, done):
     object_score, object_category, object_mask, object_position, object_bboxes, time = \
         obs['object_score'], obs['object_category'], obs['object_mask'], obs['object_pose'], obs['object'], obs['step']
@@ -24,71 +42,69 @@ def update_object_graph(imggraph, objgraph, object_embedding, obs, done):
         objgraph.reset()
         objgraph.initialize_graph(object_embedding, object_score, object_category, object_mask, object_position)
 
-    # not_found = not done  # Dense
-    to_add = [True] * int(sum(object_mask))
-
     if objgraph.sparse:
         not_found = ~imggraph.found  # Sparse
     else:
         not_found = not done  # Dense
     if not_found:
-        hop1_vis_node = imggraph.A[imggraph.last_localized_node_idx]
-        hop1_obj_node_mask = np.sum(objgraph.A_OV.transpose(1, 0)[hop1_vis_node], 0) > 0
-        curr_obj_node_mask = objgraph.A_OV[:, imggraph.last_localized_node_idx]
-        neighbor_obj_node_mask = (hop1_obj_node_mask + curr_obj_node_mask) > 0
-        neighbor_node_embedding = objgraph.graph_memory[neighbor_obj_node_mask]
-        neighbor_obj_memory_idx = np.where(neighbor_obj_node_mask)[0]
-        neighbor_obj_memory_score = objgraph.graph_score[neighbor_obj_memory_idx]
-        neighbor_obj_memory_cat = objgraph.graph_category[neighbor_obj_memory_idx]
-
-        close, prob = is_close(neighbor_node_embedding, object_embedding, return_prob=True, th=objgraph.node_th)
-        for c_i in range(prob.shape[1]):
-            close_mem_indices = np.where(close[:, c_i] == 1)[0]
-            for m_i in close_mem_indices:
-                is_same = False
-                to_update = False
-                if (object_category[c_i] == neighbor_obj_memory_cat[m_i]) and object_category[c_i] != -1:
-                    is_same = True
-                    if object_score[c_i] > neighbor_obj_memory_score[m_i]:
-                        to_update = True
-
-                if is_same:
-                    to_add[c_i] = False
-
-                if to_update:
-                    objgraph.update_node(m_i, time, object_score[c_i], object_category[c_i], int(imggraph.last_localized_node_idx), object_embedding[c_i])
-                    break
+        curr_vis_node_idx = int(imggraph.last_localized_node_idx)
+        to_add = np.ones(len(object_embedding), dtype=bool)
+        # Candidate memory objects: attached to the current or hop-1 image nodes, and of a detected category
+        hop1_vis_node = np.where(imggraph.A[imggraph.last_localized_node_idx])[0]
+        neighbor_obj_memory_idx = objgraph.objects_of(np.append(hop1_vis_node, curr_vis_node_idx))
+        neighbor_obj_memory_idx = np.intersect1d(neighbor_obj_memory_idx, objgraph.objects_of_category(object_category[object_category != -1]))
+        if objgraph.position_radius > 0:
+            # and within obj_position_radius of a detection (spatial hash query)
+            neighbor_obj_memory_idx = np.intersect1d(neighbor_obj_memory_idx, objgraph.objects_near(object_position))
+        if len(neighbor_obj_memory_idx) > 0:
+            close, prob = is_close(objgraph.graph_memory[neighbor_obj_memory_idx], object_embedding, return_prob=True, th=objgraph.node_th)
+            is_same = close & (objgraph.graph_category[neighbor_obj_memory_idx][:, None] == object_category[None]) & (object_category != -1)[None]
+            if objgraph.position_radius > 0:
+                is_same &= objgraph.position_index.within(neighbor_obj_memory_idx, object_position, objgraph.position_radius)
+            to_add = ~is_same.any(0)
+            to_update = is_same & (object_score[None] > objgraph.graph_score[neighbor_obj_memory_idx][:, None])
+            mem_i, det_i = greedy_match(prob, to_update)
+            if len(mem_i) > 0:
+                objgraph.update_nodes(neighbor_obj_memory_idx[mem_i], time, object_score[det_i], object_category[det_i],
+                                      curr_vis_node_idx, object_embedding[det_i])
 
         # Add new objects to graph
-        if sum(to_add) > 0:
-            start_node_idx = objgraph.num_node()
-            new_idx = np.where(np.stack(to_add))[0]
-            objgraph.add_node(start_node_idx, object_embedding[new_idx], object_score[new_idx],
-                                   object_category[new_idx], object_mask[new_idx], time,
-                                   object_position[new_idx], int(imggraph.last_localized_node_idx))
+        if to_add.any():
+            new_node_idx = objgraph.allocate_nodes(int(to_add.sum()), protect=objgraph.objects_of(curr_vis_node_idx))
+            objgraph.add_nodes(new_node_idx, object_embedding[to_add], object_score[to_add], object_category[to_add],
+                               time, object_position[to_add], curr_vis_node_idx)
     return objgraph
 
 
-def update_image_graph(imggraph, objgraph, new_embedding, curr_obj_embeding, obs, done):
-    # The position is only used for visualizations.
-    position, rotation, time = obs['position'], obs['rotation'], obs['step']
-    if done:
-        imggraph.reset()
-        imggraph.initialize_graph(new_embedding, position, rotation)
-
-    obj_close = True
-    obj_graph_mask = objgraph.graph_score[objgraph.A_OV[:, imggraph.last_localized_node_idx]] > 0.5
+def is_object_consistent(objgraph, vis_node_idx, curr_obj_embedding, obs):
+    """
+    Check whether the objects attached to an image node can be found among the current detections.
+    Returns False only when enough confident objects are attached to the node and almost none of them are re-detected.
+    """
+    node_obj_idx = objgraph.objects_of(vis_node_idx)
+    obj_graph_mask = objgraph.graph_score[node_obj_idx] > 0.5
     if len(obj_graph_mask) > 0:
         curr_obj_mask = obs['object_score'] > 0.5
         if np.sum(curr_obj_mask) / len(curr_obj_mask) >= 0.5:
-            close_obj, prob_obj = is_close(objgraph.graph_memory[objgraph.A_OV[:, imggraph.last_localized_node_idx]], curr_obj_embeding, return_prob=True, th=objgraph.node_th)
+            close_obj, prob_obj = is_close(objgraph.graph_memory[node_obj_idx], curr_obj_embedding, return_prob=True, th=objgraph.node_th)
             close_obj = close_obj[obj_graph_mask, :][:, curr_obj_mask]
-            category_mask = objgraph.graph_category[objgraph.A_OV[:, imggraph.last_localized_node_idx]][obj_graph_mask][:, None] == obs['object_category'][curr_obj_mask]
+            category_mask = objgraph.graph_category[node_obj_idx][obj_graph_mask][:, None] == obs['object_category'][curr_obj_mask]
             close_obj[~category_mask] = False
             if len(close_obj) >= 3:
                 clos_obj_p = close_obj.any(1).sum() / (close_obj.shape[0])
-                if clos_obj_p < 0.1:  # Fail to localize (find the same object) with the last localized frame
-                    obj_close = False
+                if clos_obj_p < 0.1:  # Fail to localize (find the same object) with the node
+                    return False
+    return True
+
+
+def update_image_graph(imggraph, objgraph, new_embedding, curr_obj_embeding, obs, done):
+    # The position is only used for visualizations.
+    position, rotation, time = obs['position'], obs['rotation'], obs['step']
+    if done:
+        imggraph.reset()
+        imggraph.initialize_graph(new_embedding, position, rotation)
+
+    obj_close = is_object_consistent(objgraph, imggraph.last_localized_node_idx, curr_obj_embeding, obs)
 
     close, prob = is_close(imggraph.last_localized_node_embedding[None], new_embedding[None], return_prob=True, th=imggraph.node_th)
     found = (np.array(done) + close.squeeze()) & np.array(obj_close).squeeze()
@@ -99,35 +115,48 @@ def update_image_graph(imggraph, objgraph, new_embedding, curr_obj_embeding, obs
         imggraph.found = True
     else:
         imggraph.found = False
-        check_list = 1 - imggraph.graph_mask[:imggraph.num_node()]
-        check_list[imggraph.last_localized_node_idx] = 1.0
-        while not found:
-            not_checked_yet = np.where((1 - check_list))[0]
-            neighbor_embedding = imggraph.graph_memory[not_checked_yet]
-            num_to_check = len(not_checked_yet)
-            if num_to_check == 0:
-                to_add = True
+        # Candidates above the threshold, ranked by similarity. Take the first one whose objects agree with the current view.
+        candidates, _ = imggraph.localize(new_embedding, exclude=imggraph.last_localized_node_idx)
+        found_node = None
+        for candidate in candidates:
+            if is_object_consistent(objgraph, candidate, curr_obj_embeding, obs):
+                found_node = candidate
                 break
-            else:
-                close, prob = is_close(new_embedding[None], neighbor_embedding, return_prob=True, th=imggraph.node_th)
-                close = close[0]
-                prob = prob[0]
-                close_idx = np.where(close)[0]
-                if len(close_idx) >= 1:
-                    found_node = not_checked_yet[prob.argmax()]
-                else:
-                    found_node = None
-                if found_node is not None:
-                    found = True
-                    imggraph.update_node(found_node, time, new_embedding)
-                    imggraph.add_edge(found_node, imggraph.last_localized_node_idx)
-                    imggraph.record_localized_state(found_node, new_embedding)
-                check_list[found_node] = 1.0
+        if found_node is not None:
+            imggraph.update_node(found_node, time, new_embedding)
+            imggraph.add_edge(found_node, imggraph.last_localized_node_idx)
+            imggraph.record_localized_state(found_node, new_embedding)
+        else:
+            to_add = True
 
     if to_add:
-        new_node_idx = imggraph.num_node()
+        new_node_idx, evicted_node_idx = imggraph.allocate_node(protect=[imggraph.last_localized_node_idx])
+        if evicted_node_idx is not None:
+            objgraph.remove_vis_node(evicted_node_idx)
         imggraph.add_node(new_node_idx, new_embedding, time, position, rotation)
         imggraph.add_edge(new_node_idx, imggraph.last_localized_node_idx)
         imggraph.record_localized_state(new_node_idx, new_embedding)
 
-    return imggraph
\ No newline at end of file
+    if imggraph.merge_interval > 0 and time > 0 and time % imggraph.merge_interval == 0:
+        objgraph.remap_vis_nodes(imggraph.compact())
+    return imggraph
+
+
+def relocalize(imggraph, objgraph, new_embedding, obs):
+    """
+    Localize the first observation of an episode in a graph loaded from the scene memory.
+    The closest node above the threshold becomes the localized node, otherwise a new node is added without edges.
+    """
+    position, rotation, time = obs['position'], obs['rotation'], obs['step']
+    candidates, _ = imggraph.localize(new_embedding)
+    if len(candidates) > 0:
+        node_idx = candidates[0]
+        imggraph.update_node(node_idx, time, new_embedding)
+    else:
+        node_idx, evicted_node_idx = imggraph.allocate_node()
+        if evicted_node_idx is not None:
+            objgraph.remove_vis_node(evicted_node_idx)
+        imggraph.add_node(node_idx, new_embedding, time, position, rotation)
+    imggraph.record_localized_state(node_idx, new_embedding)
+    imggraph.found = True
+    return imggraph
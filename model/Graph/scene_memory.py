@@ -0,0 +1,48 @@
+import os
+from collections import OrderedDict
+import joblib
+from utils.collect_manifest import atomic_dump
+
+
+class SceneMemory(object):
+    """
+    Graphs of finished episodes keyed by scene, so that the next episode in the same scene
+    starts from the graph instead of an empty one: ImageGoalGraphEnv.build_graph loads it on the env reset and passes it
+    to GraphBuilder.update(..., reset=True, state=...).
+    At most max_scenes graphs are kept in memory, the least recently used are dropped first.
+    With save_dir, the graphs are also written to disk and shared between processes and runs.
+    """
+    def __init__(self, max_scenes=10, save_dir=''):
+        self.max_scenes = max_scenes
+        self.save_dir = save_dir
+        self.scenes = OrderedDict()
+        if self.save_dir:
+            os.makedirs(self.save_dir, exist_ok=True)
+
+    def __contains__(self, scene_id):
+        return scene_id in self.scenes or (self.save_dir and os.path.exists(self.file_name(scene_id)))
+
+    def file_name(self, scene_id):
+        return os.path.join(self.save_dir, '{}.dat.gz'.format(scene_id))
+
+    def _put(self, scene_id, state):
+        self.scenes[scene_id] = state
+        self.scenes.move_to_end(scene_id)
+        while len(self.scenes) > self.max_scenes:
+            self.scenes.popitem(last=False)
+
+    def save(self, scene_id, imggraph, objgraph):
+        state = {'imggraph': imggraph.state_dict(), 'objgraph': objgraph.state_dict()}
+        self._put(scene_id, state)
+        if self.save_dir:
+            atomic_dump(state, self.file_name(scene_id))
+
+    def load(self, scene_id):
+        if scene_id in self.scenes:
+            self.scenes.move_to_end(scene_id)
+            return self.scenes[scene_id]
+        if self.save_dir and os.path.exists(self.file_name(scene_id)):
+            state = joblib.load(self.file_name(scene_id))
+            self._put(scene_id, state)
+            return state
+        return None
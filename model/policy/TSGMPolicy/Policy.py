@@ -12,6 +12,7 @@ from PIL import Image
 import torchvision.transforms as transforms
 from utils.augmentations import GaussianBlur
 from .perception import CategoryEncoding
+from model.utils import run_checkpointed, autocast
 
 
 class CriticHead(nn.Module):
@@ -74,8 +75,10 @@ class TSGMPolicy(nn.Module):
             observations, rnn_hidden_states, prev_actions, masks, return_features=return_features
         )
         features = torch.where(torch.isnan(features), Variable(torch.ones_like(features)*0.0001, requires_grad=False).to(features.device), features)
-        distribution, x = self.action_distribution(features)
-        value = self.critic(features)
+        # float32 island under autocast: the action distribution and the value
+        with autocast(features.device, enabled=False):
+            distribution, x = self.action_distribution(features.float())
+            value = self.critic(features.float())
 
         if deterministic:
             action = distribution.mode()
@@ -87,11 +90,25 @@ class TSGMPolicy(nn.Module):
             return value, action, action_log_probs, rnn_hidden_states, x, preds, ffeatures
         return value, action, action_log_probs, rnn_hidden_states, x, preds, None
 
+    def act_sequence(self, observations, rnn_hidden_states, prev_actions, masks):
+        """
+        Teacher-forced forward of T steps of N sequences, flattened as (T * N, ...) in time-major order.
+        The encoders run once over all the steps, only the state encoders step through time.
+        Returns the action logits, the last hidden states and the auxiliary predictions.
+        """
+        vis_input, obj_input, preds, _ = self.net.encode(observations, prev_actions, masks)
+        features, rnn_hidden_states = self.net.recurrent(vis_input, obj_input, rnn_hidden_states, masks)
+        features = torch.where(torch.isnan(features), Variable(torch.ones_like(features)*0.0001, requires_grad=False).to(features.device), features)
+        with autocast(features.device, enabled=False):
+            distribution, x = self.action_distribution(features.float())
+        return x, rnn_hidden_states, preds
+
     def get_value(self, observations, rnn_hidden_states, prev_actions, masks):
         features, *_ = self.net(
             observations, rnn_hidden_states, prev_actions, masks
         )
-        value = self.critic(features)
+        with autocast(features.device, enabled=False):
+            value = self.critic(features.float())
         return value
 
     def evaluate_actions(
@@ -100,8 +117,9 @@ class TSGMPolicy(nn.Module):
         features, rnn_hidden_states, preds, _ = self.net(
             observations, rnn_hidden_states, prev_actions, masks
         )
-        distribution, x = self.action_distribution(features)
-        value = self.critic(features)
+        with autocast(features.device, enabled=False):
+            distribution, x = self.action_distribution(features.float())
+            value = self.critic(features.float())
 
         action_log_probs = distribution.log_probs(action)
         distribution_entropy = distribution.entropy().mean()
@@ -146,6 +164,8 @@ class TSGMNet(nn.Module):
 
         self.torch_device = "cuda:" + str(self.cfg.TORCH_GPU_ID) if torch.cuda.device_count() > 0 else 'cpu'
         self.perception_unit = Perception(cfg, self.torch_device)
+        # Recompute the ResNet encoders in backward (IL.checkpoint_activations)
+        self.checkpoint_activations = cfg.IL.checkpoint_activations
         self.visual_fc = nn.Sequential(
             nn.Linear(
                 cfg.features.visual_feature_dim * 3, hidden_size * 2
@@ -222,6 +242,27 @@ class TSGMNet(nn.Module):
         return self.state_encoder_vis.num_recurrent_layers
 
     def forward(self, observations, rnn_hidden_states, prev_actions, masks, mode='', return_features=False):
+        vis_input, obj_input, preds, ffeatures = self.encode(observations, prev_actions, masks)
+        return self.recurrent(vis_input, obj_input, rnn_hidden_states, masks) + (preds, ffeatures)
+
+    def recurrent(self, vis_input, obj_input, rnn_hidden_states, masks):
+        """
+        The state encoders, on one step of N observations, or on T steps flattened as (T * N, ...)
+        (RNNStateEncoder.seq_forward)
+        """
+        rnn_hidden_states_vis, rnn_hidden_states_obj = rnn_hidden_states.split(int(rnn_hidden_states.shape[-1]/2), dim=-1)
+        vis_x, rnn_hidden_states_vis = self.state_encoder_vis(vis_input, rnn_hidden_states_vis, masks)
+        obj_x, rnn_hidden_states_obj = self.state_encoder_obj(obj_input, rnn_hidden_states_obj, masks)
+        x = torch.cat([vis_x, obj_x], -1)
+        rnn_hidden_states = torch.cat([rnn_hidden_states_vis, rnn_hidden_states_obj], -1)
+        return x, rnn_hidden_states
+
+    def encode(self, observations, prev_actions, masks):
+        """
+        Everything that does not depend on the recurrent state: encoders, goal embedding, graph context and the
+        auxiliary predictions. Runs on any batch of observations, e.g. the T steps of N sequences flattened (T * N, ...).
+        Returns the inputs of the visual and object state encoders, preds and ffeatures.
+        """
         prev_actions = self.prev_action_embedding(
             ((prev_actions.float() + 1) * masks).long().squeeze(-1)
         )
@@ -253,12 +294,13 @@ class TSGMNet(nn.Module):
                     goal_tensor.append(torch.cat([self.transform_eval(im).to(observations['target_goal'].device), observations['target_goal'][i][:,:,3][None]], 0))
                 goal_tensor = torch.stack(goal_tensor, 0)
             goal_tensor = goal_tensor.to(self.torch_device)
+        run = run_checkpointed if self.checkpoint_activations and torch.is_grad_enabled() else lambda fn, *inputs: fn(*inputs)
         embeddings = {}
-        embeddings['curr_embedding'] = self.img_encoder(curr_tensor).view(curr_tensor.shape[0], -1)
-        embeddings['goal_embedding'] = self.img_encoder(goal_tensor).view(goal_tensor.shape[0], -1)
-        curr_obj_embedding = self.img_encoder.embed_object(curr_tensor, observations['object'].to(self.torch_device)).view(curr_tensor.shape[0], observations['object'].shape[1], -1)
+        embeddings['curr_embedding'] = run(self.img_encoder, curr_tensor).view(curr_tensor.shape[0], -1)
+        embeddings['goal_embedding'] = run(self.img_encoder, goal_tensor).view(goal_tensor.shape[0], -1)
+        curr_obj_embedding = run(self.img_encoder.embed_object, curr_tensor, observations['object'].to(self.torch_device)).view(curr_tensor.shape[0], observations['object'].shape[1], -1)
         embeddings['curr_obj_embedding'] = self.Cat(torch.cat([curr_obj_embedding, self.obj_category_embedding(observations['object_category'])], -1))
-        target_obj_embedding = self.img_encoder.embed_object(goal_tensor, observations['target_loc_object'].to(self.torch_device)).view(goal_tensor.shape[0], observations['target_loc_object'].shape[1], -1)
+        target_obj_embedding = run(self.img_encoder.embed_object, goal_tensor, observations['target_loc_object'].to(self.torch_device)).view(goal_tensor.shape[0], observations['target_loc_object'].shape[1], -1)
         embeddings['target_obj_embedding'] = self.Cat(torch.cat([target_obj_embedding, self.obj_category_embedding(observations['target_loc_object_category'].to(self.torch_device))], -1))
 
         curr_context, goal_context, curr_obj_context, goal_obj_context, ffeatures = self.perception_unit(observations, embeddings)
@@ -268,18 +310,14 @@ class TSGMNet(nn.Module):
 
         vis_feats = self.visual_fc(torch.cat((vis_contexts, embeddings['curr_embedding']), 1))
         obj_feats = self.obj_fc(torch.cat((obj_context, embeddings['curr_obj_embedding']), -1)).flatten(1)
-        rnn_hidden_states_vis, rnn_hidden_states_obj = rnn_hidden_states.split(int(rnn_hidden_states.shape[-1]/2), dim=-1)
 
         progress = self.pred_aux2(vis_contexts) #progress
         goal = self.pred_aux4(vis_contexts) #is target
         preds = (progress, goal)
 
-        vis_x, rnn_hidden_states_vis = self.state_encoder_vis(torch.cat([vis_feats, torch.sigmoid(goal), prev_actions], dim=1), rnn_hidden_states_vis, masks)
-        obj_x, rnn_hidden_states_obj = self.state_encoder_obj(torch.cat([obj_feats, prev_actions], dim=1), rnn_hidden_states_obj, masks)
-        x = torch.cat([vis_x, obj_x], -1)
-        rnn_hidden_states = torch.cat([rnn_hidden_states_vis, rnn_hidden_states_obj], -1)
-
-        return x, rnn_hidden_states, preds, ffeatures
+        vis_input = torch.cat([vis_feats, torch.sigmoid(goal), prev_actions], dim=1)
+        obj_input = torch.cat([obj_feats, prev_actions], dim=1)
+        return vis_input, obj_input, preds, ffeatures
 
     def initialize(self):
         def weights_init(m):
@@ -5,6 +5,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 from torch.nn.parameter import Parameter
 from torch.nn.modules.module import Module
+from model.utils import autocast
 
 class GraphConvolution(Module):
     def __init__(self, in_features, out_features, bias=True, init='xavier'):
@@ -127,7 +128,8 @@ class GraphAttention(nn.Module):
         edge_h = torch.cat((h[edge[0, :], :], h[edge[1, :], :]), dim=1).t()
         # edge: 2*D x E
 
-        edge_e = torch.exp(-self.leakyrelu(self.a.mm(edge_h).squeeze()))
+        # In float32 under autocast: the exponentials and their row sums overflow in half precision
+        edge_e = torch.exp(-self.leakyrelu(self.a.mm(edge_h).squeeze().float()))
         if score!=None:
             score_mtx = (score[:,None] * score[None])**0.5
             edge_e = edge_e * score_mtx[edge[0,:], edge[1,:]]
@@ -186,4 +188,6 @@ class SpecialSpmmFunction(torch.autograd.Function):
 
 class SpecialSpmm(nn.Module):
     def forward(self, indices, values, shape, b):
-        return SpecialSpmmFunction.apply(indices, values, shape, b)
+        # float32 island under autocast: no half precision sparse matmul, and the attention sums need the range
+        with autocast(b.device, enabled=False):
+            return SpecialSpmmFunction.apply(indices, values.float(), shape, b.float())
@@ -3,7 +3,7 @@ import torch.nn.functional as F
 from .graph_layer import GraphConvolution, GraphAttention
 import torch.nn as nn
 import math
-from model.utils import CategoryEncoding
+from model.utils import CategoryEncoding, run_checkpointed, autocast
 
 class Attblock(nn.Module):
     def __init__(self, d_model, nhead, dim_feedforward=2048, dropout=0.1,
@@ -32,7 +32,9 @@ class Attblock(nn.Module):
         q = src.permute(1, 0, 2)
         k = trg.permute(1, 0, 2)
         src_mask = ~src_mask.bool()
-        src2, attention = self.attn(q, k, value=k, key_padding_mask=src_mask)
+        # float32 island under autocast: the attention softmax over the memory nodes
+        with autocast(q.device, enabled=False):
+            src2, attention = self.attn(q.float(), k.float(), value=k.float(), key_padding_mask=src_mask)
         src2 = src2.permute(1, 0, 2)
         src = src + self.dropout1(src2)
         src = self.norm1(src)
@@ -186,39 +188,43 @@ class Perception(nn.Module):
                                               nn.ReLU(),
                                               nn.Linear(cfg.features.object_feature_dim, cfg.features.object_feature_dim))
         self.output_size = feature_dim
+        # Recompute CrossGCN and the decoders in backward (IL.checkpoint_activations)
+        self.checkpoint_activations = cfg.IL.checkpoint_activations
 
     def forward(self, observations, embeddings):
+        # The graph memory arrives in its compact storage dtypes (memory.*_dtype), cast after trimming to the used nodes
+        run = run_checkpointed if self.checkpoint_activations and torch.is_grad_enabled() else lambda fn, *inputs: fn(*inputs)
         B = observations['img_memory_mask'].shape[0]
         max_node_num = observations['img_memory_mask'].sum(dim=1).max().long()
-        global_relative_time = observations['step'].unsqueeze(1) - observations['img_memory_time'][:, :max_node_num]
-        img_memory = self.time_embedding(observations['img_memory_feat'][:, :max_node_num], global_relative_time)
-        img_memory_mask = observations['img_memory_mask'][:, :max_node_num]
+        global_relative_time = observations['step'].unsqueeze(1) - observations['img_memory_time'][:, :max_node_num].float()
+        img_memory = self.time_embedding(observations['img_memory_feat'][:, :max_node_num].float(), global_relative_time)
+        img_memory_mask = observations['img_memory_mask'][:, :max_node_num].float()
         I = torch.eye(max_node_num).unsqueeze(0).repeat(B, 1, 1).cuda()
-        img_memory_A = observations['img_memory_A'][:, :max_node_num, :max_node_num] + I
+        img_memory_A = observations['img_memory_A'][:, :max_node_num, :max_node_num].float() + I
 
         max_obj_node_num = observations['obj_memory_mask'].sum(dim=1).max().long()
-        object_relative_time = observations['step'].unsqueeze(1) - observations['obj_memory_time'][:, :max_obj_node_num]
-        obj_memory = observations['obj_memory_feat'][:, :max_obj_node_num]
+        object_relative_time = observations['step'].unsqueeze(1) - observations['obj_memory_time'][:, :max_obj_node_num].float()
+        obj_memory = observations['obj_memory_feat'][:, :max_obj_node_num].float()
         obj_memory = self.Cat(torch.cat([obj_memory, self.obj_category_embedding(observations['obj_memory_category'][:, :max_obj_node_num])], -1))
         obj_memory = self.obj_time_embedding(obj_memory, object_relative_time)
-        object_mask = observations['obj_memory_mask'][:, :max_obj_node_num]
+        object_mask = observations['obj_memory_mask'][:, :max_obj_node_num].float()
         object_A_OV = observations['obj_memory_A_OV'][:, :max_obj_node_num, :max_node_num].float()
         object_A = (torch.matmul(torch.matmul(object_A_OV, img_memory_A), object_A_OV.permute(0, 2, 1))>0).float()
 
         img_memory_with_goal = self.feature_embedding(torch.cat((img_memory[:,:max_node_num], embeddings['goal_embedding'].unsqueeze(1).repeat(1,max_node_num,1)),-1))
         obj_memory_with_goal = self.object_embedding(torch.cat((obj_memory[:,:max_obj_node_num], embeddings['goal_embedding'].unsqueeze(1).repeat(1,max_obj_node_num,1)),-1))
 
-        global_context, object_context = self.cGCN(img_memory_with_goal, obj_memory_with_goal, img_memory_A, object_A, object_A_OV)
+        global_context, object_context = run(self.cGCN, img_memory_with_goal, obj_memory_with_goal, img_memory_A, object_A, object_A_OV)
         global_context = self.time_embedding(global_context, global_relative_time)
         object_context = self.obj_time_embedding(object_context, object_relative_time)
 
         object_mask[object_mask.sum(1) == 0] = 1
-        curr_obj_context, curr_obj_attn = self.obj_Decoder(embeddings['curr_obj_embedding'], object_context, object_mask)
-        goal_obj_context, goal_obj_attn = self.goal_obj_Decoder(embeddings['target_obj_embedding'], object_context, object_mask)
+        curr_obj_context, curr_obj_attn = run(self.obj_Decoder, embeddings['curr_obj_embedding'], object_context, object_mask)
+        goal_obj_context, goal_obj_attn = run(self.goal_obj_Decoder, embeddings['target_obj_embedding'], object_context, object_mask)
         goal_obj_context = goal_obj_context.squeeze(1)
-        goal_context, goal_attn = self.goal_Decoder(embeddings['goal_embedding'].unsqueeze(1), global_context, img_memory_mask)
+        goal_context, goal_attn = run(self.goal_Decoder, embeddings['goal_embedding'].unsqueeze(1), global_context, img_memory_mask)
         goal_context = goal_context.squeeze(1)
-        curr_context, curr_attn = self.vis_Decoder(embeddings['curr_embedding'].unsqueeze(1), global_context, img_memory_mask)
+        curr_context, curr_attn = run(self.vis_Decoder, embeddings['curr_embedding'].unsqueeze(1), global_context, img_memory_mask)
         curr_context = curr_context.squeeze(1)
 
         return_f = {'goal_attn': goal_attn, 'curr_attn': curr_attn, 'curr_obj_attn': curr_obj_attn, 'goal_obj_attn': goal_obj_attn}
@@ -1,6 +1,7 @@
 import torch
 import torch.nn as nn
 import math
+from torch.utils.checkpoint import checkpoint
 
 
 class CategoryEncoding(nn.Module):
@@ -30,3 +31,20 @@ class CategoryEncoding(nn.Module):
         # x = x + ce_tensor
         return ce_tensor
 
+
+def run_checkpointed(fn, *inputs):
+    """
+    fn(*inputs) with activation checkpointing: the activations of fn are recomputed in backward instead of kept.
+    The dummy input requiring grad keeps the parameters of fn trained when no input requires grad (e.g. the frames).
+    """
+    dummy = torch.ones(1, requires_grad=True)
+    return checkpoint(lambda _, *x: fn(*x), dummy, *inputs)
+
+
+def autocast(device, enabled=True):
+    """
+    Mixed precision context of the policies on device: float16 on GPU, bfloat16 on CPU (where autocast has no float16).
+    autocast(device, enabled=False) makes a float32 island inside an autocast region, for inputs cast with .float().
+    """
+    device_type = torch.device(device).type
+    return torch.autocast(device_type=device_type, dtype=torch.float16 if device_type == 'cuda' else torch.bfloat16, enabled=enabled)
@@ -7,6 +7,7 @@ from gym.spaces.discrete import Discrete
 import numpy as np
 from env_utils.env_wrapper import *
 from model.policy import *
+from model.utils import autocast
 from env_utils import *
 
 
@@ -59,22 +60,23 @@ class TSGMRunner(BaseRunner):
             else:
                 new_obs[k] = v.to(self.torch_device)
         obs = new_obs
-        (
-            values,
-            actions,
-            actions_log_probs,
-            hidden_states,
-            actions_logits,
-            preds,
-            act_features
-        ) = self.agent.act(
-            obs,
-            self.hidden_states,
-            self.actions,
-            torch.ones(self.B).unsqueeze(1).to(self.torch_device) * (1-done),
-            deterministic=False,
-            return_features=self.return_features
-        )
+        with autocast(self.torch_device, enabled=self.amp):
+            (
+                values,
+                actions,
+                actions_log_probs,
+                hidden_states,
+                actions_logits,
+                preds,
+                act_features
+            ) = self.agent.act(
+                obs,
+                self.hidden_states,
+                self.actions,
+                torch.ones(self.B).unsqueeze(1).to(self.torch_device) * (1-done),
+                deterministic=False,
+                return_features=self.return_features
+            )
         self.features = act_features
         if preds[0] is not None:
             progress = torch.sigmoid(preds[0][0])
@@ -89,7 +91,8 @@ class TSGMRunner(BaseRunner):
 
         log_str = progress_str + ' ' + pred_goal_str
         self.env.log_info(log_type='str', info=log_str)
-        self.hidden_states = hidden_states
+        # The recurrent state stays in float32
+        self.hidden_states = hidden_states.float()
         self.actions = actions
         self.time_t += 1
         return self.actions.item()
@@ -8,6 +8,7 @@ import numpy as np
 import torch.nn.functional as F
 from env_utils.env_wrapper.env_wrapper import EnvWrapper
 from model.policy import *
+from model.utils import autocast
 from env_utils import *
 
 
@@ -40,6 +41,8 @@ class BaseRunner(nn.Module):
         self.return_features = return_features
         self.need_env_wrapper = True
         self.num_agents = 1
+        # Policy under autocast (INFERENCE_AMP): float16 on GPU, bfloat16 on CPU
+        self.amp = config.INFERENCE_AMP
         return
 
     def reset(self):
@@ -59,21 +62,22 @@ class BaseRunner(nn.Module):
             else:
                 new_obs[k] = v
         obs = new_obs
-        (
-            values,
-            actions,
-            actions_log_probs,
-            hidden_states,
-            actions_logits,
-            *_
-        ) = self.agent.act(
-            obs,
-            self.hidden_states,
-            self.actions,
-            torch.ones(self.B).unsqueeze(1).to(self.torch_device) * (1-done),
-            deterministic=False,
-            return_features=self.return_features
-        )
+        with autocast(self.torch_device, enabled=self.amp):
+            (
+                values,
+                actions,
+                actions_log_probs,
+                hidden_states,
+                actions_logits,
+                *_
+            ) = self.agent.act(
+                obs,
+                self.hidden_states,
+                self.actions,
+                torch.ones(self.B).unsqueeze(1).to(self.torch_device) * (1-done),
+                deterministic=False,
+                return_features=self.return_features
+            )
         self.hidden_states.copy_(hidden_states)
         self.actions.copy_(actions)
         self.time_t += 1
@@ -5,12 +5,13 @@ from gym.spaces.dict import Dict as SpaceDict
 from gym.spaces.box import Box
 from gym.spaces.discrete import Discrete
 import os, argparse, torch, time, wandb, numpy as np
-import torchvision.transforms as transforms
-from dataset.habitatdataset import ILDataset
+from dataset.habitatdataset import ILDataset, ILCollate
+from dataset.samplers import LengthBucketBatchSampler
+from dataset.il_store import ILEpisodeStore, SharedEpisodeCache
 from habitat.core.logging import logger
 from torch.utils.data import DataLoader
 import datetime
-from utils.augmentations import GaussianBlur
+import torch.multiprocessing as mp
 project_dir = os.path.dirname(os.path.abspath(__file__))
 torch.backends.cudnn.enabled = True
 
@@ -21,6 +22,7 @@ parser.add_argument("--gpu", type=str, default="0", help="gpus",)
 parser.add_argument("--num-gpu", type=int, default=1, help="gpus",)
 parser.add_argument("--version", type=str, default="test", help="name to save")
 parser.add_argument('--data-dir', default='IL_data', type=str)
+parser.add_argument('--store-dir', default='', type=str, help="columnar episode store written by convert_il_store.py, read instead of the .dat.gz files")
 parser.add_argument('--project-dir', default='.', type=str)
 parser.add_argument('--dataset', default='gibson', type=str)
 parser.add_argument('--resume', default='none', type=str)
@@ -46,7 +48,7 @@ args.img_node_th = float(args.img_node_th)
 args.obj_node_th = float(args.obj_node_th)
 
 
-def train():
+def make_trainer(config):
     observation_space = SpaceDict({
         'panoramic_rgb': Box(low=0, high=256, shape=(64, 256, 3), dtype=np.float32),
         'panoramic_depth': Box(low=0, high=256, shape=(64, 256, 1), dtype=np.float32),
@@ -55,11 +57,93 @@ def train():
         'prev_act': Box(low=0, high=3, shape=(1,), dtype=np.int32),
         'gt_action': Box(low=0, high=3, shape=(1,), dtype=np.int32)
     })
+    action_space = Discrete(4)
+    policy = eval(config.POLICY)(
+        observation_space=observation_space,
+        action_space=action_space,
+        hidden_size=config.features.hidden_size,
+        rnn_type=config.features.rnn_type,
+        num_recurrent_layers=config.features.num_recurrent_layers,
+        backbone=config.features.backbone,
+        goal_sensor_uuid=config.TASK_CONFIG.TASK.GOAL_SENSOR_UUID,
+        normalize_visual_inputs=True,
+        cfg=config
+    )
+    if len(device_ids) > 1:
+        policy = nn.DataParallel(policy, device_ids=device_ids).cuda()
+    return eval(config.TASK_CONFIG.IL_TRAINER)(config, policy)
+
+
+def make_dataset(config, data_dir, graph_dir, split):
+    """ ILDataset of a split, from the store of --store-dir if given """
+    if args.store_dir:
+        store = ILEpisodeStore(os.path.join(project_dir, args.store_dir, split))
+        names = sorted(store.names)
+    else:
+        store = None
+        names = sorted(x for x in os.listdir(os.path.join(data_dir, split)) if x.endswith('.dat.gz'))
+    data_list = [os.path.join(data_dir, split, x) for x in names if os.path.exists(os.path.join(graph_dir, split, x))]
+    episode_cache = None
+    if config.IL.episode_cache_size > 0 and store is None:
+        episode_cache = SharedEpisodeCache(os.path.join(config.IL.episode_cache_dir, '{}_{}'.format(args.dataset, split)), config.IL.episode_cache_size)
+    # The frame augmentations run on the device, in the trainer (see utils/tensor_augmentations.py)
+    # The graphs are loaded by the DataLoader workers, collated by ILCollate
+    return ILDataset(config, data_list, store=store, graph_dir=os.path.join(graph_dir, split), episode_cache=episode_cache)
+
+
+def make_dataloader(config, dataset, batch_sampler=None, persistent=True):
+    """ DataLoader whose workers, when persistent, live across epochs and validations """
+    params = {'num_workers': config.IL.num_workers,
+              'pin_memory': config.IL.pin_memory,
+              'collate_fn': ILCollate(config.max_input_length)}
+    if batch_sampler is not None:
+        params['batch_sampler'] = batch_sampler
+    else:
+        params.update({'batch_size': config.IL.batch_size, 'shuffle': True})
+    if config.IL.num_workers > 0:
+        params['persistent_workers'] = persistent and config.IL.persistent_workers
+        params['prefetch_factor'] = config.IL.prefetch_factor
+    return DataLoader(dataset, **params)
+
+
+def run_validation(trainer, valid_dataloader, valid_iter, num_batches):
+    """ Mean validation losses over num_batches batches. The loader is iterated again when exhausted """
+    val_loss_summary_dict = {}
+    with torch.no_grad():
+        for j in range(num_batches):
+            try:
+                batch = next(valid_iter)
+            except StopIteration:
+                valid_iter = iter(valid_dataloader)
+                batch = next(valid_iter)
+            results, loss_dict = trainer(batch, train=False)
+            # if j % 100 == 0:
+            #     trainer.visualize(results, os.path.join(IMAGE_DIR, 'validate_{}_{}_{}'.format(results['scene'], step, j)))
+            for k, v in loss_dict.items():
+                if k not in val_loss_summary_dict.keys():
+                    val_loss_summary_dict[k] = []
+                val_loss_summary_dict[k].append(v)
+            del batch, results, loss_dict
+    return {k: np.array(v).mean() for k, v in val_loss_summary_dict.items()}, valid_iter
 
+
+def validate_snapshot(config, snapshot_file, data_dir, graph_dir, epoch, step):
+    """ Background validation process: the losses of the model saved in snapshot_file """
+    trainer = make_trainer(config)
+    trainer.agent.load_state_dict(torch.load(snapshot_file, map_location='cpu')['state_dict'])
+    trainer.to(device)
+    trainer.eval()
+    valid_dataloader = make_dataloader(config, make_dataset(config, data_dir, graph_dir, 'val'), persistent=False)
+    eval_start = time.time()
+    val_losses, _ = run_validation(trainer, valid_dataloader, iter(valid_dataloader), config.IL.num_val_batches)
+    loss_str = ''.join('%s: %.3f ' % (k, v) for k, v in val_losses.items())
+    logger.info("background validation of epo %d, step %d, %ds || loss : " % (epoch + 1, step + 1, time.time() - eval_start) + loss_str)
+
+
+def train():
     DATA_DIR = args.data_dir = os.path.join(project_dir, args.data_dir)
     GRAPH_DIR = args.prebuild_path = os.path.join(project_dir, args.prebuild_path)
     config = get_config(args.config, base_task_config_path="./configs/{}_{}.yaml".format(args.task, args.dataset), arguments=vars(args))
-    action_space = Discrete(4)
     config.defrost()
     config.POLICY = args.policy
     config.IL.batch_size = config.IL.batch_size * int(args.num_gpu)
@@ -93,50 +177,19 @@ def train():
     print('Object Graph Threshold: ', config.TASK_CONFIG.obj_node_th)
     print('====================================')
 
-    policy = eval(config.POLICY)(
-        observation_space=observation_space,
-        action_space=action_space,
-        hidden_size=config.features.hidden_size,
-        rnn_type=config.features.rnn_type,
-        num_recurrent_layers=config.features.num_recurrent_layers,
-        backbone=config.features.backbone,
-        goal_sensor_uuid=config.TASK_CONFIG.TASK.GOAL_SENSOR_UUID,
-        normalize_visual_inputs=True,
-        cfg=config
-    )
-    if len(device_ids) > 1:
-        policy = nn.DataParallel(policy, device_ids=device_ids).cuda()
-    trainer = eval(config.TASK_CONFIG.IL_TRAINER)(config, policy)
-    train_data_list = [os.path.join(DATA_DIR, 'train', x) for x in sorted(os.listdir(os.path.join(DATA_DIR, 'train'))) if "dat.gz" in x if os.path.exists(os.path.join(GRAPH_DIR, 'train', x))]
-    valid_data_list = [os.path.join(DATA_DIR, 'val', x) for x in sorted(os.listdir(os.path.join(DATA_DIR, 'val'))) if "dat.gz" in x if os.path.exists(os.path.join(GRAPH_DIR, 'val', x))]
-
-    params = {'batch_size': config.IL.batch_size,
-              'shuffle': True,
-              'num_workers': config.IL.num_workers,
-              'pin_memory': True}
-
-    normalize = transforms.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225])
-    eval_augmentation = [
-        transforms.Resize(config.IMG_SHAPE),
-        transforms.ToTensor(),
-        normalize
-    ]
-    augmentation = [
-        transforms.RandomApply([
-            transforms.ColorJitter(0.4, 0.4, 0.4, 0.1)  # not strengthened
-        ], p=0.8),
-        transforms.RandomGrayscale(p=0.2),
-        transforms.RandomApply([GaussianBlur([.1, 2.])], p=0.5),
-        transforms.Resize(config.IMG_SHAPE),
-        transforms.ToTensor(),
-        normalize
-    ]
-    train_dataset = ILDataset(config, train_data_list, transforms.Compose(augmentation))
-    valid_dataset = ILDataset(config, valid_data_list,transforms.Compose(eval_augmentation))
-    valid_params = params
-
-    valid_dataloader = DataLoader(valid_dataset, **valid_params)
-    valid_iter = iter(valid_dataloader)
+    trainer = make_trainer(config)
+    train_dataset = make_dataset(config, DATA_DIR, GRAPH_DIR, 'train')
+    valid_dataset = make_dataset(config, DATA_DIR, GRAPH_DIR, 'val')
+    train_sampler = None
+    if config.IL.bucket_by_length:
+        train_sampler = LengthBucketBatchSampler(train_dataset.episode_lengths(), config.IL.batch_size, config.max_input_length,
+                                                 bucket_pool_size=config.IL.bucket_pool_size)
+    # Built once: the persistent workers, their imports and caches are kept across epochs
+    train_dataloader = make_dataloader(config, train_dataset, train_sampler)
+    if not config.IL.background_validation:
+        valid_dataloader = make_dataloader(config, valid_dataset)
+        valid_iter = iter(valid_dataloader)
+    validation_process = None
 
     version_name = config.saving.name if args.version == 'none' else args.version
     version_name += '_{}'.format(args.dataset)
@@ -179,7 +232,6 @@ def train():
     trainer.to(device)
     trainer.train()
     for epoch in range(start_epoch, config.IL.max_epoch):
-        train_dataloader = DataLoader(train_dataset, **params)
         train_iter = iter(train_dataloader)
         loss_summary_dict = {}
         for iteration, batch in enumerate(train_iter):
@@ -222,37 +274,23 @@ def train():
                 logger.info("Saved checkpoint to '{}'".format(os.path.join(SAVE_DIR, 'epoch%04diter%05d.pt' % (epoch, step))))
 
             del results, batch, loss_dict
-            if step % eval_every == 0:# and step > 0:
+            if step % eval_every == 0 and config.IL.background_validation:# and step > 0:
+                # Validate a snapshot of the model in another process, unless the previous validation still runs
+                if validation_process is None or not validation_process.is_alive():
+                    snapshot_file = os.path.join(SAVE_DIR if not args.debug else IMAGE_DIR, 'validation_snapshot.pt')
+                    trainer.save(file_name=snapshot_file + '.tmp', epoch=epoch, step=step)
+                    os.replace(snapshot_file + '.tmp', snapshot_file)
+                    validation_process = mp.get_context('spawn').Process(target=validate_snapshot, args=(config, snapshot_file, DATA_DIR, GRAPH_DIR, epoch, step), daemon=True)
+                    validation_process.start()
+            elif step % eval_every == 0:# and step > 0:
                 trainer.eval()
                 eval_start = time.time()
-                with torch.no_grad():
-                    val_loss_summary_dict = {}
-                    for j in range(100):
-                        try:
-                            batch = next(valid_iter)
-                        except:
-                            valid_dataloader = DataLoader(valid_dataset, **valid_params)
-                            valid_iter = iter(valid_dataloader)
-                            batch = next(valid_iter)
-                        results, loss_dict = trainer(batch, train=False)
-                        # if j % 100 == 0:
-                        #     trainer.visualize(results, os.path.join(IMAGE_DIR, 'validate_{}_{}_{}'.format(results['scene'], step, j)))
-                        for k, v in loss_dict.items():
-                            if k not in val_loss_summary_dict.keys():
-                                val_loss_summary_dict[k] = []
-                            val_loss_summary_dict[k].append(v)
-
-                    loss_str = ''
-                    writer_dict = {}
-                    for k, v in val_loss_summary_dict.items():
-                        value = np.array(v).mean()
-                        loss_str += '%s: %.3f ' %(k, value)
-                        writer_dict[k] = value
-                    logger.info("validation time = %.0fh %.0fm, epo %d, step %d, lr: %.5f, %ds per %d iters || loss : " % (
-                        (time.time() - start) // 3600, ((time.time() - start) / 60) % 60, epoch + 1, step + 1, lr, time.time() - eval_start, print_every) + loss_str)
-                    temp = time.time()
-                    loss_summary_dict = {}
-                del batch, results, loss_dict
+                val_losses, valid_iter = run_validation(trainer, valid_dataloader, valid_iter, config.IL.num_val_batches)
+                loss_str = ''.join('%s: %.3f ' % (k, v) for k, v in val_losses.items())
+                logger.info("validation time = %.0fh %.0fm, epo %d, step %d, lr: %.5f, %ds per %d iters || loss : " % (
+                    (time.time() - start) // 3600, ((time.time() - start) / 60) % 60, epoch + 1, step + 1, lr, time.time() - eval_start, print_every) + loss_str)
+                temp = time.time()
+                loss_summary_dict = {}
                 trainer.train()
             step += 1
     print('===> end training')
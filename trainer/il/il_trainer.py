@@ -1,9 +1,12 @@
 import torch.nn.functional as F
 import torch.optim as optim
-import os, joblib
+import os
+from dataset.habitatdataset import is_graph_key
 from trainer.il.il_wrapper import *
 TIME_DEBUG = False
 from utils.debug_utils import log_time
+from utils.tensor_augmentations import BatchAugmentation, BatchNormalize
+from model.utils import autocast
 from torch.autograd import Variable
 import torch.nn as nn
 
@@ -21,7 +24,14 @@ class ImgGoalTrainer(nn.Module):
         )
         self.config = cfg
         self.env_setup_done = False
-        self.graph_dir = cfg['ARGS']['prebuild_path']
+        # Frame augmentation (train) and normalization (validation), run on the device after collation
+        self.augmentation = BatchAugmentation(img_size=cfg.IMG_SHAPE)
+        self.eval_augmentation = BatchNormalize(img_size=cfg.IMG_SHAPE)
+        # Truncated BPTT: the sequences are trained in chunks of bptt_chunk_length steps, 0 for the whole sequences
+        self.bptt_chunk_length = cfg.IL.bptt_chunk_length
+        # Mixed precision: the policy under float16 autocast, the losses in float32 and scaled for backward
+        self.amp = cfg.IL.amp and 'cuda' in self.torch_device
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.amp)
 
     def save(self,file_name=None, epoch=0, step=0):
         if file_name is not None:
@@ -31,28 +41,44 @@ class ImgGoalTrainer(nn.Module):
             save_dict['state_dict'] = self.agent.state_dict()
             torch.save(save_dict, file_name)
 
+    def transform_images(self, train_info, train=True):
+        """
+        panoramic_rgb_trans and target_goal_trans, the augmented (train) or normalized (validation) frames and goals,
+        from the uint8 frames of the batch, plus target_goal, the goal image of every step
+        """
+        augmentation = self.augmentation if train else self.eval_augmentation
+        B, T = train_info['panoramic_rgb'].shape[:2]
+        train_info['panoramic_rgb_trans'] = augmentation(train_info['panoramic_rgb'].flatten(0, 1)).view(B, T, 3, *self.config.IMG_SHAPE)
+        goal_rgb = train_info.pop('target_goal_rgb')
+        goal_depth = train_info.pop('target_goal_depth')
+        num_goals = goal_rgb.shape[1]
+        goal_trans = augmentation(goal_rgb.flatten(0, 1)).view(B, num_goals, 3, *self.config.IMG_SHAPE)
+        goal_trans = torch.cat([goal_trans, goal_depth.unsqueeze(2)], 2)
+        goal = torch.cat([goal_rgb.float() / 255., goal_depth.unsqueeze(-1)], -1)
+        batch_idx = torch.arange(B, device=goal.device)[:, None]
+        target_idx = train_info['target'].long()
+        train_info['target_goal_trans'] = goal_trans[batch_idx, target_idx]
+        train_info['target_goal'] = goal[batch_idx, target_idx]
+        return train_info
+
     def forward(self, batch, train=True):
         train_info, aux_info, vis_info = batch
         for obs in train_info:
             if obs not in ["scene", "data_path"]:
-                train_info[obs] = train_info[obs].to(dtype=torch.float).to(device=self.torch_device)
-        for i in range(len(train_info['object'])):
-            train_info['object'][i, :, :, 0] = i
-        if train_info.get('target_object', None) != None:
-            for i in range(len(train_info['target_object'])):
-                train_info['target_object'][i, :, :, 0] = i
-        if train_info.get('target_loc_object', None) != None:
-            for i in range(len(train_info['target_loc_object'])):
-                train_info['target_loc_object'][i, :, :, 0] = i
+                # Moved before the cast, so uint8 frames cross to the device as uint8
+                train_info[obs] = train_info[obs].to(device=self.torch_device, non_blocking=True)
+                # The graph memory keeps its storage dtypes, cast by the policy after trimming to the used nodes
+                if obs not in ["panoramic_rgb", "target_goal_rgb"] and not is_graph_key(obs):
+                    train_info[obs] = train_info[obs].to(dtype=torch.float)
+        train_info = self.transform_images(train_info, train)
+        train_info['panoramic_rgb'] = train_info['panoramic_rgb'].float()
         aux_info = {'is_goal': aux_info['is_goal'].to(self.torch_device), 'progress': aux_info['progress'].to(self.torch_device)}
         self.B = train_info['action'].shape[0]
         lengths = (train_info['action'] > -10).sum(dim=1)
 
         T = lengths.max().item()
         hidden_states = torch.zeros(self.agent.net.num_recurrent_layers, self.B, self.agent.net._hidden_size).to(self.torch_device)
-        actions = torch.zeros([self.B]).to(self.torch_device)
         if TIME_DEBUG: s = log_time()
-        split = "train" if train else "val"
         results = {}
 
         with torch.no_grad(): #batch x T x []
@@ -61,65 +87,64 @@ class ImgGoalTrainer(nn.Module):
             gt_progress = Variable(aux_info['progress'][:, :T])
             gt_is_goal = Variable(aux_info['is_goal'][:, :T])
 
-        graphs = []
-        for data_path in train_info['data_path']:
-            file_name = os.path.join(self.graph_dir, split, data_path.split('/')[-1])
-            graphs.append(joblib.load(file_name)['graph'])
-        actions_logits_all = []
-        progress_pred = []
-        goal_pred = []
-        for t in range(T):
-            masks = lengths > t
-            if t == 0: masks[:] = False
-            train_info_t = {}
-            len_data = train_info['panoramic_rgb'].shape[1]
-            for obs in train_info:
-                try:
-                    if train_info[obs].shape[1] == len_data:
-                        train_info_t[obs] = train_info[obs][:, t]
-                except:
-                    pass
-            obs_t = self.env_wrapper.step([train_info_t, torch.ones(self.B).to(self.torch_device)*t, (~masks).cpu().detach().numpy()], graphs)
-            if TIME_DEBUG : s, get_step_t = log_time(s, 'env step', return_time=True)
-            if -100 in actions:
-                b = torch.where(actions==-100)
-                for b_ in b:
-                    b_ = b_.to(self.torch_device)
-                    actions[b_] = 0
-            obs_t.update({k: v[:, t] for k,v in aux_info.items()})
-            (
-                values,
-                pred_act,
-                actions_log_probs,
-                hidden_states,
-                actions_logits,
-                preds,
-                _
-            ) = self.agent.act(
-                obs_t,
-                hidden_states,
-                actions.view(self.B,1),
-                masks.unsqueeze(1)
-            )
-            actions_logits_all.append(actions_logits)
-            progress_pred.append(preds[0].squeeze(-1))
-            goal_pred.append(preds[1].squeeze(-1))
-        actions_logits_all = torch.stack(actions_logits_all, 1)
-        progress_pred = torch.stack(progress_pred, 1)
-        goal_pred = torch.stack(goal_pred, 1)
+        # Graphs collated by ILCollate, (B, T, M, ...), are indexed with the other steps
+        if 'img_memory_feat' not in train_info or 'step' not in train_info:
+            raise ValueError("The batch has no graph memory: build ILDataset with graph_dir and collate it with ILCollate")
 
-        action_loss = F.cross_entropy(actions_logits_all.reshape(-1,actions_logits_all.shape[-1]), gt_action.reshape(-1).long())
-        progress_loss = F.mse_loss(torch.sigmoid(progress_pred)[valid_indices].reshape(-1), gt_progress[valid_indices].reshape(-1).float())
-        goal_loss = F.mse_loss(torch.sigmoid(goal_pred)[valid_indices].reshape(-1), gt_is_goal[valid_indices].reshape(-1).float())
-        total_loss = action_loss + goal_loss + progress_loss
+        # The T steps of the B sequences, flattened in time-major order (T * B, ...) for RNNStateEncoder.seq_forward
+        len_data = train_info['panoramic_rgb'].shape[1]
+        obs = {}
+        for k, v in list(train_info.items()) + list(aux_info.items()):
+            if torch.is_tensor(v) and v.dim() > 1 and v.shape[1] == len_data:
+                obs[k] = v[:, :T].transpose(0, 1).reshape(T * self.B, *v.shape[2:])
+        # Batch index of the boxes, as in a batch of one step
+        for k in ['object', 'target_object', 'target_loc_object']:
+            if k in obs:
+                obs[k] = obs[k].clone()
+                obs[k][:, :, 0] = torch.arange(self.B, device=obs[k].device).repeat(T)[:, None]
+        masks = (torch.arange(T, device=self.torch_device)[:, None] < lengths[None].to(self.torch_device))
+        masks[0] = False
+        masks = masks.reshape(T * self.B, 1).float()
+        prev_actions = torch.zeros([T * self.B, 1]).to(self.torch_device)
+        if TIME_DEBUG : s, get_step_t = log_time(s, 'prepare steps', return_time=True)
 
+        # Encoders over all the steps of a chunk at once, then the state encoders through time.
+        # The steps are time-major, so a chunk of steps is a contiguous slice of rows.
+        # Every chunk is backpropagated before the next one, with the hidden states detached in between, so only the
+        # activations of one chunk are kept. Its losses are sums over the valid steps divided by the valid steps of
+        # the whole batch, so that the chunks add up to the losses of the whole sequences.
+        chunk_length = self.bptt_chunk_length if train and self.bptt_chunk_length > 0 else T
+        num_valid = valid_indices.sum().float()
+        action_loss = progress_loss = goal_loss = 0.
         if train:
             self.optim.zero_grad()
-            total_loss.backward()
-            self.optim.step()
+        for t0 in range(0, T, chunk_length):
+            t1 = min(t0 + chunk_length, T)
+            rows = slice(t0 * self.B, t1 * self.B)
+            obs_chunk = {k: v[rows] for k, v in obs.items()}
+            with autocast(self.torch_device, enabled=self.amp):
+                actions_logits, hidden_states, preds = self.agent.act_sequence(obs_chunk, hidden_states, prev_actions[rows], masks[rows])
+            actions_logits = actions_logits.float().view(t1 - t0, self.B, -1).transpose(0, 1)
+            progress_pred = preds[0].float().view(t1 - t0, self.B).transpose(0, 1)
+            goal_pred = preds[1].float().view(t1 - t0, self.B).transpose(0, 1)
+            valid = valid_indices[:, t0:t1]
+
+            chunk_action_loss = F.cross_entropy(actions_logits.reshape(-1, actions_logits.shape[-1]), gt_action[:, t0:t1].reshape(-1).long(), reduction='sum') / num_valid
+            chunk_progress_loss = F.mse_loss(torch.sigmoid(progress_pred)[valid].reshape(-1), gt_progress[:, t0:t1][valid].reshape(-1).float(), reduction='sum') / num_valid
+            chunk_goal_loss = F.mse_loss(torch.sigmoid(goal_pred)[valid].reshape(-1), gt_is_goal[:, t0:t1][valid].reshape(-1).float(), reduction='sum') / num_valid
+            if train:
+                self.scaler.scale(chunk_action_loss + chunk_goal_loss + chunk_progress_loss).backward()
+                hidden_states = hidden_states.detach()
+            action_loss += chunk_action_loss.detach()
+            progress_loss += chunk_progress_loss.detach()
+            goal_loss += chunk_goal_loss.detach()
+
+        if train:
+            self.scaler.step(self.optim)
+            self.scaler.update()
 
         loss_dict = {}
         loss_dict['act_loss'] = action_loss.item()
-        loss_dict['progress'] = aux_loss1.item()
-        loss_dict['is_goal'] = aux_loss2.item()
+        loss_dict['progress'] = progress_loss.item()
+        loss_dict['is_goal'] = goal_loss.item()
         return results, loss_dict
@@ -27,7 +27,7 @@ class ILWrapper(Wrapper):
                 if "A" in key: #for affinity matrix
                     max_num_node_a = max([graph[key].shape[0] for graph in graph_t])
                     max_num_node_b = max([graph[key].shape[1] for graph in graph_t])
-                    graph_placeholder = torch.zeros([len(graphs), max_num_node_a, max_num_node_b])
+                    graph_placeholder = torch.zeros([len(graphs), max_num_node_a, max_num_node_b], dtype=torch.from_numpy(val).dtype)
                     for graph_i, graph in enumerate(graph_t):
                         num_node_a = graph[key].shape[0]
                         num_node_b = graph[key].shape[1]
@@ -37,7 +37,7 @@ class ILWrapper(Wrapper):
                     pass
                 else:
                     max_num_node = max([graph[key].shape[0] for graph in graph_t])
-                    graph_placeholder = torch.zeros([len(graphs), max_num_node, *val.shape[1:]])
+                    graph_placeholder = torch.zeros([len(graphs), max_num_node, *val.shape[1:]], dtype=torch.from_numpy(val).dtype)
                     for graph_i, graph in enumerate(graph_t):
                         num_node = len(graph[key])
                         graph_placeholder[graph_i, :num_node] = torch.from_numpy(graph[key])[:num_node][None]
@@ -48,6 +48,7 @@ class ILWrapper(Wrapper):
         with torch.no_grad():
             obs_batch, t, done_list = batch
             obs_batch['step'] = t
-            graphs = self.get_batch_graph(graphs, t)
-            obs_batch.update(graphs)
+            # None when the batch already holds the graphs of the step (see ILCollate)
+            if graphs is not None:
+                obs_batch.update(self.get_batch_graph(graphs, t))
         return obs_batch
@@ -8,6 +8,7 @@ import torch
 import torch.nn as nn
 import torch.optim as optim
 import torch.nn.functional as F
+from model.utils import autocast
 EPS_PPO = 1e-5
 
 class PPO(nn.Module):
@@ -25,6 +26,7 @@ class PPO(nn.Module):
         max_grad_norm=None,
         use_clipped_value_loss=True,
         use_normalized_advantage=True,
+        use_amp=False,
     ):
 
         super().__init__()
@@ -51,6 +53,9 @@ class PPO(nn.Module):
 
         self.device = next(actor_critic.parameters()).device
         self.use_normalized_advantage = use_normalized_advantage
+        # Mixed precision: evaluate_actions under float16 autocast, the losses in float32 and scaled for backward
+        self.use_amp = use_amp and self.device.type == 'cuda'
+        self.scaler = torch.cuda.amp.GradScaler(enabled=self.use_amp)
 
     def forward(self, *x):
         raise NotImplementedError
@@ -89,19 +94,21 @@ class PPO(nn.Module):
                 ) = sample
 
                 # Reshape to do in a single forward pass for all steps
-                (
-                    values,
-                    action_log_probs,
-                    dist_entropy,
-                    _,
-                    [progress, istarget],
-                ) = self.actor_critic.evaluate_actions(
-                    obs_batch,
-                    recurrent_hidden_states_batch,
-                    prev_actions_batch,
-                    masks_batch,
-                    actions_batch,
-                )
+                with autocast(self.device, enabled=self.use_amp):
+                    (
+                        values,
+                        action_log_probs,
+                        dist_entropy,
+                        _,
+                        [progress, istarget],
+                    ) = self.actor_critic.evaluate_actions(
+                        obs_batch,
+                        recurrent_hidden_states_batch,
+                        prev_actions_batch,
+                        masks_batch,
+                        actions_batch,
+                    )
+                values, action_log_probs, dist_entropy = values.float(), action_log_probs.float(), dist_entropy.float()
 
                 ratio = torch.exp(
                     action_log_probs - old_action_log_probs_batch
@@ -138,20 +145,21 @@ class PPO(nn.Module):
                 )
 
                 if 'progress' in obs_batch: #progress monitor
-                    progress_loss = F.mse_loss(torch.sigmoid(progress), obs_batch['progress'].float())
+                    progress_loss = F.mse_loss(torch.sigmoid(progress.float()), obs_batch['progress'].float())
                     total_loss += progress_loss
                     progress_loss_epoch += progress_loss.item()
                 if 'is_goal' in obs_batch: #goal sensor
-                    goal_loss = F.mse_loss(torch.sigmoid(istarget).reshape(-1), obs_batch['is_goal'].reshape(-1).float())
+                    goal_loss = F.mse_loss(torch.sigmoid(istarget.float()).reshape(-1), obs_batch['is_goal'].reshape(-1).float())
                     total_loss += goal_loss
                     goal_loss_epoch += goal_loss.item()
 
                 self.before_backward(total_loss)
-                total_loss.backward()
+                self.scaler.scale(total_loss).backward()
                 self.after_backward(total_loss)
 
                 self.before_step()
-                self.optimizer.step()
+                self.scaler.step(self.optimizer)
+                self.scaler.update()
                 self.after_step()
 
                 value_loss_epoch += value_loss.item()
@@ -176,6 +184,8 @@ class PPO(nn.Module):
         pass
 
     def before_step(self):
+        # The gradients are clipped unscaled
+        self.scaler.unscale_(self.optimizer)
         nn.utils.clip_grad_norm_(
             self.actor_critic.parameters(), self.max_grad_norm
         )
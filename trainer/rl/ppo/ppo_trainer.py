@@ -26,6 +26,7 @@ from habitat_baselines.common.utils import (
     linear_decay,
 )
 from trainer.rl.ppo.ppo import PPO
+from model.utils import autocast
 import pickle, time
 from env_utils import *
 from model.policy import *
@@ -215,6 +216,7 @@ class PPOTrainer(BaseRLTrainer):
             eps=ppo_cfg.eps,
             max_grad_norm=ppo_cfg.max_grad_norm,
             use_normalized_advantage=ppo_cfg.use_normalized_advantage,
+            use_amp=ppo_cfg.amp,
         )
 
     def save_checkpoint(
@@ -307,7 +309,7 @@ class PPOTrainer(BaseRLTrainer):
 
         t_sample_action = time.time()
         # sample actions
-        with torch.no_grad():
+        with torch.no_grad(), autocast(self.device, enabled=self.agent.use_amp):
 
             (
                 values,
@@ -323,6 +325,8 @@ class PPOTrainer(BaseRLTrainer):
                 self.last_prev_actions,
                 self.last_masks
             )
+            # The rollouts and the recurrent state stay in float32
+            values, actions_log_probs, recurrent_hidden_states = values.float(), actions_log_probs.float(), recurrent_hidden_states.float()
 
         pth_time += time.time() - t_sample_action
 
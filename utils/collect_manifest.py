@@ -0,0 +1,129 @@
+import glob
+import hashlib
+import json
+import os
+import socket
+import time
+import joblib
+import numpy as np
+
+PLANNED, RUNNING, DONE = 'planned', 'running', 'done'
+
+
+def file_checksum(file_name):
+    """ sha1 of the content of a file """
+    sha = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+# Compression joblib infers from the extension of a file name, at its default level
+COMPRESSION_EXTENSIONS = {'.z': 'zlib', '.gz': 'gzip', '.bz2': 'bz2', '.lzma': 'lzma', '.xz': 'xz'}
+
+
+def dump_compression(file_name):
+    """ The joblib compress argument matching the extension of file_name, as joblib.dump(data, file_name) uses """
+    method = COMPRESSION_EXTENSIONS.get(os.path.splitext(file_name)[1])
+    return (method, 3) if method is not None else 0
+
+
+def atomic_dump(data, file_name):
+    """
+    joblib.dump to a temporary file renamed to file_name, so that a crash never leaves a partial output.
+    The temporary file does not have the extension of file_name, so the compression is given explicitly.
+    """
+    tmp_file_name = '{}.tmp{}'.format(file_name, os.getpid())
+    joblib.dump(data, tmp_file_name, compress=dump_compression(file_name))
+    os.replace(tmp_file_name, file_name)
+
+
+def select_shard(items, num_shards, shard_id, contiguous=False):
+    """
+    The items handled by shard shard_id out of num_shards: every num_shards-th item, or with contiguous, the
+    shard_id-th of num_shards consecutive blocks (np.array_split)
+    """
+    if not 0 <= shard_id < num_shards:
+        raise ValueError("Shard id {} is out of the {} shards".format(shard_id, num_shards))
+    items = sorted(items)
+    if contiguous:
+        return [items[i] for i in np.array_split(np.arange(len(items)), num_shards)[shard_id]]
+    return items[shard_id::num_shards]
+
+
+class CollectManifest(object):
+    """
+    Append-only JSONL record of the units of work of a collection run (episodes for collect_il_data.py and
+    collect_graph.py): one line per status change with the unit, its status (planned, running, done), the process
+    that owns it and the checksums of its outputs.
+    Every shard of a run writes its own file, path.shard{id}of{num}.jsonl, so that shards running on different
+    machines never append to the same file. The state is read back from the files of all the shards, the last line
+    of a unit wins. A line cut by a crash is ignored.
+    """
+    def __init__(self, path, num_shards=1, shard_id=0):
+        self.path = path
+        self.file_name = '{}.shard{}of{}.jsonl'.format(path, shard_id, num_shards)
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+        dir_name = os.path.dirname(self.file_name)
+        if dir_name:
+            os.makedirs(dir_name, exist_ok=True)
+        self.records = self.load()
+
+    def load(self):
+        records = {}
+        for file_name in sorted(glob.glob('{}.shard*.jsonl'.format(self.path))):
+            with open(file_name) as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    records[record['unit']] = record
+        return records
+
+    def _append(self, unit, status, outputs=(), checksums=()):
+        record = {'unit': unit, 'status': status, 'owner': self.owner, 'outputs': list(outputs), 'checksums': list(checksums), 'time': time.time()}
+        line = json.dumps(record) + '\n'
+        if os.path.exists(self.file_name) and os.path.getsize(self.file_name) > 0:
+            with open(self.file_name, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                if f.read(1) != b'\n':
+                    # Terminate the line cut by a crash
+                    line = '\n' + line
+        # One short line per write with O_APPEND, so processes of the same shard can share the file
+        with open(self.file_name, 'a') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self.records[unit] = record
+
+    def adopt(self, unit, outputs):
+        """ Record as done a unit without record whose outputs already exist, written before the manifest was used """
+        if unit not in self.records and len(outputs) > 0 and all(os.path.exists(output) for output in outputs):
+            self.finish(unit, outputs)
+
+    def status(self, unit):
+        return self.records[unit]['status'] if unit in self.records else None
+
+    def is_done(self, unit, outputs=()):
+        """ Done, with the given outputs among its outputs, and its outputs are still there """
+        record = self.records.get(unit)
+        if record is None or record['status'] != DONE or not set(outputs) <= set(record['outputs']):
+            return False
+        return all(os.path.exists(output) for output in record['outputs'])
+
+    def plan(self, units):
+        for unit in units:
+            if unit not in self.records:
+                self._append(unit, PLANNED)
+
+    def start(self, unit):
+        self._append(unit, RUNNING)
+
+    def finish(self, unit, outputs=()):
+        self._append(unit, DONE, outputs, [file_checksum(output) for output in outputs])
+
+    def pending(self, units):
+        """ The units that are not done yet, including the ones left running by a crashed run """
+        return [unit for unit in units if not self.is_done(unit)]
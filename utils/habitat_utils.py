@@ -244,6 +244,10 @@ def _to_tensor(v):
     else:
         return torch.tensor(v, dtype=torch.float)
 
+# Observations kept in their storage dtype by batch_obs (see memory.*_dtype in configs/default.py)
+COMPACT_OBS_PREFIX = ('img_memory_', 'obj_memory_')
+
+
 def batch_obs(
     observations: List[Dict], device: Optional[torch.device] = None
 ) -> Dict[str, torch.Tensor]:
@@ -256,7 +260,8 @@ def batch_obs(
             Will not move the tensors if None
 
     Returns:
-        transposed dict of lists of observations.
+        transposed dict of lists of observations. The graph memory keeps its
+        compact dtype (float64 becomes float32), everything else is cast to float.
     """
     batch = defaultdict(list)
     for obs in observations:
@@ -268,11 +273,14 @@ def batch_obs(
                 print(sensor)
     for sensor in batch:
         try:
-            batch[sensor] = (
-                torch.stack(batch[sensor], dim=0)
-                .to(device=device)
-                .to(dtype=torch.float)
-            )
+            batch[sensor] = torch.stack(batch[sensor], dim=0)
+            if not sensor.startswith(COMPACT_OBS_PREFIX):
+                dtype = torch.float
+            elif batch[sensor].dtype == torch.float64:
+                dtype = torch.float32
+            else:
+                dtype = batch[sensor].dtype
+            batch[sensor] = batch[sensor].to(device=device).to(dtype=dtype)
         except:
             print(sensor)
 
@@ -0,0 +1,141 @@
+import math
+import torch
+import torch.nn.functional as F
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+GRAY_WEIGHTS = [0.299, 0.587, 0.114]
+
+
+def to_float_image(rgb):
+    """ (N, H, W, 3) uint8 or [0, 255] frames to (N, 3, H, W) float in [0, 1] """
+    return rgb.permute(0, 3, 1, 2).float() / 255.
+
+
+def normalize(img):
+    """ transforms.Normalize with the ImageNet statistics, on a (N, 3, H, W) batch """
+    mean = torch.tensor(IMAGENET_MEAN, device=img.device, dtype=img.dtype).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD, device=img.device, dtype=img.dtype).view(1, 3, 1, 1)
+    return (img - mean) / std
+
+
+def grayscale(img):
+    weights = torch.tensor(GRAY_WEIGHTS, device=img.device, dtype=img.dtype).view(1, 3, 1, 1)
+    return (img * weights).sum(1, keepdim=True)
+
+
+def blend(img1, img2, ratio):
+    """ ratio * img1 + (1 - ratio) * img2 with a ratio per image, as in PIL ImageEnhance """
+    return (ratio * img1 + (1 - ratio) * img2).clamp(0, 1)
+
+
+def rgb_to_hsv(img):
+    r, g, b = img.unbind(1)
+    maxc, _ = img.max(1)
+    minc, _ = img.min(1)
+    delta = maxc - minc
+    s = delta / torch.where(maxc == 0, torch.ones_like(maxc), maxc)
+    delta_safe = torch.where(delta == 0, torch.ones_like(delta), delta)
+    rc, gc, bc = (maxc - r) / delta_safe, (maxc - g) / delta_safe, (maxc - b) / delta_safe
+    h = torch.where(maxc == r, bc - gc, torch.where(maxc == g, 2.0 + rc - bc, 4.0 + gc - rc))
+    h = torch.where(delta == 0, torch.zeros_like(h), h)
+    h = (h / 6.0) % 1.0
+    return torch.stack([h, s, maxc], 1)
+
+
+def hsv_to_rgb(img):
+    h, s, v = img.unbind(1)
+    i = torch.floor(h * 6.0)
+    f = h * 6.0 - i
+    i = i.long() % 6
+    p = (v * (1.0 - s)).clamp(0, 1)
+    q = (v * (1.0 - s * f)).clamp(0, 1)
+    t = (v * (1.0 - s * (1.0 - f))).clamp(0, 1)
+    mask = (i.unsqueeze(1) == torch.arange(6, device=img.device).view(1, -1, 1, 1)).to(img.dtype)
+    r = torch.stack([v, q, p, p, t, v], 1)
+    g = torch.stack([t, v, v, q, p, p], 1)
+    b = torch.stack([p, p, t, v, v, q], 1)
+    return torch.stack([(r * mask).sum(1), (g * mask).sum(1), (b * mask).sum(1)], 1)
+
+
+def gaussian_blur(img, sigma, kernel_size):
+    """ Separable gaussian blur of a (N, C, H, W) batch with a sigma per image, as grouped convolutions """
+    N, C, H, W = img.shape
+    x = torch.arange(kernel_size, device=img.device, dtype=img.dtype) - (kernel_size - 1) / 2
+    kernel = torch.exp(-0.5 * (x[None] / sigma[:, None]) ** 2)
+    kernel = (kernel / kernel.sum(1, keepdim=True)).repeat_interleave(C, 0)
+    pad = kernel_size // 2
+    out = img.reshape(1, N * C, H, W)
+    out = F.conv2d(F.pad(out, [pad, pad, 0, 0], mode='reflect'), kernel.view(N * C, 1, 1, kernel_size), groups=N * C)
+    out = F.conv2d(F.pad(out, [0, 0, pad, pad], mode='reflect'), kernel.view(N * C, 1, kernel_size, 1), groups=N * C)
+    return out.view(N, C, H, W)
+
+
+class BatchAugmentation(object):
+    """
+    The ColorJitter / RandomGrayscale / GaussianBlur / Normalize pipeline of IL training, applied to a whole batch of
+    frames on its device, with random parameters drawn per frame.
+    Takes (N, H, W, 3) frames in [0, 255] (uint8 or float) and returns normalized (N, 3, H, W) float tensors.
+    """
+    def __init__(self, jitter=(0.4, 0.4, 0.4, 0.1), p_jitter=0.8, p_grayscale=0.2, blur_sigma=(.1, 2.), p_blur=0.5, img_size=None):
+        self.brightness, self.contrast, self.saturation, self.hue = jitter
+        self.p_jitter = p_jitter
+        self.p_grayscale = p_grayscale
+        self.blur_sigma = blur_sigma
+        self.p_blur = p_blur
+        self.blur_kernel_size = 2 * int(math.ceil(3 * blur_sigma[1])) + 1
+        self.img_size = img_size
+
+    def uniform(self, n, low, high, device):
+        return torch.empty(n, device=device).uniform_(low, high).view(n, 1, 1, 1)
+
+    def apply(self, img, aug, p):
+        """ aug(img) on a random subset of the frames, each kept with probability p """
+        mask = torch.rand(img.shape[0], device=img.device) < p
+        if not mask.any():
+            return img
+        img = img.clone()
+        img[mask] = aug(img[mask])
+        return img
+
+    def color_jitter(self, img):
+        n, device = img.shape[0], img.device
+        # One random order of the four adjustments per batch, like transforms.ColorJitter per frame
+        for fn_id in torch.randperm(4).tolist():
+            if fn_id == 0 and self.brightness > 0:
+                img = blend(img, torch.zeros_like(img), self.uniform(n, 1 - self.brightness, 1 + self.brightness, device))
+            elif fn_id == 1 and self.contrast > 0:
+                mean = grayscale(img).mean((1, 2, 3), keepdim=True)
+                img = blend(img, mean, self.uniform(n, 1 - self.contrast, 1 + self.contrast, device))
+            elif fn_id == 2 and self.saturation > 0:
+                img = blend(img, grayscale(img), self.uniform(n, 1 - self.saturation, 1 + self.saturation, device))
+            elif fn_id == 3 and self.hue > 0:
+                hsv = rgb_to_hsv(img)
+                hue_shift = self.uniform(n, -self.hue, self.hue, device).view(n, 1, 1)
+                hsv = torch.stack([(hsv[:, 0] + hue_shift) % 1.0, hsv[:, 1], hsv[:, 2]], 1)
+                img = hsv_to_rgb(hsv)
+        return img
+
+    def blur(self, img):
+        sigma = torch.empty(img.shape[0], device=img.device).uniform_(*self.blur_sigma)
+        return gaussian_blur(img, sigma, self.blur_kernel_size)
+
+    def resize(self, img):
+        if self.img_size is not None and tuple(img.shape[-2:]) != tuple(self.img_size):
+            img = F.interpolate(img, size=tuple(self.img_size), mode='bilinear', align_corners=False)
+        return img
+
+    def __call__(self, rgb):
+        with torch.no_grad():
+            img = to_float_image(rgb)
+            img = self.apply(img, self.color_jitter, self.p_jitter)
+            img = self.apply(img, lambda x: grayscale(x).expand(-1, 3, -1, -1), self.p_grayscale)
+            img = self.apply(img, self.blur, self.p_blur)
+            return normalize(self.resize(img))
+
+
+class BatchNormalize(BatchAugmentation):
+    """ The evaluation pipeline (Resize / ToTensor / Normalize) on a batch of frames """
+    def __call__(self, rgb):
+        with torch.no_grad():
+            return normalize(self.resize(to_float_image(rgb)))